@@ -36,6 +36,25 @@ def average_weights(w,weights):
         # w_avg[key] = torch.div(w_avg[key], len(w))
     return w_avg
 
+def average_vectors(vectors,weights,chunk_size=65536):
+    """
+    Returns the average of flat parameter vectors (see model_store), with the same
+    operations as average_weights on each element. The vectors are summed chunk by
+    chunk, so that the partial sums stay in the CPU cache.
+    """
+    weights = weights/sum(weights)
+    v_avg = torch.empty_like(vectors[0])
+    temp = torch.empty(min(chunk_size, len(v_avg)), dtype=v_avg.dtype, device=v_avg.device)
+    for start in range(0, len(v_avg), chunk_size):
+        stop = min(start + chunk_size, len(v_avg))
+        v_chunk = v_avg[start:stop]
+        temp_chunk = temp[:stop - start]
+        torch.mul(vectors[0][start:stop],weights[0],out=v_chunk)
+        for i in range(1, len(vectors)):
+            torch.mul(vectors[i][start:stop],weights[i],out=temp_chunk)
+            v_chunk += temp_chunk
+    return v_avg
+
 def sum_weights(w):
     """
     Returns the sum of the weights.
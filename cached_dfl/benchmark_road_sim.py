@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the road simulation.
+
+For every county the graph is timed cold (parsed from the csv) and warm (loaded from the
+road cache), together with the area clustering. For every (county, num_car, radius) the
+car initialization, the per-second move step and the contact detection of every backend
+are timed over the same simulated seconds. Throughput is in car-seconds per second.
+Every case runs in a fresh process, so its peak RSS is its own (start_rss_mb is the RSS
+of the imports before the case). The results are written as JSON, and --baseline
+compares them with an earlier file to catch regressions.
+
+    python benchmark_road_sim.py --num_car 100 1000 10000 --radius 100 200 --output bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import road_network
+from road_sim import (
+    Random_SEED, filter_edges_by_group, get_pairs_in_range, init_fleet
+)
+
+
+def get_peak_rss():
+    # peak resident set size of this process in MB, None where it is not available
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def benchmark_graph(csv_files, County, num_area):
+    """
+    Time building the county graph from the csv, loading it from the road cache and
+    clustering its areas.
+    """
+    start_rss = get_peak_rss()
+    cache_dir = tempfile.mkdtemp(prefix='road_cache_')
+    try:
+        start = time.perf_counter()
+        road_net = road_network.RoadNetworkRegistry(csv_files, cache_dir).get(County)
+        cold_load = time.perf_counter() - start
+        start = time.perf_counter()
+        road_network.RoadNetworkRegistry(csv_files, cache_dir).get(County)
+        warm_load = time.perf_counter() - start
+        area = {}
+        for method in road_network.AREA_METHODS:
+            start = time.perf_counter()
+            road_network.cluster_areas(road_net.pos_array, num_area, Random_SEED, method)
+            area[method] = time.perf_counter() - start
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    return {
+        'stage': 'graph',
+        'County': County,
+        'num_nodes': int(road_net.num_nodes),
+        'num_edges': int(road_net.num_edges),
+        'cold_load_s': cold_load,
+        'warm_load_s': warm_load,
+        'area_s': area,
+        'start_rss_mb': start_rss,
+        'peak_rss_mb': get_peak_rss(),
+    }
+
+
+def benchmark_simulation(csv_files, cache_dir, County, num_car, circle_radius, seconds, speed, num_area,
+                         backends, seed):
+    """
+    Time the initialization of num_car cars, `seconds` move steps and the contact detection
+    of every backend on the positions of those steps.
+    """
+    start_rss = get_peak_rss()
+    road_network.road_registry = road_network.RoadNetworkRegistry(csv_files, cache_dir)
+    road_net = road_network.road_registry.get(County)
+    area_labels = road_net.get_area_labels(num_area, Random_SEED)
+    adj_matrix_area = filter_edges_by_group(road_net.adj_matrix, area_labels)
+    speed = speed * 0.00145/100
+    radius = circle_radius * 0.00145/100
+
+    def new_fleet():
+        return init_fleet(num_car, [0]*num_car, speed, road_net.pos_array, road_net.adj_matrix, adj_matrix_area,
+                          area_labels, np.random.RandomState(seed), random.Random(seed))
+
+    start = time.perf_counter()
+    fleet = new_fleet()
+    init_time = time.perf_counter() - start
+
+    positions = np.zeros((seconds, num_car, 2))
+    start = time.perf_counter()
+    for second in range(seconds):
+        fleet.move(1)
+        positions[second] = fleet.current_position
+    move_time = time.perf_counter() - start
+
+    car_seconds = num_car * seconds
+    contact = {}
+    for backend in backends:
+        num_pairs = 0
+        start = time.perf_counter()
+        for second in range(seconds):
+            num_pairs += len(get_pairs_in_range(positions[second], radius, backend)[0])
+        contact_time = time.perf_counter() - start
+        contact[backend] = {
+            'time_s': contact_time,
+            'car_seconds_per_s': car_seconds / contact_time,
+            'pairs_in_range': num_pairs,
+        }
+
+    return {
+        'stage': 'simulation',
+        'County': County,
+        'num_car': num_car,
+        'circle_radius': circle_radius,
+        'seconds': seconds,
+        'init_s': init_time,
+        'move_s': move_time,
+        'move_car_seconds_per_s': car_seconds / move_time,
+        'contact': contact,
+        'start_rss_mb': start_rss,
+        'peak_rss_mb': get_peak_rss(),
+    }
+
+
+def run_isolated(function, *args):
+    # one fresh process per case, so that the peak RSS is not inherited from earlier cases
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def get_throughputs(result):
+    # (case, metric) -> car-seconds per second, for the comparison with a baseline
+    if result['stage'] != 'simulation':
+        return {}
+    case = (result['County'], result['num_car'], result['circle_radius'])
+    throughputs = {case + ('move',): result['move_car_seconds_per_s']}
+    for backend, contact in result['contact'].items():
+        throughputs[case + (backend,)] = contact['car_seconds_per_s']
+    return throughputs
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    """
+    Print the throughput ratios against a previous benchmark file and return the cases
+    that are slower than (1 - tolerance) times the baseline.
+    """
+    with open(baseline_path) as file:
+        baseline = {}
+        for result in json.load(file)['results']:
+            baseline.update(get_throughputs(result))
+    regressions = []
+    for result in results:
+        for case, throughput in get_throughputs(result).items():
+            if case not in baseline:
+                continue
+            ratio = throughput / baseline[case]
+            print('{} {:.2f}x'.format(case, ratio))
+            if ratio < 1 - tolerance:
+                regressions.append({'case': list(case), 'ratio': ratio})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the road simulation")
+    parser.add_argument("--County", nargs='+', type=str, default=["New York"], help="Counties to benchmark")
+    parser.add_argument("--num_car", nargs='+', type=int, default=[100, 1000, 10000], help="Fleet sizes")
+    parser.add_argument("--radius", nargs='+', type=float, default=[100], help="Communication distances")
+    parser.add_argument("--backend", nargs='+', type=str, default=['dense', 'grid', 'kdtree'],
+                        choices=['dense', 'grid', 'kdtree'], help="Contact detection backends")
+    parser.add_argument("--seconds", type=int, default=60, help="Simulated seconds per case")
+    parser.add_argument("--speed", type=float, default=13.59, help="Speed of the cars")
+    parser.add_argument("--num_area", type=int, default=10, help="Number of areas")
+    parser.add_argument("--dense_max_car", type=int, default=3000,
+                        help="Largest fleet timed with the dense backend (num_car^2 memory)")
+    parser.add_argument("--seed", type=int, default=Random_SEED, help="Seed of the initial positions")
+    parser.add_argument("--road_data", nargs='+', type=str, default=[],
+                        help="Extra road csv files (StartLat/StartLong/EndLat/EndLong/Miles/County)")
+    parser.add_argument("--road_cache", type=str, default="./road_cache", help="Directory caching the road networks")
+    parser.add_argument("--output", type=str, default="benchmark_road_sim.json", help="JSON result file")
+    parser.add_argument("--baseline", type=str, default="", help="Earlier JSON result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative throughput loss against --baseline reported as a regression")
+    args = parser.parse_args()
+
+    road_network.road_registry.cache_dir = args.road_cache
+    for road_file in args.road_data:
+        road_network.road_registry.add_csv(road_file)
+    csv_files = road_network.road_registry.csv_files
+
+    results = []
+    for County in args.County:
+        result = run_isolated(benchmark_graph, csv_files, County, args.num_area)
+        print('{County}: {num_nodes} nodes, cold load {cold_load_s:.2f}s, warm load {warm_load_s:.3f}s'.format(**result))
+        results.append(result)
+        # the simulation cases load the graph from the shared road cache
+        road_network.road_registry.get(County)
+        for num_car in args.num_car:
+            backends = [backend for backend in args.backend if backend != 'dense' or num_car <= args.dense_max_car]
+            for circle_radius in args.radius:
+                result = run_isolated(benchmark_simulation, csv_files, args.road_cache, County, num_car,
+                                      circle_radius, args.seconds, args.speed, args.num_area, backends, args.seed)
+                print('{} cars, radius {}: init {:.3f}s, move {:.3g} car-s/s, '.format(
+                    num_car, circle_radius, result['init_s'], result['move_car_seconds_per_s'])
+                    + ', '.join('{} {:.3g} car-s/s'.format(backend, contact['car_seconds_per_s'])
+                                for backend, contact in result['contact'].items()))
+                results.append(result)
+
+    report = {
+        'machine': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'config': vars(args),
+        'results': results,
+    }
+    if args.baseline:
+        report['regressions'] = compare_with_baseline(results, args.baseline, args.tolerance)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('Benchmark written to ' + args.output)
+    if report.get('regressions'):
+        print('Throughput regressions against ' + args.baseline + ': ' + str(report['regressions']))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 import numpy as np
-from aggregation import average_weights, sum_weights, div_weights, mul_weights
+from aggregation import average_weights, average_vectors, sum_weights, div_weights, mul_weights
+from model_store import get_cache_layout
 import random,copy
+import heapq
 import cvxpy as cp
 import seed_setter
 seed_setter.set_seed()
+eviction_rng = random.Random(seed_setter.SEED) # tie-breaking of the cache evictions
 import collections
 
 def get_mixing_weight(current_time,cached_time):
@@ -164,6 +167,67 @@ def delete_cache_global(d,cache_info):
     
     return d,cache_info
 
+class BoundedCache(dict):
+    """
+    Cache dict of one car that evicts down to a capacity in one pass: a min-heap on the
+    term of its entries ('time' by default) is built from their current values when the
+    eviction starts and the smallest entries are popped, instead of shuffling and scanning
+    the whole dict for every eviction. Each entry gets a random tie-breaker from rng, so
+    that ties are broken as in delete_smallest_value. The heap is not kept between
+    evictions, since the update functions change terms such as cache_score in place.
+    """
+    def __init__(self, entries = (), term = 'time', rng = eviction_rng):
+        super().__init__(entries)
+        self.term = term
+        self.rng = rng
+
+    def evict_to(self, capacity):
+        # delete the entries with the smallest term until at most capacity are left, returns their keys
+        if len(self) <= capacity:
+            return []
+        heap = [(value.get(self.term, float('inf')), self.rng.random(), index, key)
+                for index, (key, value) in enumerate(self.items())]
+        heapq.heapify(heap)
+        evicted = [heapq.heappop(heap)[3] for _ in range(len(self) - capacity)]
+        for key in evicted:
+            del self[key]
+        return evicted
+
+
+def evict_to_capacity(d, capacity, term = 'time', rng = eviction_rng):
+    """
+    Delete the entries of d with the smallest term, ties broken at random, until at most
+    capacity are left: what calling delete_smallest_value until d fits does, in one pass.
+    Returns d as a BoundedCache on term.
+    """
+    if len(d) <= capacity:
+        return d
+    if not isinstance(d, BoundedCache) or d.term != term:
+        d = BoundedCache(d, term, rng)
+    d.evict_to(capacity)
+    return d
+
+def evict_random(d, capacity, rng = eviction_rng):
+    # delete_random until at most capacity entries are left, in one pass
+    if len(d) > capacity:
+        for key in rng.sample(list(d), len(d) - capacity):
+            del d[key]
+    return d
+
+def evict_cache_global(d, capacity, cache_info, rng = eviction_rng):
+    """
+    delete_cache_global until at most capacity entries are left, in one pass: the entries
+    of the models held by the most caches go first, the oldest of them first, ties broken
+    at random. Deleting an entry only changes the count of its own model, so the order of
+    the others holds for the whole pass.
+    """
+    if len(d) > capacity:
+        order = sorted(d, key=lambda key: (-cache_info[key], d[key].get('time', float('inf')), rng.random()))
+        for key in order[:len(d) - capacity]:
+            del d[key]
+            cache_info[key] -= 1
+    return d, cache_info
+
 # def delete_smallest_time_count(d):
 #     # random delete the min time value
 #     #random shuffle the dictionary
@@ -273,9 +337,9 @@ def non_confliction_on_slot(cache_a,cache_b,slot):
         
 def update_model_cache_only_one(local_cache,model_a,model_b,a,b,round_index,cache_size, kick_out):
     
-    #update other's model into cache
-    temp_model_a = copy.deepcopy(model_a)
-    temp_model_b = copy.deepcopy(model_b)
+    #update other's model into cache, model_a/model_b are shared read-only versions
+    temp_model_a = model_a
+    temp_model_b = model_b
     local_cache[a][b] = {'model' :temp_model_b,'time' : round_index}
     local_cache[b][a] = {'model' : temp_model_a,'time' : round_index}
     
@@ -286,10 +350,8 @@ def update_model_cache_only_one(local_cache,model_a,model_b,a,b,round_index,cach
     #     kick_out_timeout_model(local_cache[b],round_index-cache_size)
         
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'time')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'time')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'time')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'time')
         
         
 # def put_own_model_into_cache(local_cache, model_list,index,round_index):
@@ -341,10 +403,8 @@ def update_model_cache_fresh(local_cache, model_a,model_b,a,b,round_index,cache_
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'fresh')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'fresh')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'fresh')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'fresh')
         
         
         
@@ -410,10 +470,8 @@ def update_model_cache_fresh_count(local_cache, model_a,model_b,a,b,round_index,
     # while len(local_cache[b])>cache_size:
     #     local_cache[b] = delete_smallest_time_count(local_cache[b])
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'cache_score')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'cache_score')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'cache_score')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'cache_score')
         
         
 def update_model_cache_fresh_v2(local_cache, model_a,model_b,a,b,round_index,cache_size, model_fresh_table, cache_statistic_table, kick_out):
@@ -478,10 +536,8 @@ def update_model_cache_fresh_v2(local_cache, model_a,model_b,a,b,round_index,cac
     # while len(local_cache[b])>cache_size:
     #     local_cache[b] = delete_smallest_time_count(local_cache[b])
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'cache_score')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'cache_score')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'cache_score')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'cache_score')
         
         
 
@@ -543,10 +599,8 @@ def update_model_cache_fresh_v3(local_cache, model_a,model_b,a,b,round_index,cac
     # while len(local_cache[b])>cache_size:
     #     local_cache[b] = delete_smallest_time_count(local_cache[b])
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'fresh')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'fresh')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'fresh')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'fresh')
         
     
         
@@ -589,10 +643,8 @@ def update_model_cache_combination(local_cache, model_a,model_b,a,b,round_index,
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'time')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'time')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'time')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'time')
 
 
 def update_best_model_cache(local_cache, model_a,model_b,a,b,round_index,cache_size, test_score):
@@ -631,10 +683,8 @@ def update_best_model_cache(local_cache, model_a,model_b,a,b,round_index,cache_s
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'time')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'time')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'time')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'time')
 
 def update_model_cache_distribution(local_cache, model_a,model_b,a,b,round_index,cache_size,age_threshold,statistic_data,max_std,alpha):
     
@@ -685,10 +735,8 @@ def update_model_cache_distribution(local_cache, model_a,model_b,a,b,round_index
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'cache_score')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'cache_score')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'cache_score')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'cache_score')
 def update_model_cache_mixing_old(local_cache, model_list,a,b,round_index,mixing_table):
     #update own model into cache
     local_cache[a]['self'] = {'model' : {a:model_list[a]},'time' : [round_index],'mixing_record':str(a)}
@@ -1038,12 +1086,34 @@ def update_model_cache_mixing(local_cache, model_a,model_b,a,b,round_index,slot_
     #     local_cache[b][slot]['time'] = max(local_cache[b][slot]['time_list'].values())
 
 
-def update_model_cache(local_cache, model_a,model_b,a,b,round_index,cache_size, kick_out ):
+def get_model_size(model):
+    # bytes of the parameters and buffers sent when a model is transferred
+    return sum(tensor.numel() * tensor.element_size() for tensor in model.state_dict().values())
+
+def get_max_transfer(duration, link_rate, model_size):
+    # models a contact of duration seconds carries in each direction over a link_rate Mbit/s link, None if unlimited
+    if link_rate <= 0:
+        return None
+    return int(duration * link_rate * 1e6 / 8 // model_size)
+
+def get_fresher_cache_keys(old_cache, cache, skip, limit = None):
+    # keys of old_cache that cache misses or holds an older version of, the freshest first if only limit of them fit
+    keys = [key for key in old_cache if key != skip and (key not in cache or cache[key]['time'] < old_cache[key]['time'])]
+    if limit is not None and len(keys) > limit:
+        keys = sorted(keys, key=lambda key: old_cache[key]['time'], reverse=True)[:limit]
+    return keys
+
+def update_model_cache(local_cache, model_a,model_b,a,b,round_index,cache_size, kick_out, max_transfer = None ):
+    # max_transfer limits the models sent in each direction (see get_max_transfer):
+    # the own model goes first, then the freshest cached models the other car lacks
+    # model_a/model_b are read-only versions (see model_store), the caches reference them
+    if max_transfer is not None and max_transfer < 1:
+        return
     
-    old_local_cache_a = copy.deepcopy(local_cache[a])
-    old_local_cache_b = copy.deepcopy(local_cache[b])
-    temp_model_a = copy.deepcopy(model_a)
-    temp_model_b = copy.deepcopy(model_b)
+    old_local_cache_a = dict(local_cache[a])
+    old_local_cache_b = dict(local_cache[b])
+    temp_model_a = model_a
+    temp_model_b = model_b
     
     #update other's model into cache
     local_cache[a][b] = {'model' : temp_model_b,'time' : round_index}
@@ -1051,21 +1121,13 @@ def update_model_cache(local_cache, model_a,model_b,a,b,round_index,cache_size,
     
     
     #update cache by fetching other's cache
-    for key in old_local_cache_a:
-        if key == b:
-            continue
-        if key not in local_cache[b]:
-            local_cache[b][key] = old_local_cache_a[key].copy()
-        elif local_cache[b][key]['time']<old_local_cache_a[key]['time']:
-            local_cache[b][key] = old_local_cache_a[key].copy()
-            
-    for key in old_local_cache_b:
-        if key == a:
-            continue
-        if key not in local_cache[a]:
-            local_cache[a][key] = old_local_cache_b[key].copy()
-        elif local_cache[a][key]['time']<old_local_cache_b[key]['time']:
-            local_cache[a][key] = old_local_cache_b[key].copy()
+    limit = None if max_transfer is None else max_transfer - 1
+    keys_a = get_fresher_cache_keys(old_local_cache_a, local_cache[b], b, limit)
+    keys_b = get_fresher_cache_keys(old_local_cache_b, local_cache[a], a, limit)
+    for key in keys_a:
+        local_cache[b][key] = old_local_cache_a[key].copy()
+    for key in keys_b:
+        local_cache[a][key] = old_local_cache_b[key].copy()
 
     #kick out time-out model
     # if kick_out == True:
@@ -1074,18 +1136,16 @@ def update_model_cache(local_cache, model_a,model_b,a,b,round_index,cache_size,
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'time')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'time')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'time')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'time')
 
 
 def update_model_cache_car_to_car_p(local_cache, model_a,model_b,a,b,round_index,cache_size, kick_out, car_type_list,type_limits_car ):
-    
-    old_local_cache_a = copy.deepcopy(local_cache[a])
-    old_local_cache_b = copy.deepcopy(local_cache[b])
-    temp_model_a = copy.deepcopy(model_a)
-    temp_model_b = copy.deepcopy(model_b)
+    # cache entries are replaced, never changed, so the old caches are shallow copies
+    old_local_cache_a = dict(local_cache[a])
+    old_local_cache_b = dict(local_cache[b])
+    temp_model_a = model_a
+    temp_model_b = model_b
     
     #update other's model into cache
     local_cache[a][b] = {'model' : temp_model_b,'time' : round_index, 'car_type': str(car_type_list[b]),'from':'car'}
@@ -1173,10 +1233,8 @@ def update_model_cache_car_to_taxi(local_cache, model_car,car,taxi,round_index,c
     
     
     #keep satisfying the cache size
-    while len(local_cache[car])>cache_size_car:
-        local_cache[car] = delete_smallest_value(local_cache[car],'time')
-    while len(local_cache[taxi])>cache_size_taxi:
-        local_cache[taxi] = delete_smallest_value(local_cache[taxi],'time')
+    local_cache[car] = evict_to_capacity(local_cache[car], cache_size_car, 'time')
+    local_cache[taxi] = evict_to_capacity(local_cache[taxi], cache_size_taxi, 'time')
 
 
 def update_model_cache_car_to_taxi_p(local_cache, model_car,car,taxi,round_index,cache_size_car,cache_size_taxi, kick_out,car_type_list,type_limits_car,type_limits_taxi):
@@ -1256,10 +1314,8 @@ def update_model_cache_taxi_to_taxi(local_cache, a,b,round_index,cache_size, kic
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'time')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'time')   
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'time')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'time')
 
 def update_model_cache_taxi_to_taxi_p(local_cache, a,b,cache_size, type_limits_taxi):
     
@@ -1338,17 +1394,15 @@ def update_model_cache_random(local_cache, model_a,model_b,a,b,round_index,cache
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_random(local_cache[a])
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_random(local_cache[b])
+    local_cache[a] = evict_random(local_cache[a], cache_size)
+    local_cache[b] = evict_random(local_cache[b], cache_size)
 
 def update_model_cache_global(local_cache, model_a,model_b,a,b,round_index,cache_size,cache_info,kick_out):
-    
-    old_local_cache_a = copy.deepcopy(local_cache[a])
-    old_local_cache_b = copy.deepcopy(local_cache[b])
-    temp_model_a = copy.deepcopy(model_a)
-    temp_model_b = copy.deepcopy(model_b)
+    # cache entries are replaced, never changed, so the old caches are shallow copies
+    old_local_cache_a = dict(local_cache[a])
+    old_local_cache_b = dict(local_cache[b])
+    temp_model_a = model_a
+    temp_model_b = model_b
     
     #update other's model into cache
     if b in local_cache[a]:
@@ -1384,10 +1438,8 @@ def update_model_cache_global(local_cache, model_a,model_b,a,b,round_index,cache
         local_cache[a], cache_info = kick_out_timeout_model_cache_info(local_cache[a],round_index-kick_out, cache_info)
         local_cache[b], cache_info = kick_out_timeout_model_cache_info(local_cache[b],round_index-kick_out, cache_info)
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a], cache_info = delete_cache_global(local_cache[a],cache_info)
-    while len(local_cache[b])>cache_size:
-        local_cache[b],cache_info = delete_cache_global(local_cache[b],cache_info)
+    local_cache[a], cache_info = evict_cache_global(local_cache[a], cache_size, cache_info)
+    local_cache[b], cache_info = evict_cache_global(local_cache[b], cache_size, cache_info)
     return cache_info
 
 
@@ -1427,10 +1479,8 @@ def update_model_cache_plus(local_cache, model_a,model_b, datapoint_a,datapoint_
     
     
     #keep satisfying the cache size
-    while len(local_cache[a])>cache_size:
-        local_cache[a] = delete_smallest_value(local_cache[a],'time')
-    while len(local_cache[b])>cache_size:
-        local_cache[b] = delete_smallest_value(local_cache[b],'time')
+    local_cache[a] = evict_to_capacity(local_cache[a], cache_size, 'time')
+    local_cache[b] = evict_to_capacity(local_cache[b], cache_size, 'time')
         
 def update_model_cache_only_one_by_duration(local_cache,model_list,a,b,round_index,num_round,num_car,cache_size,expected_duration,duration):
     #update own model into cache
@@ -1735,6 +1785,16 @@ def cache_average_process_combination(model,local_cache,current_model_time, curr
 
 
 def cache_average_process(model, i,current_round, local_cache, full_weight_list):
+    layout = get_cache_layout(local_cache)
+    if local_cache and layout is not None:
+        # flat snapshots are averaged as vectors, with the own model flattened to their layout
+        vectors = [layout.flatten(model.state_dict())]
+        weight = [full_weight_list[i]]
+        for key in local_cache:
+            vectors.append(local_cache[key]['model'].vector)
+            weight.append(full_weight_list[key]*get_mixing_weight(current_round,local_cache[key]['time']))
+        model.load_state_dict(layout.unflatten(average_vectors(vectors,np.array(weight))))
+        return model
     w=[]
     weight = []
     w.append(model.state_dict())
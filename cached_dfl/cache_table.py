@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+The model caches of the whole fleet as one table, instead of a list of per-car dicts.
+
+time[i, j] is the round of the model of car j in the cache of car i, -1 if car i does not
+cache a model of car j (a car never caches its own model). The table holds keys only, the
+models are the versions (car j, round) of a model_store.ModelStore, pinned there for as long
+as a cell of the table refers to them.
+A meeting, the LRU eviction, the timeout kick-out and the cache statistics are row and
+table operations on time, with the same rules as update_model_cache,
+delete_smallest_value and kick_out_timeout_model on local_cache.
+"""
+import numpy as np
+
+import seed_setter
+from model_store import ModelStore
+
+
+class CacheTable:
+    def __init__(self, num_car, store = None, rng = None):
+        self.num_car = num_car
+        self.time = np.full((num_car, num_car), -1, dtype=np.int64)
+        self.store = ModelStore() if store is None else store
+        # tie-breaking of the evictions, apart from the global stream as eviction_rng of cache_algorithm
+        self.rng = np.random.RandomState(seed_setter.SEED) if rng is None else rng
+
+    def __len__(self):
+        return self.num_car
+
+    def get_cache(self, i):
+        # the cache of car i in the local_cache form, {car: {'model': model, 'time': round}}
+        cars = np.nonzero(self.time[i] >= 0)[0]
+        return {car: {'model': self.store.get(car, round_index), 'time': round_index}
+                for car, round_index in zip(cars.tolist(), self.time[i, cars].tolist())}
+
+    def get_sizes(self):
+        # number of models in the cache of every car
+        return np.count_nonzero(self.time >= 0, axis=1)
+
+    def get_fresher_keys(self, old_row, row, skip, limit = None):
+        # cars old_row holds a newer model of than row, the freshest first if only limit of them fit
+        fresher = old_row > row
+        fresher[skip] = False
+        keys = np.nonzero(fresher)[0]
+        if limit is not None and len(keys) > limit:
+            keys = keys[np.argsort(-old_row[keys], kind='stable')[:limit]]
+        return keys
+
+    def exchange(self, a, b, round_index, cache_size, max_transfer = None):
+        """
+        Meeting of cars a and b in round_index, as update_model_cache: each caches the
+        other's model (its version of round_index in the store), then the models of the other's cache it misses or holds an older
+        version of (at most max_transfer models in each direction, the own one first),
+        and the caches are cut back to cache_size.
+        """
+        if max_transfer is not None and max_transfer < 1:
+            return
+        old_a, old_b = self.time[a].copy(), self.time[b].copy()
+        self.store.pin(a, round_index)
+        self.store.pin(b, round_index)
+        self.time[a, b] = round_index
+        self.time[b, a] = round_index
+        limit = None if max_transfer is None else max_transfer - 1
+        keys_a = self.get_fresher_keys(old_a, self.time[b], b, limit)
+        keys_b = self.get_fresher_keys(old_b, self.time[a], a, limit)
+        self.time[b, keys_a] = old_a[keys_a]
+        self.time[a, keys_b] = old_b[keys_b]
+        self.evict(a, cache_size)
+        self.evict(b, cache_size)
+
+    def evict(self, i, cache_size):
+        # drop the oldest models of car i beyond cache_size, ties broken at random
+        cars = np.nonzero(self.time[i] >= 0)[0]
+        excess = len(cars) - cache_size
+        if excess > 0:
+            order = np.lexsort((self.rng.random_sample(len(cars)), self.time[i, cars]))
+            self.time[i, cars[order[:excess]]] = -1
+
+    def kick_out(self, kick_out_time):
+        # drop every cached model of round kick_out_time or older
+        self.time[self.time <= kick_out_time] = -1
+        self.release()
+
+    def release(self):
+        # unpin the versions no cache refers to anymore
+        cached = self.time >= 0
+        self.store.unpin_except(set(zip(np.nonzero(cached)[1].tolist(), self.time[cached].tolist())))
+
+    def get_statistics(self, round_index):
+        """
+        Number of cached models, their total age in rounds at round_index and, per car,
+        the caches holding its model plus one (cache_info of the trainers).
+        """
+        cached = self.time >= 0
+        cache_num = int(np.count_nonzero(cached))
+        cache_age = int((round_index - self.time[cached]).sum())
+        cache_info = 1 + np.count_nonzero(cached, axis=0).astype(float)
+        return cache_num, cache_age, cache_info
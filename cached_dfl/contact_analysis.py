@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Contact-graph statistics of a mobility trace, to choose kick_out and cache_size without
+a training run.
+
+One pass over a ContactTrace gives the meeting rate of every car, the inter-contact
+times of every pair and the time-respecting reachability between cars: for the model a
+car trains in round r, the round it can first arrive at every other car through a chain
+of meetings (models are exchanged in the order of the trace, as update_model_cache
+does) and the number of hops of that chain. The results are stored next to the trace
+file in the trace store, e.g.
+
+    python contact_analysis.py trace_cache/trace_<key>.npz
+"""
+import argparse
+import os
+
+import numpy as np
+
+from trace_store import load_trace
+
+ANALYSIS_SUFFIX = '_contacts.npz'
+
+
+def get_meeting_rates(trace):
+    """
+    Per car: meetings per round, number of distinct cars met and seconds in contact per
+    round (meetings per round when the trace has no durations).
+    """
+    num_car, num_round = trace.num_car, max(trace.num_round, 1)
+    cars = trace.pairs.ravel()
+    meetings = np.bincount(cars, minlength=num_car) / num_round
+    keys = np.unique(np.sort(trace.pairs, axis=1).astype(np.int64) @ np.array([num_car, 1]))
+    partners = np.bincount(np.concatenate(np.divmod(keys, num_car)), minlength=num_car)
+    duration = np.ones(len(trace.pairs)) if trace.duration is None else trace.duration
+    contact_seconds = np.bincount(cars, weights=np.repeat(duration, 2), minlength=num_car) / num_round
+    return meetings, partners, contact_seconds
+
+
+def get_inter_contact_times(trace):
+    """
+    Seconds between the end of a contact of a pair and the start of its next contact, with
+    the pair (i < j) of every gap. Contacts cut by the round boundary are joined again.
+    """
+    num_car = trace.num_car
+    second = np.repeat(np.arange(len(trace)), np.diff(trace.offsets))
+    duration = np.ones(len(trace.pairs), dtype=np.int64) if trace.duration is None else trace.duration
+    key = np.sort(trace.pairs, axis=1).astype(np.int64) @ np.array([num_car, 1])
+    order = np.lexsort((second, key))
+    key, start, end = key[order], second[order], second[order] + duration[order]
+    same_pair = key[1:] == key[:-1]
+    gap = start[1:] - end[:-1]
+    gap = gap[same_pair & (gap > 0)]
+    pair = np.stack(np.divmod(key[1:][same_pair & (start[1:] > end[:-1])], num_car), axis=1)
+    return gap, pair
+
+
+def iter_reachability(trace):
+    """
+    Time-respecting reachability, scanning the meetings backwards once. For every round r,
+    from the last to the first, yields (r, delay, hops): delay[i, j] is the number of
+    rounds after r in which the round-r model of car i can first be in the cache of car j
+    (-1 if never within the trace), hops[i, j] the meetings on that earliest chain.
+    Every meeting costs one vectorized update of two rows of the num_car x num_car tables.
+    """
+    num_car, epoch_time = trace.num_car, trace.epoch_time
+    never = np.iinfo(np.int64).max
+    # arrival[i, j]: earliest second at which a model held by i now reaches j
+    arrival = np.full((num_car, num_car), never, dtype=np.int64)
+    hops = np.zeros((num_car, num_car), dtype=np.int32)
+    diagonal = np.eye(num_car, dtype=bool)
+    for round_index in range(trace.num_round - 1, -1, -1):
+        for second in range((round_index + 1) * epoch_time - 1, round_index * epoch_time - 1, -1):
+            for a, b in trace[second][::-1].tolist():
+                arrival_a, arrival_b = arrival[a].copy(), arrival[b].copy()
+                hops_a, hops_b = hops[a].copy(), hops[b].copy()
+                for car, other, other_arrival, other_hops in ((a, b, arrival_b, hops_b), (b, a, arrival_a, hops_a)):
+                    # through the other car, earlier or with fewer hops at the same second
+                    better = (other_arrival < arrival[car]) | ((other_arrival == arrival[car]) & (other_hops + 1 < hops[car]))
+                    better &= other_arrival != never
+                    arrival[car, better] = other_arrival[better]
+                    hops[car, better] = other_hops[better] + 1
+                    arrival[car, other] = second
+                    hops[car, other] = 1
+        reached = (arrival != never) & ~diagonal
+        delay = np.where(reached, arrival // epoch_time - round_index, -1)
+        yield round_index, delay, np.where(reached, hops, 0)
+
+
+def analyze_trace(trace):
+    """
+    All statistics of the trace as a dict of arrays:
+    meetings/partners/contact_seconds per car (see get_meeting_rates), inter_contact gaps
+    and their pairs, delay_histogram[r, k] the (i, j) pairs whose round-r model arrives
+    after k rounds (last column: not within the trace), mean_delay/mean_hops/reach_count
+    per (i, j) over the rounds in which it arrives, and sources_within[k] the mean number
+    of cars whose model arrives at a car within k rounds (over rounds with k rounds left).
+    """
+    num_car, num_round = trace.num_car, trace.num_round
+    meetings, partners, contact_seconds = get_meeting_rates(trace)
+    inter_contact, inter_contact_pair = get_inter_contact_times(trace)
+    delay_histogram = np.zeros((num_round, num_round + 1), dtype=np.int64)
+    delay_sum = np.zeros((num_car, num_car))
+    hops_sum = np.zeros((num_car, num_car))
+    reach_count = np.zeros((num_car, num_car), dtype=np.int64)
+    sources_sum = np.zeros(num_round)
+    sources_rounds = np.zeros(num_round, dtype=np.int64)
+    off_diagonal = ~np.eye(num_car, dtype=bool)
+    for round_index, delay, hops in iter_reachability(trace):
+        reached = delay >= 0
+        delay_histogram[round_index] = np.bincount(np.where(reached, delay, num_round)[off_diagonal],
+                                                   minlength=num_round + 1)
+        delay_sum += np.where(reached, delay, 0)
+        hops_sum += hops
+        reach_count += reached
+        # rounds with at least k rounds left after them
+        num_within = delay_histogram[round_index, :num_round - round_index].cumsum()
+        sources_sum[:num_round - round_index] += num_within / num_car
+        sources_rounds[:num_round - round_index] += 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_delay = np.where(reach_count > 0, delay_sum / reach_count, np.nan)
+        mean_hops = np.where(reach_count > 0, hops_sum / reach_count, np.nan)
+        sources_within = sources_sum / sources_rounds
+    return {
+        'num_car': num_car,
+        'num_round': num_round,
+        'epoch_time': trace.epoch_time,
+        'meetings': meetings,
+        'partners': partners,
+        'contact_seconds': contact_seconds,
+        'inter_contact': inter_contact,
+        'inter_contact_pair': inter_contact_pair,
+        'delay_histogram': delay_histogram,
+        'mean_delay': mean_delay,
+        'mean_hops': mean_hops,
+        'reach_count': reach_count,
+        'sources_within': sources_within,
+    }
+
+
+def get_analysis_path(trace_path):
+    return trace_path[:-len('.npz')] + ANALYSIS_SUFFIX
+
+
+def load_or_analyze_trace(trace_path):
+    # the statistics of a stored trace, computed once and kept next to it
+    path = get_analysis_path(trace_path)
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+    trace, _ = load_trace(trace_path, restore_rng=False)
+    analysis = analyze_trace(trace)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, **analysis)
+    os.replace(tmp_path, path)
+    return analysis
+
+
+def summarize(analysis, max_rounds = 10):
+    # human readable summary, the reach and cache figures for kick_out = 1..max_rounds
+    lines = ['{} cars, {} rounds of {} s'.format(int(analysis['num_car']), int(analysis['num_round']),
+                                                 int(analysis['epoch_time']))]
+    lines.append('meetings per car and round: mean {:.2f}, min {:.2f}, max {:.2f}'.format(
+        analysis['meetings'].mean(), analysis['meetings'].min(), analysis['meetings'].max()))
+    lines.append('distinct cars met: mean {:.1f}'.format(analysis['partners'].mean()))
+    if len(analysis['inter_contact']) > 0:
+        quantiles = np.percentile(analysis['inter_contact'], [10, 50, 90])
+        lines.append('inter-contact time (s): p10 {:.0f}, median {:.0f}, p90 {:.0f}'.format(*quantiles))
+    histogram = analysis['delay_histogram']
+    num_round = int(analysis['num_round'])
+    for k in range(min(max_rounds, num_round)):
+        # pairs of the rounds with k rounds left, so that late rounds do not count as unreachable
+        rounds = histogram[:num_round - k]
+        reached = rounds[:, :k + 1].sum() / max(rounds.sum(), 1)
+        lines.append('kick_out {}: {:.1%} of the models reach each other car, {:.1f} fresh models per car'.format(
+            k + 1, reached, analysis['sources_within'][k]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Contact-graph statistics of stored mobility traces")
+    parser.add_argument("traces", nargs='+', type=str, help="Trace files of the trace store (trace_<key>.npz)")
+    parser.add_argument("--max_rounds", type=int, default=10, help="Largest kick_out in the summary")
+    args = parser.parse_args()
+    for trace_path in args.traces:
+        if trace_path.endswith(ANALYSIS_SUFFIX):
+            continue
+        analysis = load_or_analyze_trace(trace_path)
+        print(trace_path + ' -> ' + get_analysis_path(trace_path))
+        print(summarize(analysis, args.max_rounds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Mobility traces from recorded GPS logs instead of the simulated fleet.
+
+A log is a csv or parquet file with one row per position fix (car id, timestamp,
+latitude, longitude), sorted by timestamp. It is read in chunks, so only the fixes
+around the round being built are in memory. Each fix is map-matched to the nearest node
+of the road network, whose area is the area of the car. The position of a car at
+every second is linearly interpolated between its fixes, a car without fixes within
+max_gap seconds on both sides is off the road. The rounds are ContactTraces with the same
+meeting rules as iter_roadNet_rounds.
+"""
+import hashlib
+import os
+import random
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+import road_network
+from road_sim import (
+    ContactTrace, MeetingRecord, TraceStream, get_pairs_in_range, get_round_trace, load_roadNet,
+    record_meetings, Random_SEED
+)
+
+GPS_COLUMNS = ('car_id', 'timestamp', 'lat', 'long')
+
+
+def read_gps_chunks(file_path, columns = GPS_COLUMNS, chunksize = 1000000):
+    # DataFrames of at most chunksize fixes, with the columns renamed to GPS_COLUMNS
+    columns = list(columns)
+    rename = dict(zip(columns, GPS_COLUMNS))
+    if str(file_path).endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Reading parquet GPS logs requires pyarrow')
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas().rename(columns=rename)
+    else:
+        for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunksize):
+            yield chunk.rename(columns=rename)
+
+
+def get_gps_signature(file_path):
+    # identifies the log in the trace store, a changed log gets a new key
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    signature = '|'.join([file_path, str(stat.st_size), str(stat.st_mtime_ns)])
+    return hashlib.sha1(signature.encode()).hexdigest()
+
+
+def get_seconds(timestamp):
+    # unix seconds of numeric or datetime-like timestamps
+    if pd.api.types.is_numeric_dtype(timestamp):
+        return timestamp.to_numpy(dtype=float)
+    return pd.to_datetime(timestamp).to_numpy(dtype='datetime64[ns]').astype(np.int64) / 1e9
+
+
+def get_gps_cars(file_path, num_car, columns = GPS_COLUMNS, chunksize = 1000000):
+    """
+    The first num_car car ids of the log, in order of appearance, and its first timestamp.
+    """
+    car_ids = {}
+    start_time = None
+    for chunk in read_gps_chunks(file_path, columns, chunksize):
+        if start_time is None and len(chunk) > 0:
+            start_time = get_seconds(chunk['timestamp']).min()
+        for car_id in pd.unique(chunk['car_id']):
+            if len(car_ids) == num_car:
+                return list(car_ids), start_time
+            car_ids.setdefault(car_id, len(car_ids))
+    return list(car_ids), start_time
+
+
+def interpolate_positions(car, time, position, area, num_car, seconds, max_gap):
+    """
+    Positions (num_car x len(seconds) x 2) of the cars at the given seconds from their
+    fixes, NaN where a car is off the road, and the area of its last fix (-1 if none).
+    Only the fixes within max_gap of the seconds are used, the others cannot be
+    interpolated from and would overflow the (car, time) search keys.
+    """
+    near = (time >= seconds[0] - max_gap) & (time <= seconds[-1] + max_gap)
+    car, time, position, area = car[near], time[near], position[near], area[near]
+    if len(car) == 0:
+        return np.full((num_car, len(seconds), 2), np.nan), np.full((num_car, len(seconds)), -1)
+    span = seconds[-1] - seconds[0] + 2 * max_gap + 2
+    base = seconds[0] - max_gap - 1
+    order = np.lexsort((time, car))
+    car, time, position, area = car[order], time[order], position[order], area[order]
+    key = car * span + (time - base)
+    query = (np.arange(num_car)[:, np.newaxis] * span + (seconds - base)[np.newaxis, :]).ravel()
+    car_query = np.repeat(np.arange(num_car), len(seconds))
+    second_query = np.tile(seconds, num_car).astype(float)
+    after = np.searchsorted(key, query, side='right') # first fix later than the second
+    before = after - 1 # last fix at or before the second
+    has_before = before >= 0
+    has_before[has_before] = car[before[has_before]] == car_query[has_before]
+    has_after = after < len(key)
+    has_after[has_after] = car[after[has_after]] == car_query[has_after]
+    before = np.where(has_before, before, 0)
+    after = np.where(has_after, after, 0)
+    has_before &= second_query - time[before] <= max_gap
+    has_after &= time[after] - second_query <= max_gap
+    exact = has_before & (time[before] == second_query)
+    between = has_before & has_after & ~exact
+    result = np.full((len(query), 2), np.nan)
+    result[exact] = position[before[exact]]
+    weight = (second_query[between] - time[before[between]]) / (time[after[between]] - time[before[between]])
+    result[between] = position[before[between]] + (position[after[between]] - position[before[between]]) * weight[:, np.newaxis]
+    last_area = np.where(has_before, area[before], -1)
+    return result.reshape(num_car, len(seconds), 2), last_area.reshape(num_car, len(seconds))
+
+
+def iter_gps_rounds(exp_dir, file_path, num_car, num_round, circle_radius = 100, step_time = 60, County = 'New York',
+                    num_area = 10, contact_backend = 'grid', columns = GPS_COLUMNS, start_time = None, max_gap = 120,
+                    max_snap_distance = None, chunksize = 1000000, py_rng = random, area_method = 'kmeans'):
+    """
+    Build the rounds of a GPS log like iter_roadNet_rounds, yielding a one-round
+    ContactTrace after every step_time seconds from start_time (the first fix by default).
+    Cars are the first num_car car ids of the log. Fixes farther than max_snap_distance
+    (in the unit of circle_radius) from every road node are dropped as off the map.
+    """
+    circle_radius = circle_radius * 0.00145/100
+    pos_array, adj_matrix = load_roadNet(exp_dir, County)
+    area_labels = road_network.road_registry.get(County).get_area_labels(num_area, Random_SEED, area_method)
+    tree = cKDTree(pos_array)
+    car_ids, first_time = get_gps_cars(file_path, num_car, columns, chunksize)
+    car_index = {car_id: index for index, car_id in enumerate(car_ids)}
+    if start_time is None:
+        start_time = 0 if first_time is None else first_time
+    # cars off the road are parked far apart, so that they leave every meeting record
+    off_road = np.stack([1e6 + 1e3 * np.arange(num_car), np.full(num_car, 1e6)], axis=1)
+    current_area = np.zeros(num_car, dtype=area_labels.dtype)
+
+    buffer = [np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, 2)), np.zeros(0, dtype=area_labels.dtype)]
+    chunks = read_gps_chunks(file_path, columns, chunksize)
+    end_of_log = False
+    latest = -np.inf # latest fix read so far
+    emitted = 0 # first second not yet emitted
+    for round_index in range(num_round):
+        round_end = (round_index + 1) * step_time
+        # read until every fix that can matter for this round is buffered
+        while not end_of_log and latest < round_end + max_gap:
+            chunk = next(chunks, None)
+            if chunk is None:
+                end_of_log = True
+                break
+            car = chunk['car_id'].map(car_index).to_numpy(dtype=float)
+            time = get_seconds(chunk['timestamp']) - start_time
+            position = chunk[['long', 'lat']].to_numpy(dtype=float)
+            if len(time) > 0:
+                latest = max(latest, time.max())
+            keep = ~np.isnan(car) & (time < num_round * step_time + max_gap)
+            if np.any(time[keep] < emitted - max_gap):
+                raise ValueError('The GPS log ' + str(file_path) + ' is not sorted by timestamp')
+            distance, node = tree.query(position[keep])
+            snapped = np.ones(len(node), dtype=bool) if max_snap_distance is None else distance <= max_snap_distance * 0.00145/100
+            buffer = [np.concatenate([buffer[0], car[keep][snapped].astype(np.int64)]),
+                      np.concatenate([buffer[1], time[keep][snapped]]),
+                      np.concatenate([buffer[2], position[keep][snapped]]),
+                      np.concatenate([buffer[3], area_labels[node[snapped]]])]
+        seconds = np.arange(round_index * step_time, round_end)
+        positions, last_area = interpolate_positions(buffer[0], buffer[1], buffer[2], buffer[3], num_car, seconds, max_gap)
+
+        meeting_record = MeetingRecord(num_car)
+        pair_list = []
+        area_record = np.zeros([step_time, num_car], dtype=area_labels.dtype)
+        for j in range(step_time):
+            current_area = np.where(last_area[:, j] >= 0, last_area[:, j], current_area)
+            area_record[j] = current_area
+            car_position = positions[:, j]
+            active = np.nonzero(~np.isnan(car_position[:, 0]))[0]
+            if len(active) > 1:
+                i, k = get_pairs_in_range(car_position[active], circle_radius, contact_backend)
+            else:
+                i = k = np.zeros(0, dtype=np.int64)
+            car_position = np.where(np.isnan(car_position), off_road, car_position)
+            pair_list.append(record_meetings(car_position, active[i], active[k], meeting_record, circle_radius, j, py_rng))
+        yield get_round_trace(pair_list, area_record, meeting_record, num_car, step_time)
+        # fixes older than max_gap before the next round are not needed anymore
+        emitted = round_end
+        keep = buffer[1] >= emitted - max_gap
+        buffer = [column[keep] for column in buffer]
+
+
+def import_gps_pair_area_list(exp_dir, file_path, num_car, num_round, circle_radius = 100, step_time = 60,
+                              County = 'New York', num_area = 10, contact_backend = 'grid', **kwargs):
+    # same outputs as generate_roadNet_pair_area_list, from a GPS log
+    trace = ContactTrace.concatenate(list(iter_gps_rounds(exp_dir, file_path, num_car, num_round, circle_radius, step_time,
+                                                          County, num_area, contact_backend, **kwargs)))
+    return trace, trace.area
+
+
+def stream_gps_pair_area_list(exp_dir, file_path, num_car, num_round, circle_radius = 100, step_time = 60,
+                              County = 'New York', num_area = 10, contact_backend = 'grid', prefetch = 0, **kwargs):
+    # same outputs as stream_roadNet_pair_area_list, from a GPS log
+    py_rng = random.Random()
+    py_rng.setstate(random.getstate())
+    rounds = iter_gps_rounds(exp_dir, file_path, num_car, num_round, circle_radius, step_time, County, num_area,
+                             contact_backend, py_rng=py_rng, **kwargs)
+    trace = TraceStream(rounds, num_car, num_round, step_time, np.uint8 if num_area <= 256 else np.int32, prefetch,
+                        py_rng=py_rng)
+    return trace, trace.area
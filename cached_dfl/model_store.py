@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Model versions shared by the caches of all cars.
+
+A version is the model of car car_id as it was sent in round round_index, stored once
+under (car_id, round_index). Cache entries ({'model': version, 'time': round_index}
+under key car_id) reference the version instead of holding a copy, so a meeting merges
+cache metadata and copies no tensors. Versions are read-only: training and aggregation
+write to the cars' own models only.
+
+snapshot_round stores the versions of a round as ModelSnapshots instead of
+deepcopy(model) of the whole nn.Modules: every parameter and buffer of a car copied once
+into a single flat vector, with a ModelLayout shared by all models of the architecture
+to tell the tensors apart. cache_average_process averages the vectors directly, and
+state_dict() gives the tensors back for the code that wants a model.
+
+The store holds weak references, so a version is reference-counted by the cache entries
+(and the model_before_training list of its round) and freed when the last one drops it.
+Caches that hold keys instead of models (cache_table.CacheTable) pin the versions they
+refer to in the store and unpin them when no cache refers to them anymore.
+"""
+import collections
+import weakref
+
+import torch
+
+
+class ModelLayout:
+    """
+    Names, dtypes, shapes and offsets of the tensors of a state dict in a flat vector.
+    The vector has the floating dtype of the parameters, other buffers (e.g. the int64
+    num_batches_tracked of BatchNorm) are cast to it and back.
+    """
+    def __init__(self, state_dict):
+        self.names = list(state_dict)
+        self.dtypes = [tensor.dtype for tensor in state_dict.values()]
+        self.shapes = [tensor.shape for tensor in state_dict.values()]
+        self.dtype = next((dtype for dtype in self.dtypes if dtype.is_floating_point), torch.get_default_dtype())
+        sizes = [tensor.numel() for tensor in state_dict.values()]
+        self.offsets = [sum(sizes[:k]) for k in range(len(sizes) + 1)]
+
+    @property
+    def size(self):
+        return self.offsets[-1]
+
+    def get_key(self):
+        return tuple(self.names), tuple(self.dtypes), tuple(tuple(shape) for shape in self.shapes)
+
+    def __eq__(self, other):
+        return isinstance(other, ModelLayout) and (self is other or self.get_key() == other.get_key())
+
+    def __hash__(self):
+        return hash(self.get_key())
+
+    def flatten(self, state_dict):
+        # one vector of the tensors of state_dict, in the order of the layout
+        with torch.no_grad():
+            return torch.cat([state_dict[name].reshape(-1).to(self.dtype) for name in self.names])
+
+    def unflatten(self, vector):
+        # state dict of the vector, views into it for the tensors of the vector dtype
+        state = collections.OrderedDict()
+        for k, name in enumerate(self.names):
+            tensor = vector[self.offsets[k]:self.offsets[k + 1]].view(self.shapes[k])
+            state[name] = tensor if self.dtypes[k] == self.dtype else tensor.to(self.dtypes[k])
+        return state
+
+
+class ModelSnapshot:
+    """
+    Read-only copy of a model as a flat vector on the device of the model, with the
+    layout of its architecture.
+    """
+    def __init__(self, model, layout = None):
+        state = model.state_dict()
+        self.layout = ModelLayout(state) if layout is None else layout
+        self.vector = self.layout.flatten(state)
+
+    @property
+    def nbytes(self):
+        return self.vector.numel() * self.vector.element_size()
+
+    def state_dict(self):
+        # views into the vector, not to be written to
+        return self.layout.unflatten(self.vector)
+
+    def load_into(self, model):
+        model.load_state_dict(self.state_dict())
+        return model
+
+
+def snapshot_models(models, layout = None):
+    # one snapshot per model, all with the same layout (the one of the first model by default)
+    if not models:
+        return []
+    state = models[0].state_dict()
+    if layout is None or layout != ModelLayout(state):
+        layout = ModelLayout(state)
+    return [ModelSnapshot(model, layout) for model in models]
+
+
+def get_cache_layout(cache):
+    # the layout shared by every model of a cache, None if one of them is not a ModelSnapshot
+    layout = None
+    for value in cache.values():
+        model = value['model']
+        if not isinstance(model, ModelSnapshot) or (layout is not None and model.layout != layout):
+            return None
+        layout = model.layout
+    return layout
+
+
+class ModelStore:
+    def __init__(self):
+        self.versions = weakref.WeakValueDictionary()
+        self.pinned = {}
+        self.layout = None
+
+    def add(self, car_id, round_index, model):
+        # register model as the version of car_id in round_index and return it
+        self.versions[(car_id, round_index)] = model
+        return model
+
+    def add_round(self, round_index, models):
+        # the models of every car at the end of round_index, e.g. model_before_training
+        for car_id, model in enumerate(models):
+            self.add(car_id, round_index, model)
+        return models
+
+    def snapshot_round(self, round_index, models):
+        # snapshots of the models of every car, stored as their versions of round_index
+        snapshots = snapshot_models(models, self.layout)
+        if snapshots:
+            self.layout = snapshots[0].layout
+        return self.add_round(round_index, snapshots)
+
+    def get(self, car_id, round_index):
+        return self.versions.get((car_id, round_index))
+
+    def pin(self, car_id, round_index):
+        # keep the version alive while a cache refers to it by its key
+        self.pinned[(car_id, round_index)] = self.versions[(car_id, round_index)]
+
+    def unpin_except(self, keys):
+        # drop the pins of the versions whose key is not in keys
+        for key in [key for key in self.pinned if key not in keys]:
+            del self.pinned[key]
+
+    def __contains__(self, version):
+        return version in self.versions
+
+    def __len__(self):
+        return len(self.versions)
+
+    def get_memory(self):
+        # bytes of the parameters and buffers of the versions still referenced
+        memory = 0
+        for model in list(self.versions.values()):
+            if isinstance(model, ModelSnapshot):
+                memory += model.nbytes
+            else:
+                memory += sum(tensor.numel() * tensor.element_size() for tensor in model.state_dict().values())
+        return memory
+
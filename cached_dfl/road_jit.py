@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled kernels of the road simulation, on flat arrays.
+
+advance_fleet/turn_fleet are Fleet.move and get_pairs_grid_kernel is get_pairs_grid as
+explicit loops, compiled with Numba's @njit when it is installed. They do the same
+floating point operations in the same order as the NumPy code and take the random
+numbers drawn by the caller, so the traces are identical with or without JIT.
+set_jit(True) switches the simulation to the kernels; without Numba it keeps NumPy.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        # without Numba the kernels stay plain Python functions
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+JIT_ENABLED = False
+
+
+def set_jit(enabled):
+    global JIT_ENABLED
+    if enabled and not NUMBA_AVAILABLE:
+        print('Numba is not installed, the road simulation keeps the NumPy implementation')
+        enabled = False
+    JIT_ENABLED = enabled
+    return JIT_ENABLED
+
+
+@njit(cache=True)
+def advance_fleet(current_position, destination, speed_vector, pos_array, speed, time):
+    """
+    Move the cars that stay on their road, in place. Returns the cars that reach the end
+    of their road and the time left after it. speed holds the speed of every car.
+    """
+    num_car = len(destination)
+    arrived = np.zeros(num_car, dtype=np.bool_)
+    remaining = np.zeros(num_car)
+    for car in range(num_car):
+        dx = pos_array[destination[car], 0] - current_position[car, 0]
+        dy = pos_array[destination[car], 1] - current_position[car, 1]
+        remaining[car] = np.sqrt(dx*dx + dy*dy)
+        if remaining[car] < speed[car] * time:
+            arrived[car] = True
+        else:
+            current_position[car, 0] += speed_vector[car, 0] * time
+            current_position[car, 1] += speed_vector[car, 1] * time
+    index = np.nonzero(arrived)[0]
+    residual_time = np.empty(len(index))
+    for k in range(len(index)):
+        residual_time[k] = time - remaining[index[k]] / speed[index[k]]
+    return index, residual_time
+
+
+@njit(cache=True)
+def get_turn_count(previous_source, source, use_area, edge_key, count, area_edge_key, area_count, num_nodes):
+    # number of next-road candidates of every arriving car, from its TurnTable
+    counts = np.empty(len(source), dtype=np.int64)
+    for k in range(len(source)):
+        key = previous_source[k] * num_nodes + source[k]
+        if use_area[k]:
+            counts[k] = area_count[np.searchsorted(area_edge_key, key)]
+        else:
+            counts[k] = count[np.searchsorted(edge_key, key)]
+    return counts
+
+
+@njit(cache=True)
+def turn_fleet(index, previous_source, residual_time, uniform, use_area, source, destination, current_position,
+               speed_vector, pos_array, speed, edge_key, offsets, count, candidates, cdf,
+               area_edge_key, area_offsets, area_count, area_candidates, area_cdf, num_nodes):
+    """
+    Put the arriving cars on their next road (TurnTable.sample with the given uniform
+    numbers) and move them for their residual time, in place.
+    """
+    for k in range(len(index)):
+        car = index[k]
+        key = previous_source[k] * num_nodes + source[car]
+        if use_area[k]:
+            edge = np.searchsorted(area_edge_key, key)
+            start, number, table_candidates, table_cdf = area_offsets[edge], area_count[edge], area_candidates, area_cdf
+        else:
+            edge = np.searchsorted(edge_key, key)
+            start, number, table_candidates, table_cdf = offsets[edge], count[edge], candidates, cdf
+        choice = 0
+        for c in range(number - 1):
+            if table_cdf[start + c] <= uniform[k]:
+                choice += 1
+        destination[car] = table_candidates[start + choice]
+        vx = pos_array[destination[car], 0] - pos_array[source[car], 0]
+        vy = pos_array[destination[car], 1] - pos_array[source[car], 1]
+        norm = np.sqrt(vx*vx + vy*vy)
+        if norm != 0:
+            vx = vx / norm * speed[car]
+            vy = vy / norm * speed[car]
+        else:
+            vx = 0.0
+            vy = 0.0
+        speed_vector[car, 0] = vx
+        speed_vector[car, 1] = vy
+        current_position[car, 0] = pos_array[source[car], 0] + vx * residual_time[k]
+        current_position[car, 1] = pos_array[source[car], 1] + vy * residual_time[k]
+
+
+@njit(cache=True)
+def scan_neighbor_cells(i, car_position, key, order, sorted_key, width, circle_radius, j_out, out_start):
+    # number of cars j > i in range of car i in the 3x3 cells around it, written from j_out[out_start] if j_out is not empty
+    found = 0
+    for dx in range(-1, 2):
+        for dy in range(-1, 2):
+            neighbor_key = key[i] + dx * width + dy
+            start = np.searchsorted(sorted_key, neighbor_key)
+            while start < len(sorted_key) and sorted_key[start] == neighbor_key:
+                j = order[start]
+                start += 1
+                if j <= i:
+                    continue
+                x = car_position[i, 0] - car_position[j, 0]
+                y = car_position[i, 1] - car_position[j, 1]
+                if np.sqrt(x*x + y*y) < circle_radius:
+                    if len(j_out) > 0:
+                        j_out[out_start + found] = j
+                    found += 1
+    return found
+
+
+@njit(cache=True)
+def get_pairs_grid_kernel(car_position, cell, circle_radius):
+    """
+    Pairs (i, j), i < j, closer than circle_radius, sorted by (i, j): every car looks at
+    the cars of its own and the 8 adjacent cells of the grid (cell is its (x, y) cell).
+    """
+    num_car = len(car_position)
+    width = 0
+    for car in range(num_car):
+        width = max(width, cell[car, 1])
+    width += 3 # keeps the y-1/y+1 neighbours of the border columns from wrapping into another row
+    key = cell[:, 0] * width + cell[:, 1]
+    order = np.argsort(key, kind='mergesort')
+    sorted_key = key[order]
+    # the first pass counts the pairs of every car, the second one writes them
+    no_output = np.empty(0, dtype=np.int64)
+    pair_offsets = np.zeros(num_car + 1, dtype=np.int64)
+    for i in range(num_car):
+        pair_offsets[i + 1] = pair_offsets[i] + scan_neighbor_cells(i, car_position, key, order, sorted_key, width,
+                                                                    circle_radius, no_output, 0)
+    i_out = np.empty(pair_offsets[-1], dtype=np.int64)
+    j_out = np.empty(pair_offsets[-1], dtype=np.int64)
+    for i in range(num_car):
+        start, stop = pair_offsets[i], pair_offsets[i + 1]
+        if stop > start:
+            scan_neighbor_cells(i, car_position, key, order, sorted_key, width, circle_radius, j_out, start)
+            j_out[start:stop].sort()
+            i_out[start:stop] = i
+    return i_out, j_out
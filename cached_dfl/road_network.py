@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Road networks of the mobility simulation.
+
+Any csv with the StartLat/StartLong/EndLat/EndLong/Miles/County columns can be registered.
+Every county is preprocessed once into cache_dir (node positions and CSR adjacency of its
+largest strongly connected component), and so are its area labels and centers for every
+(method, num_area, seed), so later simulations read neither the csv nor re-cluster.
+The areas come from KMeans by default, MiniBatchKMeans or a balanced grid partition are
+faster alternatives for very large graphs.
+"""
+import hashlib
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'NY_Data')
+ROAD_COLUMNS = ['StartLat', 'StartLong', 'EndLat', 'EndLong', 'Miles', 'County']
+AREA_METHODS = ['kmeans', 'minibatch', 'grid']
+
+
+def build_roadNet(gdf):
+    """
+    Build the largest strongly connected road network from the roads in gdf.
+    Returns pos_array (num_nodes x 2, longitude/latitude) and the binary adjacency matrix
+    as a scipy.sparse CSR matrix. Nodes keep the order in which they first appear in
+    the csv (start before end), which is also the node order of the former networkx graph.
+    """
+    # every road is added in both directions, a node is a unique (lat, long) point
+    points = gdf[['StartLat', 'StartLong', 'EndLat', 'EndLong']].to_numpy(dtype=float).reshape(-1, 2)
+    nodes, first_index, node_id = np.unique(points, axis=0, return_index=True, return_inverse=True)
+    insertion_order = np.argsort(first_index, kind='stable')
+    rank = np.empty(len(nodes), dtype=np.int64)
+    rank[insertion_order] = np.arange(len(nodes))
+    node_id = rank[node_id.reshape(-1)]
+    nodes = nodes[insertion_order]
+    start_node = node_id[0::2]
+    end_node = node_id[1::2]
+    row = np.concatenate([start_node, end_node])
+    col = np.concatenate([end_node, start_node])
+    G = sparse.csr_matrix((np.ones(len(row), dtype=np.int8), (row, col)), shape=(len(nodes), len(nodes)))
+    G.data[:] = 1 # duplicated roads are a single edge
+
+    num_scc, scc_labels = csgraph.connected_components(G, directed=True, connection='strong')
+    largest_scc = np.nonzero(scc_labels == np.argmax(np.bincount(scc_labels)))[0]
+    adj_matrix = G[largest_scc][:, largest_scc].tocsr()
+    adj_matrix.sort_indices() # neighbours in ascending node order
+    pos_array = nodes[largest_scc][:, ::-1].copy() # Create a position map with longitude, latitude
+    return pos_array, adj_matrix
+
+
+def partition_grid(pos_array, num_area):
+    """
+    Split the nodes into num_area = columns x rows areas of (almost) equal node counts:
+    columns by longitude, then rows by latitude inside each column. The factorization of
+    num_area is the one closest to the aspect ratio of the map.
+    """
+    num_nodes = len(pos_array)
+    extent = np.ptp(pos_array, axis=0)
+    aspect = extent[0] / extent[1] if extent[1] > 0 else np.inf
+    factors = [c for c in range(1, num_area + 1) if num_area % c == 0]
+    num_column = min(factors, key=lambda c: abs(np.log(c * c / num_area) - np.log(max(aspect, 1e-12))))
+    num_row = num_area // num_column
+    rank = np.empty(num_nodes, dtype=np.int64)
+    order = np.argsort(pos_array[:, 0], kind='stable')
+    rank[order] = np.arange(num_nodes)
+    column = rank * num_column // num_nodes
+    labels = np.empty(num_nodes, dtype=np.int32)
+    for c in range(num_column):
+        members = np.nonzero(column == c)[0]
+        order = members[np.argsort(pos_array[members, 1], kind='stable')]
+        labels[order] = c * num_row + np.arange(len(order)) * num_row // len(order)
+    return labels
+
+
+def cluster_areas(pos_array, num_area, seed, method='kmeans'):
+    # area label of every node and the area centers
+    if method == 'kmeans':
+        kmeans = KMeans(n_clusters=num_area, random_state=seed)
+    elif method == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=num_area, random_state=seed, batch_size=4096, n_init=3)
+    elif method == 'grid':
+        labels = partition_grid(pos_array, num_area)
+        centers = np.stack([pos_array[labels == area].mean(axis=0) for area in range(num_area)])
+        return labels, centers
+    else:
+        raise ValueError('Unknown area method ' + str(method) + ', choose from ' + str(AREA_METHODS))
+    kmeans.fit(pos_array)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+
+class RoadNetwork:
+    def __init__(self, County, pos_array, adj_matrix, cache_prefix=None):
+        self.County = County
+        self.pos_array = pos_array
+        self.adj_matrix = adj_matrix
+        self.cache_prefix = cache_prefix
+        self.areas = {}
+
+    @property
+    def num_nodes(self):
+        return self.adj_matrix.shape[0]
+
+    @property
+    def num_edges(self):
+        return self.adj_matrix.nnz
+
+    def save(self):
+        np.savez(self.cache_prefix + '.npz', pos_array=self.pos_array, indptr=self.adj_matrix.indptr,
+                 indices=self.adj_matrix.indices, data=self.adj_matrix.data)
+
+    @classmethod
+    def load(cls, County, cache_prefix):
+        with np.load(cache_prefix + '.npz') as data:
+            num_nodes = len(data['pos_array'])
+            adj_matrix = sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=(num_nodes, num_nodes))
+            return cls(County, data['pos_array'], adj_matrix, cache_prefix)
+
+    def get_areas(self, num_area, seed, method='kmeans'):
+        """
+        Cluster the nodes into num_area areas, once per (method, num_area, seed).
+        Returns the area label of every node and the area centers (num_area x 2).
+        """
+        key = (method, num_area, seed)
+        if key in self.areas:
+            return self.areas[key]
+        path = None
+        if self.cache_prefix is not None:
+            path = self.cache_prefix + '_area_' + method + '_' + str(num_area) + '_' + str(seed) + '.npz'
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                areas = data['labels'], data['centers']
+        else:
+            areas = cluster_areas(self.pos_array, num_area, seed, method)
+            if path is not None:
+                np.savez(path, labels=areas[0], centers=areas[1])
+        self.areas[key] = areas
+        return areas
+
+    def get_area_labels(self, num_area, seed, method='kmeans'):
+        return self.get_areas(num_area, seed, method)[0]
+
+    def get_area_centers(self, num_area, seed, method='kmeans'):
+        return self.get_areas(num_area, seed, method)[1]
+
+
+class RoadNetworkRegistry:
+    """
+    Counties of the registered road csv files. get(County) parses the csv only the first
+    time a county is requested; after that the preprocessed graph is loaded from cache_dir.
+    """
+    def __init__(self, csv_files=(), cache_dir='./road_cache'):
+        self.csv_files = []
+        self.cache_dir = cache_dir
+        self.networks = {}
+        for file_path in csv_files:
+            self.add_csv(file_path)
+
+    def add_csv(self, file_path):
+        file_path = os.path.abspath(file_path)
+        columns = pd.read_csv(file_path, nrows=0).columns
+        missing = [column for column in ROAD_COLUMNS if column not in columns]
+        if missing:
+            raise ValueError(file_path + ' is missing the road columns ' + str(missing))
+        if file_path not in self.csv_files:
+            self.csv_files.append(file_path)
+
+    def counties(self):
+        counties = set()
+        for file_path in self.csv_files:
+            counties.update(pd.read_csv(file_path, usecols=['County'])['County'].unique())
+        return sorted(counties)
+
+    def get_cache_prefix(self, file_path, County):
+        # a changed csv gets a new cache entry
+        stat = os.stat(file_path)
+        signature = '|'.join([file_path, str(stat.st_size), str(stat.st_mtime_ns), County])
+        name = re.sub(r'[^0-9A-Za-z]+', '_', County) + '_' + hashlib.sha1(signature.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, County):
+        if County in self.networks:
+            return self.networks[County]
+        for file_path in self.csv_files:
+            cache_prefix = self.get_cache_prefix(file_path, County)
+            if os.path.exists(cache_prefix + '.npz'):
+                self.networks[County] = RoadNetwork.load(County, cache_prefix)
+                return self.networks[County]
+        for file_path in self.csv_files:
+            data = pd.read_csv(file_path, usecols=ROAD_COLUMNS)
+            gdf = data[data['County']== County ]
+            if len(gdf) == 0:
+                continue
+            pos_array, adj_matrix = build_roadNet(gdf)
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            road_network = RoadNetwork(County, pos_array, adj_matrix, self.get_cache_prefix(file_path, County))
+            road_network.save()
+            self.networks[County] = road_network
+            return road_network
+        raise ValueError('County ' + str(County) + ' is not in the registered road data ' + str(self.csv_files))
+
+
+# the simulation looks counties up here; register more csv files with road_registry.add_csv
+road_registry = RoadNetworkRegistry([os.path.join(DATA_DIR, 'NewYork.csv')])
@@ -7,13 +7,17 @@ Created on Fri Mar 29 17:46:43 2024
 
 import pandas as pd
 # import matplotlib.animation as animation
-import networkx as nx
 import numpy as np
 import copy
 import random
+import queue
+import threading
+from scipy.spatial import cKDTree
 from sklearn.cluster import KMeans
 
 import seed_setter
+import road_jit
+import road_network
 
 # Call the set_seed function at the start
 Random_SEED  = seed_setter.set_seed()
@@ -73,6 +77,343 @@ class Car:
         else:
             self.current_position = self.current_position +  self.speed_vector*time
 
+
+class TurnTable:
+    """
+    Next-road distribution of every directed edge (previous_node -> node) of a CSR road graph,
+    i.e. what get_next_destination/get_road_choice_probability compute at each intersection:
+    no U-turn unless it is a dead end, 0.5 for the road best aligned with the incoming one and
+    the rest shared equally. Edge e is the e-th stored entry of the CSR matrix; its candidates
+    are candidates[offsets[e]:offsets[e+1]] (ascending node order) with cumulative
+    probabilities cdf[offsets[e]:offsets[e+1]], normalized like np.random.choice does.
+    """
+    def __init__(self, adj_matrix, pos_array):
+        num_nodes = adj_matrix.shape[0]
+        degree = np.diff(adj_matrix.indptr)
+        edge_source = np.repeat(np.arange(num_nodes), degree)
+        edge_target = adj_matrix.indices.astype(np.int64)
+        num_edge = len(edge_target)
+        self.num_nodes = num_nodes
+        self.edge_key = edge_source * num_nodes + edge_target # sorted, CSR rows are sorted
+
+        # all neighbours of the node each edge leads to
+        num_next = degree[edge_target]
+        edge = np.repeat(np.arange(num_edge), num_next)
+        offset = np.arange(num_next.sum()) - np.repeat(np.cumsum(num_next) - num_next, num_next)
+        candidate = adj_matrix.indices[np.repeat(adj_matrix.indptr[edge_target], num_next) + offset].astype(np.int64)
+        # to make sure car dont reverse, unless there is only one road to take
+        multi = num_next > 1
+        keep = multi[edge] & (candidate != edge_source[edge])
+        dead_end = np.nonzero(~multi)[0]
+        edge = np.concatenate([edge[keep], dead_end])
+        candidate = np.concatenate([candidate[keep], edge_source[dead_end]])
+        order = np.argsort(edge, kind='stable')
+        edge = edge[order]
+        candidate = candidate[order]
+        count = np.bincount(edge, minlength=num_edge)
+        offsets = np.zeros(num_edge + 1, dtype=np.int64)
+        np.cumsum(count, out=offsets[1:])
+
+        # cosine between the incoming road and every candidate road
+        incoming = pos_array[edge_target[edge]] - pos_array[edge_source[edge]]
+        outgoing = pos_array[candidate] - pos_array[edge_target[edge]]
+        norm = np.sqrt(np.sum(incoming**2, axis=1)) * np.sqrt(np.sum(outgoing**2, axis=1))
+        direction = np.zeros(len(edge))
+        np.divide(np.sum(incoming*outgoing, axis=1), norm, out=direction, where=norm != 0)
+        best = direction == np.repeat(np.maximum.reduceat(direction, offsets[:-1]), count)
+
+        # probabilities and their cdf, edges grouped by number of candidates
+        cdf = np.ones(len(edge))
+        for n in np.unique(count[count > 1]):
+            rows = np.nonzero(count == n)[0]
+            index = offsets[rows][:, np.newaxis] + np.arange(n)
+            probabilities = np.ones(index.shape) * (0.5 / (n - 1))
+            probabilities[best[index]] = 0.5
+            probabilities = probabilities.cumsum(axis=1)
+            probabilities /= probabilities[:, -1:]
+            cdf[index] = probabilities
+        self.offsets = offsets
+        self.count = count
+        self.candidates = candidate
+        self.cdf = cdf
+        self.max_count = count.max() if num_edge > 0 else 0
+
+    def get_edge(self, previous_node, node):
+        return np.searchsorted(self.edge_key, np.asarray(previous_node, dtype=np.int64) * self.num_nodes + node)
+
+    def sample(self, previous_node, node, uniform):
+        """
+        Next node of cars that arrive at `node` coming from `previous_node`. `uniform` holds one
+        U[0, 1) number per car and is only used where there is more than one candidate;
+        picking the first cdf entry above it is exactly what np.random.choice does with p.
+        """
+        edge = self.get_edge(previous_node, node)
+        start = self.offsets[edge]
+        count = self.count[edge]
+        choice = np.zeros(len(edge), dtype=np.int64)
+        for k in range(self.max_count - 1):
+            valid = k < count - 1
+            choice += valid & (self.cdf[np.minimum(start + k, len(self.cdf) - 1)] <= uniform)
+        return self.candidates[start + choice]
+
+    def get_count(self, previous_node, node):
+        return self.count[self.get_edge(previous_node, node)]
+
+
+class Fleet:
+    """
+    Struct-of-arrays version of a list of Car objects.
+    source/destination/current_position/speed_vector of every car live in contiguous
+    arrays and the whole fleet is advanced by one batched move(); the cars that reach the
+    end of their road in this step pick their next road from precomputed TurnTables,
+    drawing their random numbers in car index order, so the random stream (and thus the
+    trajectories) match the per-object Car.move loop. speed is one speed for the whole
+    fleet or one per car.
+    """
+    def __init__(self, source, destination, speed, pos_list, adj_matrix, adj_matrix_area=None, car_type=None, np_rng=np.random):
+        self.pos_list = pos_list
+        self.pos_array = np.asarray(pos_list, dtype=float)
+        self.adj_matrix = adj_matrix
+        self.adj_matrix_area = adj_matrix_area
+        self.turn_table = TurnTable(adj_matrix, self.pos_array)
+        self.turn_table_area = None if adj_matrix_area is None else TurnTable(adj_matrix_area, self.pos_array)
+        self.source = np.asarray(source, dtype=np.int64).copy()
+        self.destination = np.asarray(destination, dtype=np.int64).copy()
+        self.num_car = len(self.source)
+        self.speed = np.broadcast_to(np.asarray(speed, dtype=float), (self.num_car,)).copy()
+        if car_type is None:
+            car_type = np.zeros(self.num_car, dtype=np.int64)
+        self.car_type = np.asarray(car_type, dtype=np.int64)
+        self.speed_vector = self.get_speed_vector(self.source, self.destination, self.speed)
+        self.current_position = self.pos_array[self.source].copy() # position is a point along an edge
+        self.np_rng = np_rng # np.random or a RandomState of its own
+
+    def get_speed_vector(self, source, destination, speed):
+        speed_vector = self.pos_array[destination] - self.pos_array[source]
+        norm = np.sqrt(speed_vector[:, 0]*speed_vector[:, 0] + speed_vector[:, 1]*speed_vector[:, 1])
+        moving = norm != 0 # a zero-length road leaves the speed vector at 0
+        speed_vector[~moving] = 0
+        speed_vector[moving] = speed_vector[moving] / norm[moving, np.newaxis] * speed[moving, np.newaxis]
+        return speed_vector
+
+    def move(self, time):
+        if road_jit.JIT_ENABLED:
+            return self.move_jit(time)
+        remaining = self.pos_array[self.destination] - self.current_position
+        remaining = np.sqrt(remaining[:, 0]*remaining[:, 0] + remaining[:, 1]*remaining[:, 1])
+        arrived = remaining < self.speed*time
+        #cars that stay on their road
+        self.current_position[~arrived] += self.speed_vector[~arrived]*time
+        if not arrived.any():
+            return
+        #cars that reach the end of the current road
+        index = np.nonzero(arrived)[0]
+        previous_source = self.source[index]
+        residual_time = time - remaining[index]/self.speed[index]
+        self.source[index] = self.destination[index]
+        area_car = self.car_type[index] != 0
+        groups = [(self.turn_table, ~area_car), (self.turn_table_area, area_car)]
+        # one uniform number per car with a real choice, drawn in car order
+        choose = np.zeros(len(index), dtype=bool)
+        for turn_table, mask in groups:
+            if mask.any():
+                choose[mask] = turn_table.get_count(previous_source[mask], self.source[index[mask]]) > 1
+        uniform = np.zeros(len(index))
+        uniform[choose] = self.np_rng.random_sample(np.count_nonzero(choose))
+        for turn_table, mask in groups:
+            if mask.any():
+                self.destination[index[mask]] = turn_table.sample(previous_source[mask], self.source[index[mask]], uniform[mask])
+        self.speed_vector[index] = self.get_speed_vector(self.source[index], self.destination[index], self.speed[index])
+        self.current_position[index] = self.pos_array[self.source[index]] + self.speed_vector[index] * residual_time[:, np.newaxis]
+
+    def move_jit(self, time):
+        # move() with the compiled kernels of road_jit, drawing the same random numbers
+        index, residual_time = road_jit.advance_fleet(self.current_position, self.destination, self.speed_vector,
+                                                      self.pos_array, self.speed, time)
+        if len(index) == 0:
+            return
+        previous_source = self.source[index]
+        self.source[index] = self.destination[index]
+        use_area = self.car_type[index] != 0
+        table = self.turn_table
+        area_table = table if self.turn_table_area is None else self.turn_table_area
+        count = road_jit.get_turn_count(previous_source, self.source[index], use_area, table.edge_key, table.count,
+                                        area_table.edge_key, area_table.count, table.num_nodes)
+        choose = count > 1
+        uniform = np.zeros(len(index))
+        uniform[choose] = self.np_rng.random_sample(np.count_nonzero(choose))
+        road_jit.turn_fleet(index, previous_source, residual_time, uniform, use_area, self.source, self.destination,
+                            self.current_position, self.speed_vector, self.pos_array, self.speed,
+                            table.edge_key, table.offsets, table.count, table.candidates, table.cdf,
+                            area_table.edge_key, area_table.offsets, area_table.count, area_table.candidates,
+                            area_table.cdf, table.num_nodes)
+
+
+class ContactTrace:
+    """
+    Pairs of cars that meet in every simulated second, stored in CSR form:
+    the pairs of second j are pairs[offsets[j]:offsets[j+1]], an (n, 2) int32 array,
+    and area[car, j] is the area label of the car at second j.
+    Seconds of one round are contiguous, so a round is a single slice as well.
+    Each meeting is the start of a contact interval: duration[k] is the number of seconds
+    the cars of pairs[k] stay in contact (within the round) and distance[k] their mean
+    distance, in the unit of circle_radius. Both are None for traces built from pair lists.
+    """
+    def __init__(self, offsets, pairs, area, epoch_time, duration = None, distance = None):
+        area = np.asarray(area)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.pairs = np.asarray(pairs, dtype=np.int32).reshape(-1, 2)
+        self.area = area.astype(np.uint8 if area.size == 0 or area.max() < 256 else np.int32)
+        self.epoch_time = epoch_time
+        self.duration = None if duration is None else np.asarray(duration, dtype=np.int32)
+        self.distance = None if distance is None else np.asarray(distance, dtype=np.float32)
+
+    @classmethod
+    def from_pair_list(cls, pair_list, area_list, epoch_time):
+        # build from the list-of-lists of (a, b) tuples format
+        offsets = np.zeros(len(pair_list) + 1, dtype=np.int64)
+        np.cumsum([len(pair_info) for pair_info in pair_list], out=offsets[1:])
+        pairs = np.array([p for pair_info in pair_list for p in pair_info], dtype=np.int32).reshape(-1, 2)
+        return cls(offsets, pairs, area_list, epoch_time)
+
+    @classmethod
+    def concatenate(cls, traces):
+        # join consecutive pieces of one simulation, e.g. the rounds of iter_roadNet_rounds
+        counts = np.concatenate([np.diff(trace.offsets) for trace in traces])
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        pairs = np.concatenate([trace.pairs for trace in traces])
+        duration = distance = None
+        if all(trace.duration is not None for trace in traces):
+            duration = np.concatenate([trace.duration for trace in traces])
+            distance = np.concatenate([trace.distance for trace in traces])
+        return cls(offsets, pairs, np.concatenate([trace.area for trace in traces], axis=1), traces[0].epoch_time,
+                   duration, distance)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, second):
+        return self.pairs[self.offsets[second]:self.offsets[second+1]]
+
+    def __iter__(self):
+        return self.iter_seconds()
+
+    @property
+    def num_round(self):
+        return len(self) // self.epoch_time
+
+    @property
+    def num_car(self):
+        return self.area.shape[0]
+
+    def iter_seconds(self, start = 0, stop = None):
+        if stop is None:
+            stop = len(self)
+        for second in range(start, stop):
+            yield self[second]
+
+    def iter_round(self, round_index):
+        # per-second pair arrays of one round
+        return self.iter_seconds(round_index*self.epoch_time, (round_index+1)*self.epoch_time)
+
+    def get_round(self, round_index):
+        # all pairs of one round, in the order they meet
+        return self.pairs[self.offsets[round_index*self.epoch_time]:self.offsets[(round_index+1)*self.epoch_time]]
+
+    def iter_round_duration(self, round_index):
+        # per-second contact durations of one round, aligned with iter_round
+        for second in range(round_index*self.epoch_time, (round_index+1)*self.epoch_time):
+            yield self.duration[self.offsets[second]:self.offsets[second+1]]
+
+    def get_intervals(self, start = 0, stop = None):
+        """
+        Contact intervals that begin in seconds [start, stop): the pairs, their start and
+        end second (exclusive) and their mean distance.
+        """
+        if stop is None:
+            stop = len(self)
+        begin, end = self.offsets[start], self.offsets[stop]
+        second = np.repeat(np.arange(start, stop), np.diff(self.offsets[start:stop+1]))
+        return self.pairs[begin:end], second, second + self.duration[begin:end], self.distance[begin:end]
+
+    def get_round_intervals(self, round_index):
+        return self.get_intervals(round_index*self.epoch_time, (round_index+1)*self.epoch_time)
+
+
+class TraceStream:
+    """
+    ContactTrace of a simulation that is still running, read round by round.
+    Round i is simulated when it is first requested (or up to `prefetch` rounds earlier by a
+    background thread) and released when a later round is requested, so only the pairs of
+    the current round are held in memory. area is filled in as the rounds are simulated.
+    on_round(round_index, round_trace) is called once for every simulated round.
+    np_rng/py_rng are the private random streams the rounds draw from, if any.
+    """
+    def __init__(self, rounds, num_car, num_round, epoch_time, area_dtype=np.uint8, prefetch=0, np_rng=None, py_rng=None):
+        self.rounds = rounds
+        self.np_rng = np_rng
+        self.py_rng = py_rng
+        self.num_car = num_car
+        self.num_round = num_round
+        self.epoch_time = epoch_time
+        self.area = np.zeros([num_car, num_round*epoch_time], dtype=area_dtype)
+        self.on_round = None
+        self.round_index = -1
+        self.current = None
+        self.queue = None
+        if prefetch > 0:
+            self.queue = queue.Queue(maxsize=prefetch)
+            self.thread = threading.Thread(target=self.run_ahead, daemon=True)
+            self.thread.start()
+
+    def run_ahead(self):
+        try:
+            for trace in self.rounds:
+                self.queue.put(trace)
+        except Exception as error: # raised again in the training thread
+            self.queue.put(error)
+
+    def next_round(self):
+        if self.queue is None:
+            return next(self.rounds)
+        trace = self.queue.get()
+        if isinstance(trace, Exception):
+            raise trace
+        return trace
+
+    def get_round_trace(self, round_index):
+        if round_index < self.round_index:
+            raise IndexError('Round ' + str(round_index) + ' of the trace stream has already been released')
+        if round_index >= self.num_round:
+            raise IndexError('Round ' + str(round_index) + ' is out of the ' + str(self.num_round) + ' simulated rounds')
+        while self.round_index < round_index:
+            self.current = self.next_round()
+            self.round_index += 1
+            self.area[:, self.round_index*self.epoch_time:(self.round_index+1)*self.epoch_time] = self.current.area
+            if self.on_round is not None:
+                self.on_round(self.round_index, self.current)
+        return self.current
+
+    def __len__(self):
+        return self.num_round * self.epoch_time
+
+    def __getitem__(self, second):
+        return self.get_round_trace(second // self.epoch_time)[second % self.epoch_time]
+
+    def iter_round(self, round_index):
+        return self.get_round_trace(round_index).iter_seconds()
+
+    def get_round(self, round_index):
+        return self.get_round_trace(round_index).pairs
+
+    def iter_round_duration(self, round_index):
+        return self.get_round_trace(round_index).iter_round_duration(0)
+
+    def get_round_intervals(self, round_index):
+        pairs, start, end, distance = self.get_round_trace(round_index).get_round_intervals(0)
+        return pairs, start + round_index*self.epoch_time, end + round_index*self.epoch_time, distance
+
 # def calculate_distance(node1, node2):
 #     # Calculate and return the distance between two nodes   
 #     pass
@@ -80,20 +421,22 @@ class Car:
 def get_cordinate_by_node(node, pos_list):
     return np.array([pos_list[node][0], pos_list[node][1]])
 
+def get_neighbors(adj_matrix, node):
+    # neighbours of node in a CSR adjacency matrix: an O(degree) slice of its column indices
+    return adj_matrix.indices[adj_matrix.indptr[node]:adj_matrix.indptr[node+1]]
+
 def filter_edges_by_group(adj_matrix, groups):
-    num_nodes = len(groups)
-    new_adj_matrix = np.zeros_like(adj_matrix)
-    
-    for i in range(num_nodes):
-        for j in range(num_nodes):
-            if groups[i] == groups[j]:  # Only keep edges within the same group
-                new_adj_matrix[i][j] = adj_matrix[i][j]
-    
+    groups = np.asarray(groups)
+    new_adj_matrix = adj_matrix.copy()
+    row = np.repeat(np.arange(adj_matrix.shape[0]), np.diff(adj_matrix.indptr))
+    # Only keep edges within the same group
+    new_adj_matrix.data = np.where(groups[row] == groups[adj_matrix.indices], adj_matrix.data, 0).astype(adj_matrix.dtype)
+    new_adj_matrix.eliminate_zeros()
     return new_adj_matrix
 
 def get_next_destination(source,previous_source,speed_vector,pos_list, adj_matrix):
     # Select and return a random edge from the given node's edges
-    neighbors = np.where(adj_matrix[source] == 1)[0]
+    neighbors = get_neighbors(adj_matrix, source)
     if len(neighbors)>1:# to make sure car dont reverse
         mask = neighbors != previous_source
         neighbors = neighbors[mask]
@@ -134,51 +477,274 @@ def cosine_similarity(vec1,vec2):
     norm_vector2 = np.linalg.norm(vec2)
     # Calculate cosine similarity
     if norm_vector1 == 0 or norm_vector2 == 0:
-        print("One of the vectors is zero, returning 0.0")
+        # a zero-length road has no direction, as in TurnTable
         return 0.0  # Trả về 0 nếu vector có độ dài 0
     
     return dot_product / (norm_vector1 * norm_vector2)
 
-def generate_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius = 100, step_time = 60, speed = 13.59,  County = 'New York', num_area = 10, car_type_list = [0]*100 ):
-    # data = gpd.read_file(file_path)
-    data = pd.read_csv("../NY_Data/NewYork.csv")
-    gdf = data[data['County']== County ]
-    # Initialize a directed graph if the roads have direction, else use nx.Graph()
-    G = nx.DiGraph()
-    speed = speed *0.00145/100
-    circle_radius = circle_radius * 0.00145/100
-    for index, row in gdf.iterrows():
-        start_node = (row['StartLat'], row['StartLong'])
-        end_node = (row['EndLat'], row['EndLong'])
-    
-        # Add nodes with attributes if you have any specific attributes to add
-        G.add_node(start_node)
-        G.add_node(end_node)
-    
-        # Add edge
-        G.add_edge(start_node, end_node, length=row['Miles'])
-        G.add_edge(end_node, start_node, length=row['Miles'])
-    
-        # If you have one-way streets, ensure you are adding edges in the correct direction.
-        # If the streets are two-way, you'll need to add edges in both directions.
-    
-    # Now G contains your road network graph
+def get_pair_distance(car_position, i, j):
+    # same arithmetic as the dense distance matrix, so every backend agrees on the boundary
+    return np.sqrt(np.sum((car_position[i] - car_position[j]) ** 2, axis=-1))
+
+class MeetingRecord:
+    """
+    Sparse replacement of the num_car x num_car meeting table: the pairs (i < j) met since
+    they last came into range, as sorted i*num_car+j keys. A pair is a new meeting only if
+    it is not in the record, and leaves the record once it is farther than circle_radius,
+    so every second costs O(contacts) instead of O(num_car^2).
+    Every recorded pair is an open contact interval: the second it started, the last second
+    it was in range and the sum of its distances; close() returns all the intervals.
+    """
+    def __init__(self, num_car):
+        self.num_car = num_car
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.start = np.zeros(0, dtype=np.int64)
+        self.last = np.zeros(0, dtype=np.int64)
+        self.distance_sum = np.zeros(0)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.closed = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, car_position, i, j, circle_radius, second = 0):
+        # i, j are the pairs in range now, sorted by (i, j); returns the mask of those that are new meetings
+        keys = i.astype(np.int64) * self.num_car + j
+        distance = get_pair_distance(car_position, i, j)
+        index = np.searchsorted(self.keys, keys)
+        found = index < len(self.keys)
+        found[found] = self.keys[index[found]] == keys[found]
+        index = index[found]
+        self.last[index] = second
+        self.distance_sum[index] += distance[found]
+        self.count[index] += 1
+        # pairs of the record out of range now are dropped, except those exactly at circle_radius
+        out = np.ones(len(self.keys), dtype=bool)
+        out[index] = False
+        out = np.nonzero(out)[0]
+        out_i, out_j = np.divmod(self.keys[out], self.num_car)
+        keep = np.ones(len(self.keys), dtype=bool)
+        keep[out[get_pair_distance(car_position, out_i, out_j) > circle_radius]] = False
+        self.closed.append(self.get_intervals(~keep))
+        new_meeting = ~found
+        count = np.count_nonzero(new_meeting)
+        keys = np.concatenate([self.keys[keep], keys[new_meeting]])
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.start = np.concatenate([self.start[keep], np.full(count, second)])[order]
+        self.last = np.concatenate([self.last[keep], np.full(count, second)])[order]
+        self.distance_sum = np.concatenate([self.distance_sum[keep], distance[new_meeting]])[order]
+        self.count = np.concatenate([self.count[keep], np.ones(count, dtype=np.int64)])[order]
+        return new_meeting
+
+    def get_intervals(self, mask):
+        # key, start second, duration in seconds and mean distance of the selected intervals
+        return (self.keys[mask], self.start[mask], self.last[mask] - self.start[mask] + 1,
+                self.distance_sum[mask] / self.count[mask])
+
+    def close(self):
+        # all contact intervals, ended or still open
+        intervals = self.closed + [self.get_intervals(np.ones(len(self.keys), dtype=bool))]
+        return tuple(np.concatenate(column) for column in zip(*intervals))
+
+def get_pairs_dense(car_position, circle_radius):
+    # reference backend: full num_car x num_car distance matrix, fine for small fleets
+    distance = np.sqrt(np.sum((car_position[:, np.newaxis, :] - car_position[np.newaxis, :, :]) ** 2, axis=-1))
+    i, j = np.where(distance < circle_radius)
+    mask = i < j
+    return i[mask], j[mask]
+
+def get_pairs_grid(car_position, circle_radius):
+    # uniform grid with cell size circle_radius: only cars in the same or an adjacent cell can be in range
+    num_car = len(car_position)
+    cell = np.floor(car_position / circle_radius).astype(np.int64)
+    cell -= cell.min(axis=0)
+    if road_jit.JIT_ENABLED:
+        return road_jit.get_pairs_grid_kernel(car_position, cell, circle_radius)
+    width = cell[:, 1].max() + 3 # keeps the y-1/y+1 neighbours of the border columns from wrapping into another row
+    key = cell[:, 0] * width + cell[:, 1]
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    i_list = []
+    j_list = []
+    # half of the 3x3 neighbourhood, so every pair of cells is visited once
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        neighbor_key = key + dx * width + dy
+        start = np.searchsorted(sorted_key, neighbor_key, side='left')
+        count = np.searchsorted(sorted_key, neighbor_key, side='right') - start
+        total = count.sum()
+        if total == 0:
+            continue
+        i = np.repeat(np.arange(num_car), count)
+        offset = np.arange(total) - np.repeat(np.cumsum(count) - count, count)
+        j = order[np.repeat(start, count) + offset]
+        if dx == 0 and dy == 0:
+            mask = i < j
+            i, j = i[mask], j[mask]
+        i_list.append(np.minimum(i, j))
+        j_list.append(np.maximum(i, j))
+    if len(i_list) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    i = np.concatenate(i_list)
+    j = np.concatenate(j_list)
+    mask = get_pair_distance(car_position, i, j) < circle_radius
+    i, j = i[mask], j[mask]
+    order = np.lexsort((j, i))
+    return i[order], j[order]
+
+def get_pairs_kdtree(car_position, circle_radius):
+    # query a slightly larger ball and apply the exact (strict) distance test afterwards
+    candidate = cKDTree(car_position).query_pairs(circle_radius * (1 + 1e-9), output_type='ndarray')
+    i = candidate[:, 0].astype(np.int64)
+    j = candidate[:, 1].astype(np.int64)
+    mask = get_pair_distance(car_position, i, j) < circle_radius
+    i, j = i[mask], j[mask]
+    order = np.lexsort((j, i))
+    return i[order], j[order]
+
+contact_backends = {'dense': get_pairs_dense, 'grid': get_pairs_grid, 'kdtree': get_pairs_kdtree}
+
+def get_pairs_in_range(car_position, circle_radius, backend = 'grid'):
+    """
+    Return the pairs (i, j), i < j, of cars closer than circle_radius, sorted by (i, j)
+    so that every backend yields the same list as the dense distance matrix.
+    """
+    if backend not in contact_backends:
+        raise ValueError('Unknown contact backend: ' + str(backend))
+    return contact_backends[backend](car_position, circle_radius)
+
+def load_roadNet(exp_dir, County = 'New York'):
+    """
+    Return pos_array (num_nodes x 2, longitude/latitude) and the CSR adjacency matrix of
+    the largest strongly connected road network of County, from road_network.road_registry.
+    """
     print('Now generating the road net of '+County)
-    scc = list(nx.strongly_connected_components(G))
-    largest_scc = max(scc, key=len)
-    G_largest_scc = G.subgraph(largest_scc).copy()
-    pos = {node: (node[1], node[0]) for node in G_largest_scc.nodes()}  # Create a position map with longitude, latitude
-    # Now G contains your road network graph
-    print(f"Number of nodes: {G_largest_scc.number_of_nodes()}")
-    print(f"Number of edges: {G_largest_scc.number_of_edges()}")
-    with open(exp_dir+'/configuration.txt','a') as file:
-        file.write('The road net of '+County+'\n')
-        file.write(f"Number of nodes: {G_largest_scc.number_of_nodes()}\n")
-        file.write(f"Number of edges: {G_largest_scc.number_of_edges()}\n")
-    # Generate the binary adjacency matrix
-    adjacency_matrix = nx.adjacency_matrix(G_largest_scc).todense()
-    pos_list = list(pos.values())
-    adj_matrix = np.array(adjacency_matrix)
+    road_net = road_network.road_registry.get(County)
+    pos_array, adj_matrix = road_net.pos_array, road_net.adj_matrix
+    print(f"Number of nodes: {adj_matrix.shape[0]}")
+    print(f"Number of edges: {adj_matrix.nnz}")
+    if exp_dir is not None: # batch simulations have no experiment directory
+        with open(exp_dir+'/configuration.txt','a') as file:
+            file.write('The road net of '+County+'\n')
+            file.write(f"Number of nodes: {adj_matrix.shape[0]}\n")
+            file.write(f"Number of edges: {adj_matrix.nnz}\n")
+    return pos_array, adj_matrix
+
+def init_fleet(num_car, car_type_list, speed, pos_list, adj_matrix, adj_matrix_area, area_labels, np_rng = np.random, py_rng = random):
+    """
+    Draw the initial road of every car: type 0 cars start anywhere, a car of type k
+    starts in area k-1 and stays there. Returns the Fleet.
+    """
+    num_nodes = adj_matrix.shape[0]
+    area_degree = np.diff(adj_matrix_area.indptr)
+    area_nodes = {} # nodes of every area, found once per car type
+    car_source = []
+    car_destination = []
+    for i in range(num_car):
+        car_type = int(car_type_list[i])
+        if car_type==0:
+            source  = py_rng.randint(0, num_nodes-1)
+            neighbors = get_neighbors(adj_matrix, source)
+        else:
+            if car_type not in area_nodes:
+                area_nodes[car_type] = np.where(area_labels == car_type-1)[0]
+                if not np.any(area_degree[area_nodes[car_type]] > 0):
+                    raise ValueError('Area ' + str(car_type-1) + ' has no road for cars of type ' + str(car_type))
+            neighbors = np.array([])
+            while(len(neighbors)==0):##########keep trying to get a non-empty neighbors
+                source = np_rng.choice(area_nodes[car_type])
+                neighbors = get_neighbors(adj_matrix_area, source)
+        #random chose destination from chosen source
+        # if len(neighbors) == 0:
+        #     print('ERROR!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+        destination = np_rng.choice(neighbors) 
+        car_source.append(source)
+        car_destination.append(destination)
+    return Fleet(car_source,car_destination,speed,pos_list,adj_matrix,adj_matrix_area,[int(car_type) for car_type in car_type_list[:num_car]],np_rng)
+
+def init_fleet_vectorized(num_car, car_type_list, speed, pos_list, adj_matrix, adj_matrix_area, area_labels, np_rng = np.random):
+    """
+    init_fleet for large mixed fleets: the start nodes of every car type are drawn at once
+    from the nodes with a road for that type, and the first roads in one draw for all cars.
+    Only np_rng is used, so the fleet differs from the init_fleet one with the same seed.
+    """
+    car_type = np.array([int(car_type) for car_type in car_type_list[:num_car]], dtype=np.int64)
+    area_car = car_type != 0
+    degree = np.diff(adj_matrix.indptr)
+    area_degree = np.diff(adj_matrix_area.indptr)
+    source = np.zeros(num_car, dtype=np.int64)
+    for type_index in np.unique(car_type):
+        cars = np.nonzero(car_type == type_index)[0]
+        if type_index == 0:
+            candidates = np.nonzero(degree > 0)[0]
+        else:
+            candidates = np.nonzero((area_labels == type_index-1) & (area_degree > 0))[0]
+        if len(candidates) == 0:
+            raise ValueError('Area ' + str(type_index-1) + ' has no road for cars of type ' + str(type_index))
+        source[cars] = candidates[np_rng.randint(0, len(candidates), size=len(cars))]
+    # the first road of every car, a uniform choice among the roads leaving its start node
+    choice = np_rng.randint(0, np.where(area_car, area_degree[source], degree[source]))
+    destination = np.zeros(num_car, dtype=np.int64)
+    destination[~area_car] = adj_matrix.indices[adj_matrix.indptr[source[~area_car]] + choice[~area_car]]
+    destination[area_car] = adj_matrix_area.indices[adj_matrix_area.indptr[source[area_car]] + choice[area_car]]
+    return Fleet(source,destination,speed,pos_list,adj_matrix,adj_matrix_area,car_type,np_rng)
+
+def parse_speed_class(text):
+    # 'share:mean:std' of a vehicle class, the --speed_mix format of the trainers
+    share, mean, std = (float(value) for value in text.split(':'))
+    return share, mean, std
+
+def get_speed_list(num_car, speed_mix, seed = Random_SEED):
+    """
+    Speed of every car in a fleet of vehicle classes (e.g. buses, taxis and private cars).
+    speed_mix lists the (share, mean, std) of every class; the class and the speed of each
+    car are drawn from a RandomState of their own, so the simulation streams are untouched.
+    Speeds are kept above a tenth of the class mean.
+    """
+    share, mean, std = (np.array(column, dtype=float) for column in zip(*speed_mix))
+    rng = np.random.RandomState(seed)
+    vehicle_class = rng.choice(len(share), size=num_car, p=share / share.sum())
+    speed = rng.normal(mean[vehicle_class], std[vehicle_class])
+    return np.maximum(speed, 0.1 * mean[vehicle_class])
+
+def record_meetings(car_position, i, j, meeting_record, circle_radius, second, py_rng = random):
+    # the pairs (i, j) in range that are new meetings, in random order
+    new_meeting = meeting_record.update(car_position, i, j, circle_radius, second)
+    pair = np.stack([i[new_meeting], j[new_meeting]], axis=1)
+    order = list(range(len(pair))) # shuffling the order consumes the same random numbers as shuffling the pair list
+    py_rng.shuffle(order)
+    return pair[order]
+
+def get_round_trace(pair_list, area_record, meeting_record, num_car, step_time):
+    """
+    One-round ContactTrace from the per-second meetings, the (step_time x num_car) area
+    record and the MeetingRecord of the round.
+    """
+    offsets = np.zeros(len(pair_list) + 1, dtype=np.int64)
+    np.cumsum([len(pair_info) for pair_info in pair_list], out=offsets[1:])
+    pairs = np.concatenate(pair_list)
+    # every meeting starts one contact interval, match them by (second, pair)
+    interval_key, interval_start, duration, distance = meeting_record.close()
+    second = np.repeat(np.arange(step_time), np.diff(offsets))
+    row = np.lexsort((pairs[:, 0].astype(np.int64) * num_car + pairs[:, 1], second))
+    interval = np.lexsort((interval_key, interval_start))
+    contact_duration = np.zeros(len(pairs), dtype=np.int64)
+    contact_duration[row] = duration[interval]
+    contact_distance = np.zeros(len(pairs))
+    contact_distance[row] = distance[interval] / (0.00145/100) # back to the unit of circle_radius
+    return ContactTrace(offsets, pairs, area_record.T, step_time, contact_duration, contact_distance)
+
+def iter_roadNet_rounds( exp_dir, num_car, num_round, circle_radius = 100, step_time = 60, speed = 13.59,  County = 'New York', num_area = 10, car_type_list = [0]*100, contact_backend = 'grid', np_rng = np.random, py_rng = random, area_method = 'kmeans', fleet_init = 'sequential' ):
+    """
+    Simulate the fleet round by round, yielding a one-round ContactTrace after every
+    step_time seconds. The random numbers come from np_rng/py_rng (np.random and random
+    by default, or RandomState/Random objects of the caller). The areas come from
+    area_method, see road_network.AREA_METHODS. speed is one speed or one per car (see
+    get_speed_list), fleet_init 'sequential' (init_fleet) or 'vectorized' (init_fleet_vectorized).
+    """
+    speed = np.asarray(speed, dtype=float) *0.00145/100
+    circle_radius = circle_radius * 0.00145/100
+    pos_list, adj_matrix = load_roadNet(exp_dir, County)
     
     
 
@@ -188,11 +754,8 @@ def generate_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius
     
     #cluster the nodes into num of areas
     pos_array = np.array(pos_list)
-    # Create and fit the KMeans model
-    kmeans = KMeans(n_clusters=num_area, random_state=Random_SEED)
-    kmeans.fit(pos_array)
-    # Get the cluster labels for each position
-    area_labels = kmeans.labels_
+    # area labels for each position, clustered once per (County, area_method, num_area, seed)
+    area_labels = road_network.road_registry.get(County).get_area_labels(num_area, Random_SEED, area_method)
 
     # # Get the cluster centers
     # area_centers = kmeans.cluster_centers_
@@ -201,29 +764,12 @@ def generate_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius
     
     # Draw the car
     # random initial
-    
-    pair_list = []
-    area_list = []
-    car_list = []
-    car_position = []
-    for i in range(num_car):
-        car_type = int(car_type_list[i])
-        if car_type==0:
-            source  = random.randint(0, num_nodes-1)
-            neighbors = np.where(adj_matrix[source] == 1)[0]
-        else:
-            neighbors = np.array([])
-            while(len(neighbors)==0):##########keep trying to get a non-empty neighbors
-                source = np.random.choice(np.where(area_labels == car_type-1)[0])
-                neighbors = np.where(adj_matrix_area[source] == 1)[0]
-        #random chose destination from chosen source
-        # if len(neighbors) == 0:
-        #     print('ERROR!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-        destination = np.random.choice(neighbors) 
-        car_list.append(Car(source,destination,speed,pos_list,adj_matrix,adj_matrix_area,car_type))
-        area_list.append([])
-        car_position.append(car_list[i].current_position)
-    car_position = np.array(car_position)
+    if fleet_init == 'vectorized':
+        fleet = init_fleet_vectorized(num_car, car_type_list, speed, pos_list, adj_matrix, adj_matrix_area, area_labels, np_rng)
+    elif fleet_init == 'sequential':
+        fleet = init_fleet(num_car, car_type_list, speed, pos_list, adj_matrix, adj_matrix_area, area_labels, np_rng, py_rng)
+    else:
+        raise ValueError('Unknown fleet initialization: ' + str(fleet_init))
     
     # # update car_node
     # def update(car_node ,previous_node):
@@ -239,39 +785,43 @@ def generate_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius
     #         previous_node[i] = temp_node
     #     return car_position,car_node, previous_node
 
-    def caculate_pair(car_position,meeting_record):
-        distance = np.sqrt(np.sum((car_position[:, np.newaxis, :] - car_position[np.newaxis, :, :]) ** 2, axis=-1))
-        pair = []
-        i, j = np.where(distance < circle_radius)
-        for x, y in zip(i, j):
-            if x<y:
-                if meeting_record[x][y]==0:
-                    pair.append((x,y))
-                    meeting_record[x][y] = 1
-        # for those not in the record: reset to not meet for the future use
-        i, j = np.where(distance > circle_radius)
-        for x, y in zip(i, j):
-            if x<y:
-                meeting_record[x][y] = 0
-        random.shuffle(pair)
-        return pair,meeting_record
+    def caculate_pair(car_position,meeting_record,second):
+        i, j = get_pairs_in_range(car_position, circle_radius, contact_backend)
+        return record_meetings(car_position, i, j, meeting_record, circle_radius, second, py_rng),meeting_record
     
     # loop to simulate cars' movement
-    # a table to record which car meet with other car, to remove duplicated continuous meeting.
-    meeting_record = np.zeros([num_car,num_car])
-    for j in range(num_round*step_time):
-        if j%step_time == 0:
-            #reset the meeting information every step time, because at that time the new model finishes training
-            meeting_record = np.zeros([num_car,num_car])
-        for i in range(num_car):
-            car_list[i].move(1)
-            car_position[i] = car_list[i].current_position
-    #     print(car_position[0]) 
-        for i in range(num_car):
-            area_list[i].append(area_labels[car_list[i].source])
-        pair_info, meeting_record = caculate_pair(car_position,meeting_record)
-        pair_list.append(pair_info)
-    return pair_list, area_list
+    for round_index in range(num_round):
+        # a table to record which car meet with other car, to remove duplicated continuous meeting.
+        #reset the meeting information every step time, because at that time the new model finishes training
+        meeting_record = MeetingRecord(num_car)
+        pair_list = []
+        area_record = np.zeros([step_time, num_car], dtype=area_labels.dtype)
+        for j in range(step_time):
+            fleet.move(1)
+            area_record[j] = area_labels[fleet.source]
+            pair_info, meeting_record = caculate_pair(fleet.current_position,meeting_record,j)
+            pair_list.append(pair_info)
+        yield get_round_trace(pair_list, area_record, meeting_record, num_car, step_time)
+
+def generate_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius = 100, step_time = 60, speed = 13.59,  County = 'New York', num_area = 10, car_type_list = [0]*100, contact_backend = 'grid', area_method = 'kmeans', fleet_init = 'sequential' ):
+    trace = ContactTrace.concatenate(list(iter_roadNet_rounds(exp_dir, num_car, num_round, circle_radius, step_time, speed, County, num_area, car_type_list, contact_backend, area_method=area_method, fleet_init=fleet_init)))
+    return trace, trace.area
+
+def stream_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius = 100, step_time = 60, speed = 13.59,  County = 'New York', num_area = 10, car_type_list = [0]*100, contact_backend = 'grid', prefetch = 0, area_method = 'kmeans', fleet_init = 'sequential' ):
+    """
+    Lazy generate_roadNet_pair_area_list: returns a TraceStream and its area matrix.
+    The simulation draws from private copies of the current random/np.random states, so the
+    trace is the same as the one of generate_roadNet_pair_area_list however the rounds are
+    interleaved with training, and the global streams are left to the training.
+    """
+    np_rng = np.random.RandomState()
+    np_rng.set_state(np.random.get_state())
+    py_rng = random.Random()
+    py_rng.setstate(random.getstate())
+    rounds = iter_roadNet_rounds(exp_dir, num_car, num_round, circle_radius, step_time, speed, County, num_area, car_type_list, contact_backend, np_rng, py_rng, area_method, fleet_init)
+    trace = TraceStream(rounds, num_car, num_round, step_time, np.uint8 if num_area <= 256 else np.int32, prefetch, np_rng, py_rng)
+    return trace, trace.area
+
 
 # def generate_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius = 100, step_time = 60, speed = 13.59,  County = 'New York', num_area = 10):
 #     # data = gpd.read_file(file_path)
@@ -396,45 +946,9 @@ def generate_roadNet_pair_area_list( exp_dir, num_car, num_round, circle_radius
 #     return pair_list, area_list
 
 def generate_roadNet_pair_list_v2( exp_dir, num_car, num_round, circle_radius = 100, step_time = 60, speed = 13.59,  County = 'New York'):
-    # data = gpd.read_file(file_path)
-    data = pd.read_csv("./NY_Data/NewYork.csv")
-    gdf = data[data['County']== County ]
-    # Initialize a directed graph if the roads have direction, else use nx.Graph()
-    G = nx.DiGraph()
     speed = speed *0.00145/100
     circle_radius = circle_radius * 0.00145/100
-    for index, row in gdf.iterrows():
-        start_node = (row['StartLat'], row['StartLong'])
-        end_node = (row['EndLat'], row['EndLong'])
-    
-        # Add nodes with attributes if you have any specific attributes to add
-        G.add_node(start_node)
-        G.add_node(end_node)
-    
-        # Add edge
-        G.add_edge(start_node, end_node, length=row['Miles'])
-        G.add_edge(end_node, start_node, length=row['Miles'])
-    
-        # If you have one-way streets, ensure you are adding edges in the correct direction.
-        # If the streets are two-way, you'll need to add edges in both directions.
-    
-    # Now G contains your road network graph
-    print('Now generating the road net of '+County)
-    scc = list(nx.strongly_connected_components(G))
-    largest_scc = max(scc, key=len)
-    G_largest_scc = G.subgraph(largest_scc).copy()
-    pos = {node: (node[1], node[0]) for node in G_largest_scc.nodes()}  # Create a position map with longitude, latitude
-    # Now G contains your road network graph
-    print(f"Number of nodes: {G_largest_scc.number_of_nodes()}")
-    print(f"Number of edges: {G_largest_scc.number_of_edges()}")
-    with open(exp_dir+'/configuration.txt','a') as file:
-        file.write('The road net of '+County+'\n')
-        file.write(f"Number of nodes: {G_largest_scc.number_of_nodes()}\n")
-        file.write(f"Number of edges: {G_largest_scc.number_of_edges()}\n")
-    # Generate the binary adjacency matrix
-    adjacency_matrix = nx.adjacency_matrix(G_largest_scc).todense()
-    pos_list = list(pos.values())
-    adj_matrix = np.array(adjacency_matrix)
+    pos_list, adj_matrix = load_roadNet(exp_dir, County)
     
     #generate car neighbour list:
     num_nodes = adj_matrix.shape[0]
@@ -451,7 +965,7 @@ def generate_roadNet_pair_list_v2( exp_dir, num_car, num_round, circle_radius =
     for i in range(num_car):
         #random choose road (source and destination)
         source  = random.randint(0, num_nodes-1)
-        neighbors = np.where(adj_matrix[source] == 1)[0]
+        neighbors = get_neighbors(adj_matrix, source)
         destination = np.random.choice(neighbors) 
         car_list.append(Car(source,destination,speed,pos_list,adj_matrix))
         car_position.append(car_list[i].current_position)
@@ -460,7 +974,7 @@ def generate_roadNet_pair_list_v2( exp_dir, num_car, num_round, circle_radius =
     # update car_node
     def update(car_node ,previous_node):
         for i in range(num_car):
-            neighbors = np.where(adj_matrix[car_node[i]] == 1)[0]
+            neighbors = get_neighbors(adj_matrix, car_node[i])
             temp_node = car_node[i]
             if len(neighbors)>1:# to make sure car don't reverse where there are other routine avaliable
                 node_to_remove = previous_node[i]
@@ -492,43 +1006,8 @@ def generate_roadNet_pair_list_v2( exp_dir, num_car, num_round, circle_radius =
 
 
 def generate_roadNet_pair_list( exp_dir, num_car, num_round, circle_radius = 0.02, County = 'New York', communication_interval = 1):
-    data = pd.read_csv("./NY_Data/NewYork.csv")
-    gdf = data[data['County']== County ]
-    # Initialize a directed graph if the roads have direction, else use nx.Graph()
-    G = nx.DiGraph()
-    
-    for index, row in gdf.iterrows():
-        start_node = (row['StartLat'], row['StartLong'])
-        end_node = (row['EndLat'], row['EndLong'])
-    
-        # Add nodes with attributes if you have any specific attributes to add
-        G.add_node(start_node)
-        G.add_node(end_node)
     
-        # Add edge
-        G.add_edge(start_node, end_node, length=row['Miles'])
-        G.add_edge(end_node, start_node, length=row['Miles'])
-    
-        # If you have one-way streets, ensure you are adding edges in the correct direction.
-        # If the streets are two-way, you'll need to add edges in both directions.
-    
-    # Now G contains your road network graph
-    print('Now generating the road net of '+County)
-    scc = list(nx.strongly_connected_components(G))
-    largest_scc = max(scc, key=len)
-    G_largest_scc = G.subgraph(largest_scc).copy()
-    pos = {node: (node[1], node[0]) for node in G_largest_scc.nodes()}  # Create a position map with longitude, latitude
-    # Now G contains your road network graph
-    print(f"Number of nodes: {G_largest_scc.number_of_nodes()}")
-    print(f"Number of edges: {G_largest_scc.number_of_edges()}")
-    with open(exp_dir+'/configuration.txt','a') as file:
-        file.write('The road net of '+County+'\n')
-        file.write(f"Number of nodes: {G_largest_scc.number_of_nodes()}\n")
-        file.write(f"Number of edges: {G_largest_scc.number_of_edges()}\n")
-    # Generate the binary adjacency matrix
-    adjacency_matrix = nx.adjacency_matrix(G_largest_scc).todense()
-    pos_list = list(pos.values())
-    adj_matrix = np.array(adjacency_matrix)
+    pos_list, adj_matrix = load_roadNet(exp_dir, County)
     
     #generate car neighbour list:
     num_nodes = adj_matrix.shape[0]
@@ -549,7 +1028,7 @@ def generate_roadNet_pair_list( exp_dir, num_car, num_round, circle_radius = 0.0
     # update car_node
     def update(car_node ,previous_node):
         for i in range(num_car):
-            neighbors = np.where(adj_matrix[car_node[i]] == 1)[0]
+            neighbors = get_neighbors(adj_matrix, car_node[i])
             temp_node = car_node[i]
             if len(neighbors)>1:# to make sure car don't reverse where there are other routine avaliable
                 node_to_remove = previous_node[i]
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Binary, indexed dump of the mobility trace of a run (trace.bin + trace.idx in the run
+directory), replacing the pair.txt/area.txt text dumps.
+
+trace.bin is a header followed by one record per round, appended as the rounds are
+known (so a streamed trace is written while training). A record holds the per-second
+offsets of the round, its pairs (int32), the contact durations/distances if the trace
+has them and the area of every car at every second. trace.idx holds the byte position
+of every record, so a round is read without scanning the rounds before it:
+
+    python trace_file.py <run_dir>/trace.bin                 # summary
+    python trace_file.py <run_dir>/trace.bin --round 3       # pairs of every second of round 3
+    python trace_file.py <run_dir>/trace.bin --second 100 130 --area
+"""
+import argparse
+import os
+
+import numpy as np
+
+from road_sim import ContactTrace
+
+TRACE_FILE_MAGIC = b'CDFLTRC1'
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('num_car', '<i8'), ('epoch_time', '<i8')])
+ROUND_DTYPE = np.dtype([('round_index', '<i8'), ('num_pairs', '<i8'), ('has_duration', '<i8'), ('area_itemsize', '<i8')])
+AREA_DTYPES = {1: np.dtype('<u1'), 4: np.dtype('<i4')}
+
+
+def get_index_path(path):
+    return os.path.splitext(path)[0] + '.idx'
+
+
+class TraceWriter:
+    """
+    Writes the rounds of a trace to path (and its index), starting a new file.
+    """
+    def __init__(self, path, num_car, epoch_time):
+        self.path = path
+        self.num_car = num_car
+        self.epoch_time = epoch_time
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header[0] = (TRACE_FILE_MAGIC, num_car, epoch_time)
+        with open(path, 'wb') as file:
+            file.write(header.tobytes())
+        open(get_index_path(path), 'wb').close()
+        self.num_round = 0
+
+    def write_round(self, round_trace, round_index=None):
+        # append a one-round ContactTrace
+        if round_index is None:
+            round_index = self.num_round
+        has_duration = round_trace.duration is not None
+        area = round_trace.area.astype(AREA_DTYPES[round_trace.area.dtype.itemsize])
+        record = np.zeros(1, dtype=ROUND_DTYPE)
+        record[0] = (round_index, len(round_trace.pairs), has_duration, area.dtype.itemsize)
+        with open(self.path, 'ab') as file:
+            position = file.tell()
+            file.write(record.tobytes())
+            file.write((round_trace.offsets - round_trace.offsets[0]).astype('<i8').tobytes())
+            file.write(round_trace.pairs.astype('<i4').tobytes())
+            if has_duration:
+                file.write(round_trace.duration.astype('<i4').tobytes())
+                file.write(round_trace.distance.astype('<f4').tobytes())
+            file.write(np.ascontiguousarray(area).tobytes())
+        with open(get_index_path(self.path), 'ab') as file:
+            file.write(np.array([position], dtype='<i8').tobytes())
+        self.num_round += 1
+
+    def write_trace(self, trace):
+        # append every round of a whole ContactTrace
+        for round_index in range(trace.num_round):
+            start, stop = round_index * trace.epoch_time, (round_index + 1) * trace.epoch_time
+            begin, end = trace.offsets[start], trace.offsets[stop]
+            self.write_round(ContactTrace(
+                trace.offsets[start:stop + 1] - begin, trace.pairs[begin:end], trace.area[:, start:stop], trace.epoch_time,
+                None if trace.duration is None else trace.duration[begin:end],
+                None if trace.distance is None else trace.distance[begin:end]))
+
+
+def write_trace_file(path, trace):
+    writer = TraceWriter(path, trace.num_car, trace.epoch_time)
+    writer.write_trace(trace)
+    return writer
+
+
+class TraceReader:
+    """
+    Random access to the rounds of a trace file, through a read-only memory map.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        header = np.frombuffer(self.data, dtype=HEADER_DTYPE, count=1)[0]
+        if header['magic'] != TRACE_FILE_MAGIC:
+            raise ValueError(path + ' is not a trace file')
+        self.num_car = int(header['num_car'])
+        self.epoch_time = int(header['epoch_time'])
+        self.positions = np.fromfile(get_index_path(path), dtype='<i8')
+
+    @property
+    def num_round(self):
+        return len(self.positions)
+
+    def read(self, dtype, count, position):
+        array = np.frombuffer(self.data, dtype=dtype, count=count, offset=position)
+        return array, position + array.nbytes
+
+    def get_round(self, round_index):
+        # one-round ContactTrace of round round_index
+        record, position = self.read(ROUND_DTYPE, 1, int(self.positions[round_index]))
+        num_pairs, has_duration = int(record[0]['num_pairs']), bool(record[0]['has_duration'])
+        offsets, position = self.read('<i8', self.epoch_time + 1, position)
+        pairs, position = self.read('<i4', 2 * num_pairs, position)
+        duration = distance = None
+        if has_duration:
+            duration, position = self.read('<i4', num_pairs, position)
+            distance, position = self.read('<f4', num_pairs, position)
+        area, position = self.read(AREA_DTYPES[int(record[0]['area_itemsize'])], self.num_car * self.epoch_time, position)
+        return ContactTrace(offsets, pairs.reshape(-1, 2), area.reshape(self.num_car, self.epoch_time),
+                            self.epoch_time, duration, distance)
+
+    def get_trace(self, start_round=0, stop_round=None):
+        # the rounds [start_round, stop_round) as one ContactTrace
+        if stop_round is None:
+            stop_round = self.num_round
+        return ContactTrace.concatenate([self.get_round(round_index) for round_index in range(start_round, stop_round)])
+
+    def iter_seconds(self, start, stop):
+        # (second, pairs, area of every car) of the seconds [start, stop) of the run
+        for round_index in range(start // self.epoch_time, (stop - 1) // self.epoch_time + 1):
+            round_trace = self.get_round(round_index)
+            first = round_index * self.epoch_time
+            for second in range(max(start, first), min(stop, first + self.epoch_time)):
+                yield second, round_trace[second - first], round_trace.area[:, second - first]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a binary mobility trace of a run")
+    parser.add_argument("path", type=str, help="trace.bin of a run directory")
+    parser.add_argument("--round", nargs='+', type=int, default=None, help="Round, or range of rounds [start, stop)")
+    parser.add_argument("--second", nargs='+', type=int, default=None, help="Second, or range of seconds [start, stop)")
+    parser.add_argument("--area", action='store_true', help="Print the area of every car as well")
+    args = parser.parse_args()
+
+    reader = TraceReader(args.path)
+    if args.round is None and args.second is None:
+        num_pairs = sum(len(reader.get_round(round_index).pairs) for round_index in range(reader.num_round))
+        print('{} cars, {} rounds of {} s, {} meetings'.format(reader.num_car, reader.num_round, reader.epoch_time,
+                                                              num_pairs))
+        return
+    if args.second is not None:
+        start, stop = args.second[0], (args.second[1] if len(args.second) > 1 else args.second[0] + 1)
+    else:
+        start = args.round[0] * reader.epoch_time
+        stop = (args.round[1] if len(args.round) > 1 else args.round[0] + 1) * reader.epoch_time
+    stop = min(stop, reader.num_round * reader.epoch_time)
+    for second, pairs, area in reader.iter_seconds(start, stop):
+        if second % reader.epoch_time == 0 or second == start:
+            print('Round:' + str(second // reader.epoch_time) + ': ')
+        print('Seconds:' + str(second % reader.epoch_time) + ': ')
+        print(str(pairs.tolist()))
+        if args.area:
+            print('Area: ' + str(area.tolist()))
+
+
+if __name__ == '__main__':
+    main()
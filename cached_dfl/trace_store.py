@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk store of road simulation traces.
+
+A trace (ContactTrace + area matrix) is written once per simulation configuration as an
+.npz file named by a hash of the parameters, holding the CSR arrays of the ContactTrace.
+Later runs with the same configuration load it instead of re-running
+generate_roadNet_pair_area_list. generate_trace_batch fills the store with many
+configurations at once, in a process pool. Traces imported from a GPS log (see gps_trace)
+are stored the same way, keyed by the log file as well.
+"""
+import hashlib
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import road_network
+import seed_setter
+from gps_trace import get_gps_signature, import_gps_pair_area_list, stream_gps_pair_area_list
+from road_sim import (
+    ContactTrace, generate_roadNet_pair_area_list, stream_roadNet_pair_area_list, iter_roadNet_rounds, Random_SEED
+)
+
+TRACE_FORMAT_VERSION = 4
+
+
+def get_rng_fingerprint(np_rng=np.random, py_rng=random):
+    """
+    Digest of the `random`/`np.random` state (the global one by default). The simulation
+    draws from both, so the same seed can still give different traces if something
+    consumed random numbers before the simulation started (e.g. a different data distribution).
+    """
+    np_state = np_rng.get_state()
+    digest = hashlib.sha1()
+    digest.update(np_state[1].tobytes())
+    digest.update(str(np_state[2:]).encode())
+    digest.update(str(py_rng.getstate()).encode())
+    return digest.hexdigest()
+
+
+def get_trace_key(County, num_car, num_round, epoch_time, speed, communication_distance,
+                  num_area, car_type_list, seed, rng_fingerprint=None, road_net=None, gps=None, area_method='kmeans',
+                  fleet_init='sequential'):
+    config = {
+        'version': TRACE_FORMAT_VERSION,
+        'County': County,
+        'num_car': int(num_car),
+        'num_round': int(num_round),
+        'epoch_time': int(epoch_time),
+        'speed': float(speed) if np.ndim(speed) == 0 else [float(car_speed) for car_speed in speed],
+        'communication_distance': float(communication_distance),
+        'num_area': int(num_area),
+        'car_type_list': [int(car_type) for car_type in car_type_list[:num_car]],
+        'seed': seed,
+        'rng': rng_fingerprint,
+        'road_net': road_net,
+        'gps': gps,
+        'area_method': area_method,
+        'fleet_init': fleet_init,
+    }
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def save_trace(path, trace, np_rng=np.random, py_rng=random):
+    """
+    Write the ContactTrace to `path` together with the RNG state reached at the end of the
+    simulation, so that a run loading the trace continues with the same random stream.
+    """
+    np_state = np_rng.get_state()
+    py_state = py_rng.getstate()
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, offsets=trace.offsets, pairs=trace.pairs, area=trace.area, epoch_time=trace.epoch_time,
+                 duration=trace.duration, distance=trace.distance,
+                 np_keys=np_state[1], np_pos=np_state[2], np_has_gauss=np_state[3],
+                 np_cached_gaussian=np_state[4],
+                 py_state=np.array(py_state[1], dtype=np.int64),
+                 py_gauss=np.nan if py_state[2] is None else py_state[2])
+    os.replace(tmp_path, path)
+
+
+def load_trace(path, restore_rng=True):
+    with np.load(path) as data:
+        trace = ContactTrace(data['offsets'], data['pairs'], data['area'], int(data['epoch_time']),
+                             data['duration'], data['distance'])
+        if restore_rng:
+            np.random.set_state(('MT19937', data['np_keys'], int(data['np_pos']),
+                                 int(data['np_has_gauss']), float(data['np_cached_gaussian'])))
+            py_gauss = float(data['py_gauss'])
+            random.setstate((3, tuple(data['py_state'].tolist()), None if np.isnan(py_gauss) else py_gauss))
+    return trace, trace.area
+
+
+def load_or_generate_trace(trace_dir, exp_dir, num_car, num_round, circle_radius=100, step_time=60,
+                           speed=13.59, County='New York', num_area=10, car_type_list=[0]*100,
+                           contact_backend='grid', seed=None, stream=False, prefetch=0, gps_file=None,
+                           area_method='kmeans', fleet_init='sequential'):
+    """
+    Same arguments and outputs as generate_roadNet_pair_area_list, plus `trace_dir`
+    (an empty value disables the store) and the `seed` the run was started with.
+    With a seed, `random` and `np.random` are reseeded with it before the simulation, so
+    that the trace depends on the configuration and the seed only, whatever the data
+    loaders drew before, and is the one generate_trace_batch stores for them.
+    With `stream` a trace that is not in the store is simulated lazily as a TraceStream
+    (see stream_roadNet_pair_area_list), which is never held whole and thus not stored.
+    With `gps_file` the trace is imported from that GPS log instead of simulated.
+    """
+    if seed is not None:
+        np.random.seed(seed)
+        random.seed(seed)
+    if trace_dir:
+        # the road network cache name changes with the csv it was built from
+        road_net = os.path.basename(road_network.road_registry.get(County).cache_prefix)
+        key = get_trace_key(County, num_car, num_round, step_time, speed, circle_radius, num_area,
+                            car_type_list, seed, None if seed is not None else get_rng_fingerprint(), road_net,
+                            get_gps_signature(gps_file) if gps_file else None, area_method, fleet_init)
+        path = os.path.join(trace_dir, 'trace_' + key + '.npz')
+        if os.path.exists(path):
+            print('Load the mobility trace from ' + path)
+            with open(exp_dir+'/configuration.txt', 'a') as file:
+                file.write('Mobility trace loaded from ' + path + '\n')
+            return load_trace(path)
+    if stream and gps_file:
+        return stream_gps_pair_area_list(exp_dir, gps_file, num_car, num_round, circle_radius, step_time,
+                                         County, num_area, contact_backend, prefetch, area_method=area_method)
+    if stream:
+        return stream_roadNet_pair_area_list(exp_dir, num_car, num_round, circle_radius, step_time, speed,
+                                             County, num_area, car_type_list, contact_backend, prefetch, area_method,
+                                             fleet_init)
+    if gps_file:
+        pair, area = import_gps_pair_area_list(exp_dir, gps_file, num_car, num_round, circle_radius, step_time,
+                                               County, num_area, contact_backend, area_method=area_method)
+    else:
+        pair, area = generate_roadNet_pair_area_list(exp_dir, num_car, num_round, circle_radius, step_time, speed,
+                                                     County, num_area, car_type_list, contact_backend, area_method,
+                                                     fleet_init)
+    if not trace_dir:
+        return pair, area
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+    save_trace(path, pair)
+    with open(exp_dir+'/configuration.txt', 'a') as file:
+        file.write('Mobility trace saved to ' + path + '\n')
+    return pair, area
+
+
+def get_trace_config(config):
+    """
+    Complete a batch simulation config with the defaults of generate_roadNet_pair_area_list.
+    num_car and num_round are required, seed defaults to seed_setter.SEED.
+    """
+    full_config = {
+        'circle_radius': 100,
+        'step_time': 60,
+        'speed': 13.59,
+        'County': 'New York',
+        'num_area': 10,
+        'car_type_list': [0]*config['num_car'],
+        'contact_backend': 'grid',
+        'area_method': 'kmeans',
+        'fleet_init': 'sequential',
+        'seed': seed_setter.SEED,
+    }
+    full_config.update(config)
+    return full_config
+
+
+def init_trace_worker(csv_files, cache_dir):
+    # a spawned worker starts with the default registry
+    road_network.road_registry = road_network.RoadNetworkRegistry(csv_files, cache_dir)
+
+
+def simulate_trace_job(job):
+    """
+    Simulate one batch config with random streams of its own, seeded like
+    seed_setter.set_seed with config['seed'], and store it at path.
+    """
+    config, path = job
+    np_rng = np.random.RandomState(config['seed'])
+    py_rng = random.Random(config['seed'])
+    rounds = iter_roadNet_rounds(None, config['num_car'], config['num_round'], config['circle_radius'],
+                                 config['step_time'], config['speed'], config['County'], config['num_area'],
+                                 config['car_type_list'], config['contact_backend'], np_rng, py_rng,
+                                 config['area_method'], config['fleet_init'])
+    save_trace(path, ContactTrace.concatenate(list(rounds)), np_rng, py_rng)
+    return path
+
+
+def generate_trace_batch(configs, trace_dir, num_workers=None):
+    """
+    Simulate every config (a dict of generate_roadNet_pair_area_list arguments plus
+    'seed', see get_trace_config) into the store at trace_dir, in a pool of num_workers
+    processes (all CPUs by default). Each job draws only from streams seeded by its own
+    config, so the traces do not depend on the number of workers or the job order.
+    Configs that are already stored are skipped. Returns the trace paths, in config order.
+    """
+    configs = [get_trace_config(config) for config in configs]
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+    paths = []
+    jobs = {}
+    for config in configs:
+        # graphs and area labels are built once here, the workers load them from the road cache
+        road_net = road_network.road_registry.get(config['County'])
+        road_net.get_area_labels(config['num_area'], Random_SEED, config['area_method'])
+        # keyed on the seed like load_or_generate_trace, which reseeds the global streams with it
+        key = get_trace_key(config['County'], config['num_car'], config['num_round'], config['step_time'],
+                            config['speed'], config['circle_radius'], config['num_area'], config['car_type_list'],
+                            config['seed'], None, os.path.basename(road_net.cache_prefix),
+                            area_method=config['area_method'], fleet_init=config['fleet_init'])
+        path = os.path.join(trace_dir, 'trace_' + key + '.npz')
+        paths.append(path)
+        if not os.path.exists(path):
+            jobs[path] = config
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    job_list = [(config, path) for path, config in jobs.items()]
+    if num_workers <= 1 or len(job_list) <= 1:
+        for job in job_list:
+            simulate_trace_job(job)
+    else:
+        with ProcessPoolExecutor(num_workers, initializer=init_trace_worker,
+                                 initargs=(road_network.road_registry.csv_files, road_network.road_registry.cache_dir)) as executor:
+            list(executor.map(simulate_trace_job, job_list))
+    return paths
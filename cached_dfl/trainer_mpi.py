@@ -32,6 +32,7 @@ from cache_algorithm import (
     update_model_cache_global, kick_out_timeout_model_cache_info,
     cache_average_process, 
     update_model_cache, update_model_cache_only_one,
+    get_model_size, get_max_transfer,
 )
 from aggregation import (
     average_weights, normal_training_process, normal_train,
@@ -45,7 +46,13 @@ from data_loader import (
     get_cifar10_iid,  get_cifar10_dirichlet, get_cifar10_non_iid,
     get_fashionmnist_area, get_fashionmnist_iid,  get_fashionmnist_dirichlet, get_fashionmnist_non_iid
 )
-from road_sim import generate_roadNet_pair_area_list
+from trace_store import load_or_generate_trace
+from road_sim import TraceStream, get_speed_list, parse_speed_class
+from trace_file import TraceWriter, write_trace_file
+from model_store import ModelStore, snapshot_models
+from cache_table import CacheTable
+from road_network import road_registry, AREA_METHODS
+from road_jit import set_jit
 import seed_setter
 
 Randomseed = seed_setter.set_seed()
@@ -82,6 +89,18 @@ parser.add_argument("--overlap", type=int, default=0, help="date overlap in area
 parser.add_argument("--test_ratio", type=float, default=1.0, help="ratio to take the subset of the testset for the testing")
 parser.add_argument("--shards_allocation", nargs='+', type=int, default=[3,2,1,3,2,1,1,4,1,2]*10, help="Shards allocation")
 parser.add_argument("--County", type=str, default="New York", help="County")
+parser.add_argument("--contact_backend", type=str, default='grid', choices=['dense', 'grid', 'kdtree'], help="Contact detection backend of the road simulation")
+parser.add_argument("--trace_dir", type=str, default="./trace_cache", help="Directory caching the mobility traces (empty string disables it)")
+parser.add_argument("--link_rate", type=float, default=0, help="V2V link rate in Mbit/s limiting the models exchanged per contact (0: unlimited)")
+parser.add_argument("--stream_trace", action='store_true', help="Simulate the mobility trace round by round while training instead of up front")
+parser.add_argument("--trace_prefetch", type=int, default=0, help="Rounds a background thread simulates ahead of training with --stream_trace")
+parser.add_argument("--road_data", nargs='+', type=str, default=[], help="Extra road csv files (StartLat/StartLong/EndLat/EndLong/Miles/County) to simulate on")
+parser.add_argument("--road_cache", type=str, default="./road_cache", help="Directory caching the preprocessed road networks")
+parser.add_argument("--gps_trace", type=str, default="", help="GPS log (csv/parquet with car_id, timestamp, lat, long) replacing the simulated fleet")
+parser.add_argument("--area_method", type=str, default='kmeans', choices=AREA_METHODS, help="Clustering of the road nodes into areas (minibatch/grid are faster on large graphs)")
+parser.add_argument("--speed_mix", nargs='+', type=parse_speed_class, default=[], help="Vehicle classes as share:mean:std of their speed (e.g. 0.1:8:1 0.3:15:3 0.6:13.59:2), replacing --speed")
+parser.add_argument("--fleet_init", type=str, default='sequential', choices=['sequential', 'vectorized'], help="Initial roads drawn car by car (original traces) or at once for large mixed fleets")
+parser.add_argument("--jit", action='store_true', help="Run the car movement and grid contact detection as Numba kernels (same traces)")
 parser.add_argument("--weighted_aggregation", action='store_true', help="Enable weighted aggregation")
 parser.add_argument('--no-weighted_aggregation', dest='weighted_aggregation', action='store_false')
 parser.set_defaults(weighted_aggregation=True)
@@ -90,6 +109,10 @@ parser.add_argument("--algorithm", type=str, default='cache', choices=[
 ], help="Choose the algorithm to run")
 # Parse arguments
 args = parser.parse_args()
+road_registry.cache_dir = args.road_cache
+for road_file in args.road_data:
+    road_registry.add_csv(road_file)
+set_jit(args.jit)
 task = args.task
 # Assign values to variables
 if args.test_ratio<1.0:
@@ -135,6 +158,8 @@ def write_info(write_dir):
         file.write('num_round = '+str(num_round)+'\n')
         file.write('num_car = '+str(args.num_car)+'\n')
         file.write('speed = '+str(speed)+'\n')
+        if args.speed_mix:
+            file.write('speed_mix = '+str(args.speed_mix)+'\n')
         file.write('communication_distance = '+str(communication_distance)+'\n')
         file.write('epoch_time = '+str(args.epoch_time)+'\n')
         file.write('cache_size = '+str(cache_size)+'\n')
@@ -142,6 +167,8 @@ def write_info(write_dir):
         file.write('shards_allocation = '+str(shards_allocation)+'\n')
         file.write('Aggregation weights = '+str(weights)+'\n')
         file.write('County = '+str(County)+'\n')
+        file.write('contact_backend = '+str(args.contact_backend)+'\n')
+        file.write('link_rate = '+str(args.link_rate)+'\n')
         file.write('kick_out = '+str(args.kick_out)+'\n')
         file.write('Test_ratio = '+str(args.test_ratio)+'\n')
         file.write('Test size = '+str(len(test_loader.dataset))+'\n')
@@ -166,17 +193,15 @@ def write_info(write_dir):
         file.write(str(data_similarity)+'\n')
         file.write('Data_points:\n'+str(data_points)+'\n')
 
-    pair, area = generate_roadNet_pair_area_list(write_dir,args.num_car, num_round,communication_distance,args.epoch_time,speed,County,10,car_type_list)
-    with open(write_dir+'/pair.txt','w') as file:
-        for i in range(num_round):
-            file.write('Round:'+str(i)+': \n')
-            for j in range(args.epoch_time):
-                file.write('Seconds:'+str(j)+': \n')
-                file.write(str(pair[i*args.epoch_time+j])+'\n')
-    with open(write_dir+'/area.txt','w') as file:
-        for i in range(num_car):
-            file.write('Car:'+str(i)+': ')
-            file.write(str(area[i])+'\n')
+    car_speed = get_speed_list(args.num_car, args.speed_mix, Randomseed) if args.speed_mix else speed
+    pair, area = load_or_generate_trace(args.trace_dir,write_dir,args.num_car, num_round,communication_distance,args.epoch_time,car_speed,County,10,car_type_list,args.contact_backend,Randomseed,args.stream_trace,args.trace_prefetch,args.gps_trace,args.area_method,args.fleet_init)
+    # the trace of the run goes to trace.bin/trace.idx, read it back with trace_file.py
+    if isinstance(pair, TraceStream):
+        # rounds are logged as they are simulated
+        trace_writer = TraceWriter(write_dir+'/trace.bin', num_car, args.epoch_time)
+        pair.on_round = lambda round_index, round_trace: trace_writer.write_round(round_trace, round_index)
+        return pair, area
+    write_trace_file(write_dir+'/trace.bin', pair)
     return pair, area
             
 # Example: serialize a PyTorch model
@@ -471,9 +496,9 @@ def Decentralized_process(suffix_dir,train_loader,test_loader,num_round,local_ep
         # do model update
         time_a = time.time()
         receiver_buffer = {}
-        model_before_training = copy.deepcopy(model)
-        for seconds in range(args.epoch_time):
-            for a,b in pair[i*args.epoch_time+seconds]: 
+        model_before_training = snapshot_models(model)
+        for pair_info in pair.iter_round(i):
+            for a,b in pair_info.tolist(): 
                 if distribution == 'area':
                     if car_type_list[a] == car_type_list[b] or car_type_list[a] == 0 or car_type_list[b] == 0: 
                         receiver_buffer[a] = b
@@ -544,7 +569,8 @@ def Decentralized_process(suffix_dir,train_loader,test_loader,num_round,local_ep
  
 def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,local_ep):
     model = []
-    local_cache = []
+    model_store = ModelStore() # model versions referenced by cache_table
+    cache_table = CacheTable(num_car, model_store) # the caches of all cars
     acc_global = []
     acc_global_before_aggregation = []
     class_acc_list = []
@@ -561,13 +587,13 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
     current_class_test = np.zeros([num_car,10])
     model_dir = './result/'+str(date_time.strftime('%Y-%m-%d %H_%M_%S'))+'_'+task+'_'+data_distribution+'_'+str(Randomseed)+'_'+args.algorithm+'_'+str(cache_size)+'_local_ep_'+str(local_ep)+'_epoch_time_'+str(args.epoch_time)+'_kick_out_'+str(args.kick_out) +suffix_dir
     pair,area = write_info(model_dir)
+    model_size = get_model_size(global_model) # bytes sent per model over the V2V link
 
     for i in range(1,size):
         comm.send(model_dir, dest=i, tag=7)
         comm.send(area, dest=i, tag=8)
     # Distribute model to all clients 
     for i in range(num_car):
-        local_cache.append({})
         model.append(copy.deepcopy(global_model))
         # optimizer.append([])
         acc_global.append([])
@@ -615,42 +641,32 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
         # model_before_aggregation = copy.deepcopy(model)
         
         # mpi_test_host(model_before_aggregation, acc_global_before_aggregation, class_acc_list_before_aggregation,False,model_dir)
-        model_before_training = copy.deepcopy(model)
+        model_before_training = model_store.snapshot_round(i, model)
         if kick_out == True:
-            for index in range(args.num_car):
-                local_cache[index] = kick_out_timeout_model(local_cache[index],i-args.kick_out)
+            cache_table.kick_out(i-args.kick_out)
             torch.cuda.empty_cache()
-        for seconds in range(args.epoch_time):
-            for a,b in pair[i*args.epoch_time+seconds]: 
-                update_model_cache(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out)
-                torch.cuda.empty_cache()
+        for pair_info, duration_info in zip(pair.iter_round(i), pair.iter_round_duration(i)):
+            for (a,b), duration in zip(pair_info.tolist(), duration_info.tolist()): 
+                cache_table.exchange(a,b,i, cache_size, get_max_transfer(duration, args.link_rate, model_size))
+        cache_table.release()
+        torch.cuda.empty_cache()
         #########################
         #Statistic cache age and cache number
-        cache_age = 0
-        cache_num = 0
-        for index in range(args.num_car):
-            cache_num += len(local_cache[index])
-            for key in local_cache[index]:
-                cache_age += i-local_cache[index][key]['time']
+        cache_num, cache_age, cache_info = cache_table.get_statistics(i)
         avg_cache_age = cache_age/cache_num
         with open(model_dir+'/cache_age_cache_num_'+str(args.algorithm )+'_'+str(cache_size)+'_'+str(args.epoch_time)+'_'+str(args.kick_out)+'.txt','a') as file:
             file.write(str(i)+':')
             file.write(str(avg_cache_age)+'\t'+str(cache_num/args.num_car)+'\n')
+        with open(model_dir+'/log.txt','a') as file:
+            file.write('Model versions in memory: '+str(len(model_store))+' ('+str(round(model_store.get_memory()/1024**2,1))+' MB)\n')
         #########################
-        cache_info = np.zeros([args.num_car])
-        for index in range(args.num_car):
-            # cache_info_by_time[0][index] += 1 
-            cache_info[index] += 1
-            for key in local_cache[index]:
-                # print(local_cache[index][key]['time'])
-                cache_info[key] += 1
         with open(model_dir+'/cache_info.txt','a') as file:
             file.write('This is the round:'+str(i)+'\n')
             file.write(str(cache_info)+'\n')
         # do model aggregation
         print('Updated/aggregated model time/combination:')
         for index in range(num_car):
-            model[index] = cache_average_process(model[index],index,i,local_cache[index],weights)
+            model[index] = cache_average_process(model[index],index,i,cache_table.get_cache(index),weights)
            
             
         
@@ -695,7 +711,7 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
         # print('----------------------------------------------------------------------')
         print('Average test acc:',np.average(acc_global,axis=0)[-1])
         print('Variance test acc:',np.var(acc_global,axis=0)[-1])
-        print('pair:',pair[i])
+        print('pair:',pair.get_round(i).tolist())
         with open(model_dir+'/log.txt','a') as file:
             file.write('fresh_class_time_table\n')
             file.write(str(fresh_class_time_table)+'\n')
@@ -710,8 +726,8 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
                 # file.write(str(class_acc_list_before_aggregation[index][-1])+'\n')
                 file.write(str(class_acc_list[index][-1])+'\n')
                 file.write('Local Cache model version:'+'\n')
-                for key in local_cache[index]:
-                    file.write(str(key)+':'+str(local_cache[index][key]['time'])+'\n')#,local_cache[index][key]['fresh_metric'])
+                for key, value in cache_table.get_cache(index).items():
+                    file.write(str(key)+':'+str(value['time'])+'\n')#,local_cache[index][key]['fresh_metric'])
             file.write('----------------------------------------------------------------------'+'\n')
             file.write('Average test acc:'+str(np.average(acc_global,axis=0)[-1])+'\n')
             file.write('Variance test acc:'+str(np.var(acc_global,axis=0)[-1])+'\n')
@@ -733,6 +749,7 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
 def Decentralized_Cache_areas_process(suffix_dir,train_loader,test_loader,num_round,local_ep):
     model = []
     local_cache = []
+    model_store = ModelStore() # model versions referenced by local_cache
     acc_global = []
     acc_global_before_aggregation = []
     class_acc_list = []
@@ -749,6 +766,7 @@ def Decentralized_Cache_areas_process(suffix_dir,train_loader,test_loader,num_ro
     current_class_test = np.zeros([num_car,10])
     model_dir = './result/'+str(date_time.strftime('%Y-%m-%d %H_%M_%S'))+'_'+task+'_'+data_distribution+'_'+str(Randomseed)+'_'+args.algorithm+'_'+str(cache_size)+'_local_ep_'+str(local_ep)+'_epoch_time_'+str(args.epoch_time)+'_kick_out_'+str(args.kick_out) +suffix_dir
     pair,area = write_info(model_dir)
+    model_size = get_model_size(global_model) # bytes sent per model over the V2V link
 
 
     for i in range(1,size):
@@ -806,15 +824,15 @@ def Decentralized_Cache_areas_process(suffix_dir,train_loader,test_loader,num_ro
         # model_before_aggregation = copy.deepcopy(model)
         
         # mpi_test_host(model_before_aggregation, acc_global_before_aggregation, class_acc_list_before_aggregation,False,model_dir)
-        model_before_training = copy.deepcopy(model)
+        model_before_training = model_store.snapshot_round(i, model)
         if kick_out == True:
             for index in range(args.num_car):
                 local_cache[index] = kick_out_timeout_model(local_cache[index],i-args.kick_out)
             torch.cuda.empty_cache()
-        for seconds in range(args.epoch_time):
-            for a,b in pair[i*args.epoch_time+seconds]: 
+        for pair_info, duration_info in zip(pair.iter_round(i), pair.iter_round_duration(i)):
+            for (a,b), duration in zip(pair_info.tolist(), duration_info.tolist()): 
                 if car_type_list[a] == car_type_list[b] or car_type_list[a] == 0 or car_type_list[b] == 0: 
-                    update_model_cache(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out)
+                    update_model_cache(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out, get_max_transfer(duration, args.link_rate, model_size))
                 # if car_type_list[a] == car_type_list[b]: 
                 #     if car_type_list[a] != 0:
                 #         update_model_cache(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out)
@@ -896,7 +914,7 @@ def Decentralized_Cache_areas_process(suffix_dir,train_loader,test_loader,num_ro
         # print('----------------------------------------------------------------------')
         print('Average test acc:',np.average(acc_global,axis=0)[-1])
         print('Variance test acc:',np.var(acc_global,axis=0)[-1])
-        print('pair:',pair[i])
+        print('pair:',pair.get_round(i).tolist())
         with open(model_dir+'/log.txt','a') as file:
             file.write('fresh_class_time_table\n')
             file.write(str(fresh_class_time_table)+'\n')
@@ -935,6 +953,7 @@ def Decentralized_Cache_areas_process(suffix_dir,train_loader,test_loader,num_ro
 def Decentralized_Cache_areas_GB_process(suffix_dir,train_loader,test_loader,num_round,local_ep):
     model = []
     local_cache = []
+    model_store = ModelStore() # model versions referenced by local_cache
     acc_global = []
     acc_global_before_aggregation = []
     class_acc_list = []
@@ -1007,7 +1026,7 @@ def Decentralized_Cache_areas_GB_process(suffix_dir,train_loader,test_loader,num
         # model_before_aggregation = copy.deepcopy(model)
         
         # mpi_test_host(model_before_aggregation, acc_global_before_aggregation, class_acc_list_before_aggregation,False,model_dir)
-        model_before_training = copy.deepcopy(model)
+        model_before_training = model_store.snapshot_round(i, model)
         if kick_out == True:
             for index in range(args.num_car):
                 if len(local_cache[index])>cache_size:
@@ -1019,8 +1038,8 @@ def Decentralized_Cache_areas_GB_process(suffix_dir,train_loader,test_loader,num
                 #     if len(local_cache[index])>cache_size:
                 #         local_cache[index] = prune_cache(local_cache[index], type_limits_taxi, cache_size,'time','car_type')
             torch.cuda.empty_cache()
-        for seconds in range(args.epoch_time):
-            for a,b in pair[i*args.epoch_time+seconds]: 
+        for pair_info in pair.iter_round(i):
+            for a,b in pair_info.tolist(): 
                 if car_type_list[a] == car_type_list[b] or car_type_list[a] == 0 or car_type_list[b] == 0: 
                     update_model_cache_car_to_car_p(local_cache, model_before_training[a], model_before_training[b],a,b,i, cache_size, kick_out,car_area_list, type_limits_car)
                 # if car_type_list[a] == car_type_list[b]: 
@@ -1105,7 +1124,7 @@ def Decentralized_Cache_areas_GB_process(suffix_dir,train_loader,test_loader,num
         # print('----------------------------------------------------------------------')
         print('Average test acc:',np.average(acc_global,axis=0)[-1])
         print('Variance test acc:',np.var(acc_global,axis=0)[-1])
-        print('pair:',pair[i])
+        print('pair:',pair.get_round(i).tolist())
         with open(model_dir+'/log.txt','a') as file:
             # file.write('fresh_class_time_table\n')
             # file.write(str(fresh_class_time_table)+'\n')
@@ -25,6 +25,7 @@ from cache_algorithm import (
     update_model_cache_global, kick_out_timeout_model_cache_info,
     cache_average_process, 
     update_model_cache, update_model_cache_only_one,
+    get_model_size, get_max_transfer,
 )
 from aggregation import (
     average_weights, normal_training_process, normal_train,
@@ -38,7 +39,13 @@ from data_loader import (
     get_cifar10_iid,  get_cifar10_dirichlet, get_cifar10_non_iid,
     get_fashionmnist_area, get_fashionmnist_iid,  get_fashionmnist_dirichlet, get_fashionmnist_non_iid
 )
-from road_sim import generate_roadNet_pair_area_list
+from trace_store import load_or_generate_trace
+from road_sim import TraceStream, get_speed_list, parse_speed_class
+from trace_file import TraceWriter, write_trace_file
+from model_store import ModelStore, snapshot_models
+from cache_table import CacheTable
+from road_network import road_registry, AREA_METHODS
+from road_jit import set_jit
 import seed_setter
 
 # Set random seeds for reproducibility
@@ -86,6 +93,30 @@ parser.set_defaults(augment=True)
 parser.add_argument("--shards_allocation", nargs='+', type=int,
                     default=[3,2,1,3,2,1,1,4,1,2]*10, help="Shards allocation for non-iid data")
 parser.add_argument("--County", type=str, default="New York", help="County")
+parser.add_argument("--contact_backend", type=str, default='grid', choices=['dense', 'grid', 'kdtree'],
+                    help="Contact detection backend of the road simulation")
+parser.add_argument("--trace_dir", type=str, default="./trace_cache",
+                    help="Directory caching the mobility traces (empty string disables it)")
+parser.add_argument("--link_rate", type=float, default=0,
+                    help="V2V link rate in Mbit/s limiting the models exchanged per contact (0: unlimited)")
+parser.add_argument("--stream_trace", action='store_true',
+                    help="Simulate the mobility trace round by round while training instead of up front")
+parser.add_argument("--trace_prefetch", type=int, default=0,
+                    help="Rounds a background thread simulates ahead of training with --stream_trace")
+parser.add_argument("--road_data", nargs='+', type=str, default=[],
+                    help="Extra road csv files (StartLat/StartLong/EndLat/EndLong/Miles/County) to simulate on")
+parser.add_argument("--road_cache", type=str, default="./road_cache",
+                    help="Directory caching the preprocessed road networks")
+parser.add_argument("--gps_trace", type=str, default="",
+                    help="GPS log (csv/parquet with car_id, timestamp, lat, long) replacing the simulated fleet")
+parser.add_argument("--area_method", type=str, default='kmeans', choices=AREA_METHODS,
+                    help="Clustering of the road nodes into areas (minibatch/grid are faster on large graphs)")
+parser.add_argument("--speed_mix", nargs='+', type=parse_speed_class, default=[],
+                    help="Vehicle classes as share:mean:std of their speed (e.g. 0.1:8:1 0.3:15:3 0.6:13.59:2), replacing --speed")
+parser.add_argument("--fleet_init", type=str, default='sequential', choices=['sequential', 'vectorized'],
+                    help="Initial roads drawn car by car (original traces) or at once for large mixed fleets")
+parser.add_argument("--jit", action='store_true',
+                    help="Run the car movement and grid contact detection as Numba kernels (same traces)")
 parser.add_argument('--kick_out', type=int, default=3, help='Threshold round to kick out from cache')
 parser.add_argument("--weighted_aggregation", action='store_true', help="Enable weighted aggregation")
 parser.add_argument('--no-weighted_aggregation', dest='weighted_aggregation', action='store_false')
@@ -96,6 +127,10 @@ parser.add_argument("--algorithm", type=str, default='cache', choices=[
 ], help="Algorithm to run")
 
 args = parser.parse_args()
+road_registry.cache_dir = args.road_cache
+for road_file in args.road_data:
+    road_registry.add_csv(road_file)
+set_jit(args.jit)
 
 
 
@@ -128,11 +163,15 @@ def write_info(write_dir):
         file.write('num_car = ' + str(args.num_car) + '\n')
         file.write('epoch time = ' + str(args.epoch_time) + '\n')
         file.write('speed = ' + str(args.speed) + '\n')
+        if args.speed_mix:
+            file.write('speed_mix = ' + str(args.speed_mix) + '\n')
         file.write('communication_distance = ' + str(args.communication_distance) + '\n')
         file.write('cache_size = ' + str(args.cache_size) + '\n')
         file.write('shards_allocation = ' + str(args.shards_allocation) + '\n')
         file.write('Aggregation weights = ' + str(weights) + '\n')
         file.write('County = ' + str(args.County) + '\n')
+        file.write('contact_backend = ' + str(args.contact_backend) + '\n')
+        file.write('link_rate = ' + str(args.link_rate) + '\n')
         file.write('kick_out = ' + str(args.kick_out) + '\n')
         file.write('alpha = ' + str(alpha) + '\n')
         file.write('Data distribution among cars:\n')
@@ -141,21 +180,22 @@ def write_info(write_dir):
         file.write(str(data_similarity) + '\n')
         file.write('Data_points:\n' + str(data_points) + '\n')
 
-    # Generate pair & area from road network simulation
-    pair, area = generate_roadNet_pair_area_list(
-        write_dir, num_car, num_round, args.communication_distance,
-        args.epoch_time, args.speed, args.County, 10, car_type_list
+    # Generate pair & area from road network simulation (or load them from the trace store)
+    speed = get_speed_list(num_car, args.speed_mix, Randomseed) if args.speed_mix else args.speed
+    pair, area = load_or_generate_trace(
+        args.trace_dir, write_dir, num_car, num_round, args.communication_distance,
+        args.epoch_time, speed, args.County, 10, car_type_list,
+        args.contact_backend, Randomseed, args.stream_trace, args.trace_prefetch, args.gps_trace,
+        args.area_method, args.fleet_init
     )
-    with open(os.path.join(write_dir, 'pair.txt'), 'w') as file:
-        for i in range(num_round):
-            file.write('Round:' + str(i) + ': \n')
-            for j in range(args.epoch_time):
-                file.write('Seconds:' + str(j) + ': \n')
-                file.write(str(pair[i*args.epoch_time + j]) + '\n')
-    with open(os.path.join(write_dir, 'area.txt'), 'w') as file:
-        for i in range(num_car):
-            file.write('Car:' + str(i) + ': ')
-            file.write(str(area[i]) + '\n')
+    # the trace of the run goes to trace.bin/trace.idx, read it back with trace_file.py
+    trace_path = os.path.join(write_dir, 'trace.bin')
+    if isinstance(pair, TraceStream):
+        # rounds are logged as they are simulated
+        trace_writer = TraceWriter(trace_path, num_car, args.epoch_time)
+        pair.on_round = lambda round_index, round_trace: trace_writer.write_round(round_trace, round_index)
+        return pair, area
+    write_trace_file(trace_path, pair)
     return pair, area
 
 
@@ -399,8 +439,9 @@ def Decentralized_process(suffix_dir,train_loader,test_loader,num_round,local_ep
         # do model update
         time_a = time.time()
         receiver_buffer = {}
-        for seconds in range(args.epoch_time):
-            for a,b in pair[i*args.epoch_time+seconds]: 
+        model_before_training = snapshot_models(model)
+        for pair_info in pair.iter_round(i):
+            for a,b in pair_info.tolist(): 
                 if distribution == 'area':
                     if car_type_list[a] == car_type_list[b] or car_type_list[a] == 0 or car_type_list[b] == 0: 
                         receiver_buffer[a] = b
@@ -437,7 +478,7 @@ def Decentralized_process(suffix_dir,train_loader,test_loader,num_round,local_ep
 
         avg_acc = np.average(acc_global, axis=0)[-1]
         print('Average test acc:', avg_acc)
-        print('Pairs in this round:', pair[i])
+        print('Pairs in this round:', pair.get_round(i).tolist())
 
         # update LR
         for index in range(num_car):
@@ -477,7 +518,8 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
     Decentralized FL with a model cache that can hold up to 'cache_size' models for each node.
     """
     model = []
-    local_cache = []
+    model_store = ModelStore() # model versions referenced by cache_table
+    cache_table = CacheTable(num_car, model_store) # the caches of all cars
     acc_global = []
     class_acc_list = []
     acc_local = []
@@ -495,11 +537,11 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
         Randomseed, args.algorithm, str(cache_size) + suffix_dir
     )
     pair, area = write_info(model_dir)
+    model_size = get_model_size(global_model) # bytes sent per model over the V2V link
 
     # Init
     for i in range(num_car):
         model.append(copy.deepcopy(global_model).to(device))
-        local_cache.append({})
         optimizer[i] = optim.SGD(params=model[i].parameters(), lr=learning_rate)
         scheduler[i] = ReduceLROnPlateau(optimizer[i], mode='max', factor=args.lr_factor, patience=args.lr_patience, verbose=False)
         acc_global.append([])
@@ -526,19 +568,18 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
                                     train_loader[index], local_ep, loss_list[index])
             fresh_class_time_table[index][index] = i
 
-        model_before_training = copy.deepcopy(model)
+        model_before_training = model_store.snapshot_round(i, model)
 
         # Exchange caches over each second in the round
-        for seconds in range(args.epoch_time):
-            for a, b in pair[i * args.epoch_time + seconds]:
-                update_model_cache(local_cache, model_before_training[a],
-                                   model_before_training[b], a, b, i,
-                                   cache_size, kick_out)
+        for pair_info, duration_info in zip(pair.iter_round(i), pair.iter_round_duration(i)):
+            for (a, b), duration in zip(pair_info.tolist(), duration_info.tolist()):
+                cache_table.exchange(a, b, i, cache_size, get_max_transfer(duration, args.link_rate, model_size))
+        cache_table.release()
 
         # After exchanging, do cache-based model aggregation
         for index in range(num_car):
             model[index] = cache_average_process(model[index], index, i,
-                                                      local_cache[index], weights)
+                                                      cache_table.get_cache(index), weights)
             model[index].to(device)
 
         # Evaluate
@@ -556,6 +597,7 @@ def Decentralized_Cache_process(suffix_dir,train_loader,test_loader,num_round,lo
                 file.write(f'{idx}:{class_acc_list[idx][-1]}\n')
             file.write(f'{end_time - start_time:.2f} sec this round\n')
             file.write('Average test acc:' + str(avg_acc) + '\n')
+            file.write(f'Model versions in memory: {len(model_store)} ({model_store.get_memory() / 1024**2:.1f} MB)\n')
 
         fn_name = f'average_acc_{task}_{distribution}_{Randomseed}_{args.algorithm}_{cache_size}{suffix_dir}.txt'
         with open(os.path.join(model_dir, fn_name), 'a') as file:
@@ -580,6 +622,7 @@ def Decentralized_Cache_test_area():
     """
     model = []
     local_cache = []
+    model_store = ModelStore() # model versions referenced by local_cache
     acc_global = []
     acc_global_before_aggregation = []
     class_acc_list = []
@@ -589,6 +632,7 @@ def Decentralized_Cache_test_area():
     optimizer = []
     model_dir = './result/test/taxi'
     pair,area = write_info(model_dir)
+    model_size = get_model_size(global_model) # bytes sent per model over the V2V link
 
     for i in range(num_car):
         local_cache.append({})
@@ -607,15 +651,15 @@ def Decentralized_Cache_test_area():
         for ep in range(local_ep):
             start_time = time.time()
             
-            model_before_training = copy.deepcopy(model)
+            model_before_training = model_store.snapshot_round(i, model)
             if kick_out == True:
                 for index in range(num_car):
                     local_cache[index] = kick_out_timeout_model(local_cache[index],i-args.kick_out)
                     
-            for seconds in range(args.epoch_time):
-                for a,b in pair[i*args.epoch_time+seconds]: 
+            for pair_info, duration_info in zip(pair.iter_round(i), pair.iter_round_duration(i)):
+                for (a,b), duration in zip(pair_info.tolist(), duration_info.tolist()): 
                     if car_type_list[a] == car_type_list[b] or car_type_list[a] == 0 or car_type_list[b] == 0: 
-                        update_model_cache(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out)
+                        update_model_cache(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out, get_max_transfer(duration, args.link_rate, model_size))
             cache_info = np.zeros([num_car])
             for index in range(num_car):
                 # cache_info_by_time[0][index] += 1 
@@ -646,6 +690,7 @@ def Decentralized_Cache_test_area_GB():
     """
     model = []
     local_cache = []
+    model_store = ModelStore() # model versions referenced by local_cache
     acc_global = []
     acc_global_before_aggregation = []
     class_acc_list = []
@@ -673,13 +718,13 @@ def Decentralized_Cache_test_area_GB():
         print('This is the round:',i)
         for ep in range(local_ep):
 
-            model_before_training = copy.deepcopy(model)
+            model_before_training = model_store.snapshot_round(i, model)
             if kick_out == True:
                 for index in range(num_car):
                     local_cache[index] = kick_out_timeout_model(local_cache[index],i-args.kick_out)
                     
-            for seconds in range(args.epoch_time):
-                for a,b in pair[i*args.epoch_time+seconds]: 
+            for pair_info in pair.iter_round(i):
+                for a,b in pair_info.tolist(): 
                     if car_type_list[a] == car_type_list[b] or car_type_list[a] == 0 or car_type_list[b] == 0: 
                         update_model_cache_car_to_car_p(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out,car_area_list, type_limits_car)
                     # if car_type_list[a] == car_type_list[b]: 
@@ -735,7 +780,8 @@ def Decentralized_Cache_test():
     Another test function that loops but doesn't do real multi-threading.
     """
     model = []
-    local_cache = []
+    model_store = ModelStore() # model versions referenced by cache_table
+    cache_table = CacheTable(num_car, model_store) # the caches of all cars
     acc_global = []
     acc_global_before_aggregation = []
     class_acc_list = []
@@ -745,9 +791,9 @@ def Decentralized_Cache_test():
     optimizer = []
     model_dir = './result/test/cache'
     pair,area = write_info(model_dir)
+    model_size = get_model_size(global_model) # bytes sent per model over the V2V link
 
     for i in range(num_car):
-        local_cache.append({})
         model.append(copy.deepcopy(global_model))
         optimizer.append(optim.SGD(params=model[i].parameters(), lr=lr))
         acc_global.append([])
@@ -756,8 +802,6 @@ def Decentralized_Cache_test():
         class_acc_list_before_aggregation.append([])
         acc_local.append([])
         loss.append([])
-    for i in range(10):
-        local_cache.append({})
     cache_info_dynamic = np.ones([num_car])
     for i in range(num_round):
         # old_model = copy.deepcopy(model)
@@ -766,27 +810,15 @@ def Decentralized_Cache_test():
         for ep in range(local_ep):
             start_time = time.time()
             
-            model_before_training = copy.deepcopy(model)
+            model_before_training = model_store.snapshot_round(i, model)
             if kick_out == True:
-                for index in range(num_car):
-                    local_cache[index] = kick_out_timeout_model(local_cache[index],i-args.kick_out)
+                cache_table.kick_out(i-args.kick_out)
                     
-            for seconds in range(args.epoch_time):
-                for a,b in pair[i*args.epoch_time+seconds]: 
-                    update_model_cache(local_cache, model_before_training[a],model_before_training[b],a,b,i, cache_size, kick_out)
-            cache_info = np.zeros([num_car])
-            for index in range(num_car):
-                # cache_info_by_time[0][index] += 1 
-                cache_info[index] += 1
-                for key in local_cache[index]:
-                    # print(local_cache[index][key]['time'])
-                    cache_info[key] += 1
-            cache_age = 0
-            cache_num = 0
-            for index in range(num_car):
-                cache_num += len(local_cache[index])
-                for key in local_cache[index]:
-                    cache_age += i-local_cache[index][key]['time']
+            for pair_info, duration_info in zip(pair.iter_round(i), pair.iter_round_duration(i)):
+                for (a,b), duration in zip(pair_info.tolist(), duration_info.tolist()): 
+                    cache_table.exchange(a,b,i, cache_size, get_max_transfer(duration, args.link_rate, model_size))
+            cache_table.release()
+            cache_num, cache_age, cache_info = cache_table.get_statistics(i)
             avg_cache_age = cache_age/cache_num
             with open(model_dir+'/cache_age_cache_num_'+str('cache' )+'_'+str(cache_size)+'_'+str(args.epoch_time)+'_'+str(args.kick_out)+'.txt','a') as file:
                 file.write(str(i)+':')
@@ -1 +1,670 @@
 #to be developed, currently you can excute trainer_single.py ot trainer_mpi.py with argparse directly
+
+import os
+import random
+from copy import deepcopy
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+import torch
+from torch import nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cached_dfl'))
+
+import cache_algorithm
+import cache_table
+import contact_analysis
+import gps_trace
+import model_store
+import road_jit
+import road_network
+import road_sim
+import seed_setter
+import trace_file
+import trace_store
+
+
+def simulate(num_car, car_type_list, num_round = 2, step_time = 30):
+    np.random.seed(10086)
+    random.seed(10086)
+    trace, _ = road_sim.generate_roadNet_pair_area_list(None, num_car, num_round, 100, step_time, 13.59, 'New York', 10, car_type_list)
+    return trace
+
+
+def test_jit_kernels_give_identical_traces(tmp_path, monkeypatch):
+    # the kernels run compiled with Numba and as plain Python without it, both must match NumPy
+    monkeypatch.setattr(road_network, 'road_registry', road_network.RoadNetworkRegistry(
+        [os.path.join(road_network.DATA_DIR, 'NewYork.csv')], str(tmp_path)))
+    car_type_list = [0, 1, 0, 2, 3] * 8
+    monkeypatch.setattr(road_jit, 'JIT_ENABLED', False)
+    expected = simulate(len(car_type_list), car_type_list)
+    monkeypatch.setattr(road_jit, 'JIT_ENABLED', True)
+    result = simulate(len(car_type_list), car_type_list)
+    for name in ['offsets', 'pairs', 'area', 'duration', 'distance']:
+        assert np.array_equal(getattr(expected, name), getattr(result, name))
+
+
+def evict_in_loop(d, capacity, term):
+    while len(d) > capacity:
+        d = cache_algorithm.delete_smallest_value(d, term)
+    return d
+
+
+def test_evict_to_capacity_matches_delete_smallest_value():
+    rng = random.Random(0)
+    for term in ['time', 'fresh', 'cache_score']:
+        for _ in range(50):
+            # distinct terms, so that the old loop deletes the same entries
+            values = iter(rng.sample(range(1000), 1000))
+            old = {car: {term: next(values)} for car in rng.sample(range(30), rng.randint(1, 20))}
+            new = {car: dict(value) for car, value in old.items()}
+            for _ in range(5):
+                capacity = rng.randint(0, 10)
+                old = evict_in_loop(old, capacity, term)
+                new = cache_algorithm.evict_to_capacity(new, capacity, term)
+                assert new == old
+                # the update functions change terms in place and add entries between evictions
+                for car in old:
+                    if rng.random() < 0.3:
+                        old[car][term] = new[car][term] = next(values)
+                for car in rng.sample(range(30, 60), rng.randint(0, 5)):
+                    value = next(values)
+                    old[car], new[car] = {term: value}, {term: value}
+        for _ in range(50):
+            # with ties only the terms kept are the same
+            old = {car: {term: rng.randint(0, 3)} for car in range(rng.randint(1, 20))}
+            new = {car: dict(value) for car, value in old.items()}
+            capacity = rng.randint(0, 10)
+            old = evict_in_loop(old, capacity, term)
+            new = cache_algorithm.evict_to_capacity(new, capacity, term)
+            assert sorted(value[term] for value in new.values()) == sorted(value[term] for value in old.values())
+
+
+def test_evict_to_capacity_sees_terms_changed_in_place():
+    cache = {'A': {'cache_score': 5}, 'B': {'cache_score': 3}, 'C': {'cache_score': 4}}
+    cache = cache_algorithm.evict_to_capacity(cache, 2, 'cache_score')
+    assert sorted(cache) == ['A', 'C']
+    cache['A']['cache_score'] = 1
+    cache['D'] = {'cache_score': 6}
+    cache = cache_algorithm.evict_to_capacity(cache, 2, 'cache_score')
+    assert sorted(cache) == ['C', 'D']
+
+
+def test_evict_random_and_global_match_the_loops():
+    rng = random.Random(0)
+    for _ in range(100):
+        cars = rng.sample(range(30), rng.randint(1, 20))
+        capacity = rng.randint(0, 10)
+        old = {car: {'time': rng.randint(0, 5)} for car in cars}
+        new = cache_algorithm.evict_random(dict(old), capacity, rng)
+        while len(old) > capacity:
+            old = cache_algorithm.delete_random(old)
+        assert len(new) == len(old) and set(new) <= set(cars)
+        # distinct counts, so that the old loop deletes the same entries
+        counts = rng.sample(range(2, 100), len(cars))
+        old = {car: {'time': rng.randint(0, 5)} for car in cars}
+        old_info = dict(zip(cars, counts))
+        new, new_info = cache_algorithm.evict_cache_global(dict(old), capacity, dict(old_info), rng)
+        while len(old) > capacity:
+            old, old_info = cache_algorithm.delete_cache_global(old, old_info)
+        assert new == old and new_info == old_info
+
+
+def test_cache_table_matches_local_cache():
+    # meetings (a, b, max_transfer) per round, one meeting a round keeps the evictions free of ties
+    meetings = [[(0, 1, None)], [(1, 2, None)], [(2, 3, None)], [(0, 3, None)], [(1, 3, None)],
+                [(4, 0, 2)], [(2, 4, None)], [(3, 4, 1)], [(1, 4, None)], [(0, 2, 2)]]
+    num_car, cache_size, kick_out = 5, 2, 4
+    local_cache = [{} for _ in range(num_car)]
+    store = model_store.ModelStore()
+    table = cache_table.CacheTable(num_car, store)
+    networks = get_small_models(num_car)
+    for i, round_meetings in enumerate(meetings):
+        models = store.snapshot_round(i, networks)
+        for index in range(num_car):
+            local_cache[index] = cache_algorithm.kick_out_timeout_model(local_cache[index], i - kick_out)
+        table.kick_out(i - kick_out)
+        for a, b, max_transfer in round_meetings:
+            cache_algorithm.update_model_cache(local_cache, models[a], models[b], a, b, i, cache_size, True, max_transfer)
+            table.exchange(a, b, i, cache_size, max_transfer)
+        table.release()
+        assert [table.get_cache(index) for index in range(num_car)] == local_cache
+        # the table pins exactly the versions it refers to, the store is their only owner
+        assert set(store.pinned) == {(key, value['time']) for cache in local_cache for key, value in cache.items()}
+        cache_info = np.ones(num_car)
+        for index in range(num_car):
+            for key in local_cache[index]:
+                cache_info[key] += 1
+        cache_num, cache_age, table_info = table.get_statistics(i)
+        assert cache_num == sum(len(cache) for cache in local_cache)
+        assert cache_age == sum(i - value['time'] for cache in local_cache for value in cache.values())
+        assert np.array_equal(table_info, cache_info)
+    # without the other references, the store keeps just the pinned versions
+    del models, local_cache
+    assert set(store.versions.keys()) == set(store.pinned)
+
+
+def test_gps_log_of_the_simulation_gives_its_meetings(tmp_path, monkeypatch):
+    # a per-second log of the simulated fleet, read in one chunk that spans all the rounds
+    monkeypatch.setattr(road_network, 'road_registry', road_network.RoadNetworkRegistry(
+        [os.path.join(road_network.DATA_DIR, 'NewYork.csv')], str(tmp_path)))
+    num_car, num_round, step_time = 60, 10, 60
+    fixes = []
+    move = road_sim.Fleet.move
+
+    def record_move(fleet, time):
+        move(fleet, time)
+        fixes.append(fleet.current_position.copy())
+
+    monkeypatch.setattr(road_sim.Fleet, 'move', record_move)
+    expected = simulate(num_car, [0] * num_car, num_round, step_time)
+    fixes = np.array(fixes)
+    log_path = str(tmp_path / 'gps.csv')
+    pd.DataFrame({'car_id': np.tile(np.arange(num_car), len(fixes)),
+                  'timestamp': np.repeat(np.arange(len(fixes)), num_car),
+                  'lat': fixes[:, :, 1].ravel(), 'long': fixes[:, :, 0].ravel()}).to_csv(log_path, index=False)
+    result, _ = gps_trace.import_gps_pair_area_list(None, log_path, num_car, num_round, 100, step_time)
+    assert len(expected.pairs) > 0
+    for round_index in range(num_round):
+        # the meetings of a second are in random order
+        for expected_pairs, pairs in zip(expected.iter_round(round_index), result.iter_round(round_index)):
+            assert sorted(map(tuple, pairs.tolist())) == sorted(map(tuple, expected_pairs.tolist()))
+
+
+def test_trainer_finds_the_batch_traces(tmp_path, monkeypatch):
+    monkeypatch.setattr(road_network, 'road_registry', road_network.RoadNetworkRegistry(
+        [os.path.join(road_network.DATA_DIR, 'NewYork.csv')], str(tmp_path)))
+    trace_dir = str(tmp_path / 'traces')
+    [path] = trace_store.generate_trace_batch([{'num_car': 10, 'num_round': 2, 'step_time': 30}], trace_dir, 1)
+    # the data loaders draw from the global streams before the trace is loaded
+    np.random.seed(1)
+    np.random.random_sample(5)
+    random.random()
+    pair, area = trace_store.load_or_generate_trace(trace_dir, str(tmp_path), 10, 2, 100, 30, car_type_list=[0] * 10,
+                                                   seed=seed_setter.SEED)
+    assert os.listdir(trace_dir) == [os.path.basename(path)]
+    np_state, py_state = np.random.get_state(), random.getstate()
+    expected, _ = trace_store.load_or_generate_trace('', str(tmp_path), 10, 2, 100, 30, car_type_list=[0] * 10,
+                                                      seed=seed_setter.SEED)
+    for name in ['offsets', 'pairs', 'area', 'duration', 'distance']:
+        assert np.array_equal(getattr(expected, name), getattr(pair, name))
+    # the run goes on with the same random streams as after the simulation
+    assert np.array_equal(np.random.get_state()[1], np_state[1]) and random.getstate() == py_state
+
+
+def get_toy_road():
+    # a jittered 5x5 grid with a dead end at node 25, two areas and the starting road of every car
+    rng = np.random.RandomState(0)
+    x, y = np.meshgrid(np.arange(5), np.arange(5), indexing='ij')
+    pos_list = np.concatenate([np.stack([x.ravel(), y.ravel()], axis=1) + rng.uniform(-0.2, 0.2, (25, 2)), [[-1.0, 0.0]]])
+    edges = [(a, a + 1) for a in range(25) if a % 5 != 4] + [(a, a + 5) for a in range(20)] + [(0, 25)]
+    row, col = np.array(edges).T
+    adj_matrix = csr_matrix((np.ones(2 * len(edges)), (np.concatenate([row, col]), np.concatenate([col, row]))), shape=(26, 26))
+    area_labels = (pos_list[:, 0] > 2).astype(int)
+    adj_matrix_area = road_sim.filter_edges_by_group(adj_matrix, area_labels)
+    car_type = np.array([0, 1, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0])
+    speed = rng.uniform(0.05, 0.2, len(car_type))
+    source = rng.randint(0, 26, len(car_type))
+    source[car_type != 0] = rng.choice([15, 16, 20, 21], np.count_nonzero(car_type))
+    destination = np.array([rng.choice(road_sim.get_neighbors(adj_matrix_area if car_type[k] else adj_matrix, node))
+                            for k, node in enumerate(source)])
+    return pos_list, adj_matrix, adj_matrix_area, car_type, speed, source, destination
+
+
+def test_fleet_matches_car_objects():
+    pos_list, adj_matrix, adj_matrix_area, car_type, car_speed, source, destination = get_toy_road()
+    # one speed per car, and one speed for the whole fleet as the trainers pass it
+    for speed in [car_speed, 0.13]:
+        np.random.seed(10086)
+        car_list = [road_sim.Car(source[k], destination[k], np.broadcast_to(speed, len(car_type))[k], pos_list,
+                                 adj_matrix, adj_matrix_area, car_type[k]) for k in range(len(car_type))]
+        fleet = road_sim.Fleet(source, destination, speed, pos_list, adj_matrix, adj_matrix_area, car_type,
+                               np.random.RandomState(10086))
+        turns = 0
+        for _ in range(300):
+            for car in car_list:
+                car.move(1)
+            previous_source = fleet.source.copy()
+            fleet.move(1)
+            turns += np.count_nonzero(fleet.source != previous_source)
+            assert np.array_equal(fleet.source, [car.source for car in car_list])
+            assert np.array_equal(fleet.destination, [car.destination for car in car_list])
+            assert np.allclose(fleet.current_position, [car.current_position for car in car_list], rtol=0, atol=1e-12)
+        # the cars took many turns and drew the same random numbers
+        assert turns > 100
+        assert not np.array_equal(fleet.np_rng.get_state()[1], np.random.RandomState(10086).get_state()[1])
+        assert np.array_equal(np.random.get_state()[1], fleet.np_rng.get_state()[1])
+        assert np.random.get_state()[2] == fleet.np_rng.get_state()[2]
+
+
+def test_contact_backends_match_the_dense_meeting_table():
+    pos_list, adj_matrix, adj_matrix_area, car_type, speed, source, destination = get_toy_road()
+    num_car, circle_radius, step_time = len(car_type), 0.6, 60
+    # the original loop: Car objects and a dense meeting table, reset every step_time seconds
+    np.random.seed(10086)
+    car_list = [road_sim.Car(source[k], destination[k], speed[k], pos_list, adj_matrix, adj_matrix_area, car_type[k])
+                for k in range(num_car)]
+    expected = []
+    for second in range(300):
+        if second % step_time == 0:
+            meeting_record = np.zeros([num_car, num_car])
+        for car in car_list:
+            car.move(1)
+        car_position = np.array([car.current_position for car in car_list])
+        distance = np.sqrt(np.sum((car_position[:, np.newaxis, :] - car_position[np.newaxis, :, :]) ** 2, axis=-1))
+        pair = []
+        for x, y in zip(*np.where(distance < circle_radius)):
+            if x < y and meeting_record[x][y] == 0:
+                pair.append((x, y))
+                meeting_record[x][y] = 1
+        for x, y in zip(*np.where(distance > circle_radius)):
+            if x < y:
+                meeting_record[x][y] = 0
+        expected.append(sorted(pair))
+    assert sum(len(pair) for pair in expected) > 20
+    for backend in ['dense', 'grid', 'kdtree']:
+        fleet = road_sim.Fleet(source, destination, speed, pos_list, adj_matrix, adj_matrix_area, car_type,
+                               np.random.RandomState(10086))
+        for second in range(300):
+            if second % step_time == 0:
+                meeting_record = road_sim.MeetingRecord(num_car)
+            fleet.move(1)
+            i, j = road_sim.get_pairs_in_range(fleet.current_position, circle_radius, backend)
+            pair = road_sim.record_meetings(fleet.current_position, i, j, meeting_record, circle_radius,
+                                            second % step_time, random.Random(second))
+            assert sorted(map(tuple, pair.tolist())) == expected[second], (backend, second)
+
+
+def test_pair_backends_match_the_dense_distance_matrix(monkeypatch):
+    rng = np.random.RandomState(0)
+    circle_radius = 0.25
+    for _ in range(20):
+        # random cars, cars on cell boundaries, and pairs exactly circle_radius apart
+        uniform = rng.uniform(-2, 2, (200, 2))
+        boundary = rng.randint(-8, 8, (100, 2)) * circle_radius
+        boundary[::2, 0] += rng.uniform(0, circle_radius, 50)
+        at_radius = np.concatenate([boundary[:50] + [circle_radius, 0], boundary[:50] + [0, -circle_radius],
+                                    boundary[:50] + [0.15, 0.2]])
+        car_position = np.concatenate([uniform, boundary, at_radius])[rng.permutation(450)]
+        expected = road_sim.get_pairs_in_range(car_position, circle_radius, 'dense')
+        distance = road_sim.get_pair_distance(car_position, *road_sim.get_pairs_kdtree(car_position, 2 * circle_radius))
+        assert np.any(distance == circle_radius)
+        for jit in [False, True]:
+            monkeypatch.setattr(road_jit, 'JIT_ENABLED', jit)
+            for backend in ['grid', 'kdtree']:
+                i, j = road_sim.get_pairs_in_range(car_position, circle_radius, backend)
+                assert np.array_equal(i, expected[0]) and np.array_equal(j, expected[1])
+
+
+def get_rng_state():
+    np_state = np.random.get_state()
+    return np_state[1].tolist(), np_state[2:], random.getstate()
+
+
+def test_trace_store_loads_the_stored_trace(tmp_path, monkeypatch):
+    monkeypatch.setattr(road_network, 'road_registry', road_network.RoadNetworkRegistry(
+        [os.path.join(road_network.DATA_DIR, 'NewYork.csv')], str(tmp_path)))
+    trace_dir = str(tmp_path / 'traces')
+    # with a seed, and keyed on the global random state without one
+    for seed in [seed_setter.SEED, None]:
+        np.random.seed(7)
+        random.seed(7)
+        start_state = (np.random.get_state(), random.getstate())
+        generated, _ = trace_store.load_or_generate_trace(trace_dir, str(tmp_path), 10, 2, 100, 30,
+                                                          car_type_list=[0] * 10, seed=seed)
+        state = get_rng_state()
+        stored = os.listdir(trace_dir)
+        np.random.set_state(start_state[0])
+        random.setstate(start_state[1])
+        loaded, _ = trace_store.load_or_generate_trace(trace_dir, str(tmp_path), 10, 2, 100, 30,
+                                                       car_type_list=[0] * 10, seed=seed)
+        assert os.listdir(trace_dir) == stored
+        for name in ['offsets', 'pairs', 'area', 'duration', 'distance']:
+            assert np.array_equal(getattr(generated, name), getattr(loaded, name))
+        # the run goes on with the random streams it would have had after simulating
+        assert get_rng_state() == state
+    assert len(os.listdir(trace_dir)) == 2
+    with open(str(tmp_path / 'configuration.txt')) as file:
+        assert file.read().count('Mobility trace loaded from') == 2
+
+
+def test_trace_key_changes_with_every_field():
+    config = dict(County='New York', num_car=10, num_round=2, epoch_time=30, speed=13.59, communication_distance=100,
+                  num_area=10, car_type_list=[0] * 10, seed=seed_setter.SEED)
+    changes = [{'car_type_list': [0] * 9 + [1]}, {'seed': 1}, {'speed': 10.0}, {'speed': [13.59] * 9 + [10.0]},
+               {'num_car': 9, 'car_type_list': [0] * 9}, {'num_round': 3}, {'epoch_time': 60},
+               {'communication_distance': 50}, {'num_area': 5}, {'County': 'Other'}, {'rng_fingerprint': 'x'},
+               {'road_net': 'x'}, {'gps': 'x'}, {'area_method': 'grid'}, {'fleet_init': 'vectorized'}]
+    keys = [trace_store.get_trace_key(**config)] + [trace_store.get_trace_key(**dict(config, **change)) for change in changes]
+    assert len(set(keys)) == len(keys)
+    # car types beyond num_car are not part of the configuration
+    assert trace_store.get_trace_key(**dict(config, car_type_list=[0] * 12)) == keys[0]
+
+
+def test_cosine_similarity_of_a_zero_length_road(capsys):
+    assert road_sim.cosine_similarity(np.zeros(2), np.array([1.0, 2.0])) == 0.0
+    assert road_sim.cosine_similarity(np.array([1.0, 0.0]), np.array([0.0, 3.0])) == 0.0
+    assert capsys.readouterr().out == ''
+
+
+def test_trace_stream_matches_the_generated_trace(tmp_path, monkeypatch):
+    monkeypatch.setattr(road_network, 'road_registry', road_network.RoadNetworkRegistry(
+        [os.path.join(road_network.DATA_DIR, 'NewYork.csv')], str(tmp_path)))
+    car_type_list = [0, 1, 0, 2, 3] * 4
+    expected = simulate(len(car_type_list), car_type_list, 3, 30)
+    expected_state = get_rng_state()
+    for prefetch in [0, 2]:
+        np.random.seed(10086)
+        random.seed(10086)
+        start_state = get_rng_state()
+        trace, area = road_sim.stream_roadNet_pair_area_list(None, len(car_type_list), 3, 100, 30, 13.59, 'New York', 10,
+                                                             car_type_list, prefetch=prefetch)
+        for round_index in range(3):
+            assert np.array_equal(trace.get_round(round_index), expected.get_round(round_index))
+            for pairs, expected_pairs in zip(trace.iter_round(round_index), expected.iter_round(round_index)):
+                assert np.array_equal(pairs, expected_pairs)
+            for duration, expected_duration in zip(trace.iter_round_duration(round_index),
+                                                   expected.iter_round_duration(round_index)):
+                assert np.array_equal(duration, expected_duration)
+        assert np.array_equal(area, expected.area)
+        if prefetch:
+            trace.thread.join()
+        # the simulation ends in the state of the global streams after generating, which it leaves alone
+        np_state = trace.np_rng.get_state()
+        assert (np_state[1].tolist(), np_state[2:], trace.py_rng.getstate()) == expected_state
+        assert get_rng_state() == start_state
+
+
+def test_area_labels_are_clustered_once(tmp_path, monkeypatch):
+    csv_files = [os.path.join(road_network.DATA_DIR, 'NewYork.csv')]
+    road_net = road_network.RoadNetworkRegistry(csv_files, str(tmp_path)).get('New York')
+    areas = {method: road_net.get_areas(10, seed_setter.SEED, method) for method in road_network.AREA_METHODS}
+    assert all(road_net.get_areas(10, seed_setter.SEED, method) is areas[method] for method in areas)
+    fresh = {method: road_network.cluster_areas(road_net.pos_array, 10, seed_setter.SEED, method) for method in areas}
+
+    # a new run loads the labels of every method from the road cache instead of clustering again
+    def cluster_areas(*args, **kwargs):
+        raise AssertionError('the area labels were clustered again')
+
+    monkeypatch.setattr(road_network, 'cluster_areas', cluster_areas)
+    road_net = road_network.RoadNetworkRegistry(csv_files, str(tmp_path)).get('New York')
+    for method in areas:
+        labels, centers = road_net.get_areas(10, seed_setter.SEED, method)
+        assert np.array_equal(labels, fresh[method][0]) and np.array_equal(centers, fresh[method][1])
+        assert sorted(np.unique(labels)) == list(range(10))
+    # the grid areas hold almost the same number of nodes
+    count = np.bincount(road_net.get_area_labels(10, seed_setter.SEED, 'grid'))
+    assert count.max() - count.min() <= 2
+
+
+def get_naive_reachability(trace, round_index):
+    # earliest arrival second with at most k hops, for k = 1, 2, ..., of the models of round_index
+    meetings = [(second, a, b) for second in range(round_index * trace.epoch_time, len(trace))
+                for a, b in trace[second].tolist()]
+    never = len(meetings)
+    arrival = np.full((trace.num_car, trace.num_car), -1)
+    hops = np.zeros((trace.num_car, trace.num_car), dtype=int)
+    for i in range(trace.num_car):
+        # index of the meeting after which a car holds the model, -1 for the car that trained it
+        held = [never] * trace.num_car
+        held[i] = -1
+        for k in range(1, trace.num_car):
+            new_held = list(held)
+            for index, (second, a, b) in enumerate(meetings):
+                for car, other in ((a, b), (b, a)):
+                    if held[other] < index < new_held[car]:
+                        new_held[car] = index
+            for j in range(trace.num_car):
+                # the fewest hops are those of the first k that reaches the earliest second
+                if j != i and new_held[j] < never and (arrival[i, j] < 0 or meetings[new_held[j]][0] < arrival[i, j]):
+                    arrival[i, j], hops[i, j] = meetings[new_held[j]][0], k
+            held = new_held
+    return np.where(arrival >= 0, arrival // trace.epoch_time - round_index, -1), hops
+
+
+def test_reachability_matches_a_naive_search():
+    rng = np.random.RandomState(0)
+    num_car, num_round, epoch_time = 6, 4, 5
+    pair_list = []
+    for _ in range(num_round * epoch_time):
+        pair_list.append([tuple(rng.choice(num_car, 2, replace=False)) for _ in range(rng.randint(0, 3))])
+    trace = road_sim.ContactTrace.from_pair_list(pair_list, np.zeros((num_car, num_round * epoch_time)), epoch_time)
+    rounds = list(contact_analysis.iter_reachability(trace))
+    assert [round_index for round_index, _, _ in rounds] == list(range(num_round - 1, -1, -1))
+    for round_index, delay, hops in rounds:
+        expected_delay, expected_hops = get_naive_reachability(trace, round_index)
+        assert np.array_equal(delay, expected_delay) and np.array_equal(hops, expected_hops)
+    assert np.any(rounds[-1][2] > 1)
+
+
+def get_hand_built_trace():
+    # the contacts of 0-1 are [0, 2), [3, 4), [4, 5), [9, 10), those of 1-2 [3, 5) and [5, 7) across the rounds
+    pair_list = [[(0, 1)], [], [], [(1, 0), (1, 2)], [(0, 1)], [(2, 1)], [], [], [], [(0, 1)]]
+    offsets = np.zeros(11, dtype=np.int64)
+    np.cumsum([len(pair_info) for pair_info in pair_list], out=offsets[1:])
+    pairs = [pair for pair_info in pair_list for pair in pair_info]
+    return road_sim.ContactTrace(offsets, pairs, np.zeros((3, 10)), 5, [2, 1, 2, 1, 2, 1], np.zeros(6))
+
+
+def test_contact_statistics_of_a_hand_built_trace():
+    trace = get_hand_built_trace()
+    meetings, partners, contact_seconds = contact_analysis.get_meeting_rates(trace)
+    assert np.array_equal(meetings, [2, 3, 1])
+    assert np.array_equal(partners, [1, 2, 1])
+    assert np.array_equal(contact_seconds, [2.5, 4.5, 2])
+    gap, pair = contact_analysis.get_inter_contact_times(trace)
+    assert np.array_equal(gap, [1, 4]) and np.array_equal(pair, [[0, 1], [0, 1]])
+
+
+def test_contact_analysis_is_stored_with_the_trace(tmp_path, monkeypatch):
+    trace_path = str(tmp_path / 'trace_key.npz')
+    trace_store.save_trace(trace_path, get_hand_built_trace())
+    analysis = contact_analysis.load_or_analyze_trace(trace_path)
+    assert os.path.exists(contact_analysis.get_analysis_path(trace_path))
+
+    def analyze_trace(trace):
+        raise AssertionError('the stored analysis was computed again')
+
+    monkeypatch.setattr(contact_analysis, 'analyze_trace', analyze_trace)
+    stored = contact_analysis.load_or_analyze_trace(trace_path)
+    assert sorted(stored) == sorted(analysis)
+    for key in analysis:
+        assert np.array_equal(stored[key], analysis[key], equal_nan=np.asarray(analysis[key]).dtype.kind == 'f')
+
+
+def test_vectorized_fleet_init_matches_init_fleet():
+    pos_list, adj_matrix, adj_matrix_area, _, _, _, _ = get_toy_road()
+    area_labels = (pos_list[:, 0] > 2).astype(int)
+    car_type_list = [0, 1, 2, 0, 2] * 6000
+    speed = np.linspace(0.1, 0.2, len(car_type_list))
+    fleets = {
+        'sequential': road_sim.init_fleet(len(car_type_list), car_type_list, speed, pos_list, adj_matrix, adj_matrix_area,
+                                          area_labels, np.random.RandomState(10086), random.Random(10086)),
+        'vectorized': road_sim.init_fleet_vectorized(len(car_type_list), car_type_list, speed, pos_list, adj_matrix,
+                                                     adj_matrix_area, area_labels, np.random.RandomState(10086)),
+    }
+    again = road_sim.init_fleet_vectorized(len(car_type_list), car_type_list, speed, pos_list, adj_matrix,
+                                           adj_matrix_area, area_labels, np.random.RandomState(10086))
+    assert np.array_equal(again.source, fleets['vectorized'].source)
+    assert np.array_equal(again.destination, fleets['vectorized'].destination)
+    # init_fleet draws one car after the other, so the two only agree in distribution:
+    # a uniform start node with a road for the car type, then a uniform road leaving it
+    car_type = np.array(car_type_list)
+    for fleet in fleets.values():
+        assert np.array_equal(fleet.car_type, car_type) and np.array_equal(fleet.speed, speed)
+        for type_index, graph in [(0, adj_matrix), (1, adj_matrix_area), (2, adj_matrix_area)]:
+            cars = np.nonzero(car_type == type_index)[0]
+            degree = np.diff(graph.indptr)
+            nodes = np.nonzero(degree > 0)[0] if type_index == 0 else np.nonzero((area_labels == type_index - 1) & (degree > 0))[0]
+            probability = np.zeros(graph.shape)
+            for node in nodes:
+                probability[node, road_sim.get_neighbors(graph, node)] = 1 / len(nodes) / degree[node]
+            assert graph[fleet.source[cars], fleet.destination[cars]].all()
+            frequency = np.zeros(graph.shape)
+            np.add.at(frequency, (fleet.source[cars], fleet.destination[cars]), 1 / len(cars))
+            assert np.all(np.abs(frequency - probability) <= 5 * np.sqrt(probability * (1 - probability) / len(cars)) + 1e-12)
+
+
+def test_speed_list_follows_the_speed_mix():
+    assert road_sim.parse_speed_class('0.25:5:0.5') == (0.25, 5, 0.5)
+    state = get_rng_state()
+    speed_mix = [(0.25, 6, 0.5), (0.5, 20, 1.5), (0.25, 1, 0.4)]
+    speed = road_sim.get_speed_list(40000, speed_mix, 1)
+    assert get_rng_state() == state
+    assert np.array_equal(speed, road_sim.get_speed_list(40000, speed_mix, 1))
+    # the classes do not overlap, except for the slow one which is cut at a tenth of its mean
+    classes = [(speed >= 2.5) & (speed < 12), speed >= 12, speed < 2.5]
+    assert sum(np.count_nonzero(members) for members in classes) == len(speed)
+    for (share, mean, std), members in zip(speed_mix[:2], classes):
+        assert abs(np.mean(members) - share) < 0.01
+        assert abs(speed[members].mean() - mean) < 0.05 * mean and abs(speed[members].std() - std) < 0.05 * std
+    assert abs(np.mean(classes[2]) - 0.25) < 0.01
+    assert speed.min() == 0.1 and np.count_nonzero(speed == 0.1) > 10
+
+
+def get_random_trace(rng, num_car, num_round, epoch_time, num_area = 10, duration = True):
+    # meetings in some seconds only, the first and the last ones empty
+    counts = rng.randint(0, 3, num_round * epoch_time) * (rng.rand(num_round * epoch_time) < 0.6)
+    counts[[0, -1]] = 0
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    pairs = np.array([rng.choice(num_car, 2, replace=False) for _ in range(offsets[-1])]).reshape(-1, 2)
+    area = rng.randint(0, num_area, (num_car, num_round * epoch_time))
+    if not duration:
+        return road_sim.ContactTrace(offsets, pairs, area, epoch_time)
+    return road_sim.ContactTrace(offsets, pairs, area, epoch_time, rng.randint(1, epoch_time + 1, len(pairs)),
+                                 rng.rand(len(pairs)) * 100)
+
+
+def assert_same_trace(trace, expected):
+    for name in ['offsets', 'pairs', 'area', 'duration', 'distance']:
+        value, expected_value = getattr(trace, name), getattr(expected, name)
+        assert (value is None and expected_value is None) or np.array_equal(value, expected_value)
+    assert trace.epoch_time == expected.epoch_time
+
+
+def test_trace_file_round_trip(tmp_path):
+    rng = np.random.RandomState(0)
+    # with contact durations and uint8 areas, and without durations and with int32 areas
+    for duration, num_area in [(True, 10), (False, 300)]:
+        trace = get_random_trace(rng, 6, 4, 5, num_area, duration)
+        path = str(tmp_path / 'trace.bin')
+        trace_file.write_trace_file(path, trace)
+        reader = trace_file.TraceReader(path)
+        assert (reader.num_car, reader.num_round, reader.epoch_time) == (6, 4, 5)
+        assert_same_trace(reader.get_trace(), trace)
+        sliced = reader.get_trace(1, 3)
+        assert np.array_equal(sliced.area, trace.area[:, 5:15])
+        assert [pairs.tolist() for pairs in sliced] == [trace[second].tolist() for second in range(5, 15)]
+        for round_index in range(4):
+            assert [pairs.tolist() for pairs in reader.get_round(round_index)] == \
+                [trace[second].tolist() for second in range(round_index * 5, (round_index + 1) * 5)]
+        seconds = list(reader.iter_seconds(3, 17))
+        assert [second for second, _, _ in seconds] == list(range(3, 17))
+        for second, pairs, area in seconds:
+            assert np.array_equal(pairs, trace[second]) and np.array_equal(area, trace.area[:, second])
+        assert any(len(pairs) == 0 for _, pairs, _ in seconds)
+    # rounds appended one at a time, as a streamed trace is written
+    stream_path = str(tmp_path / 'stream.bin')
+    writer = trace_file.TraceWriter(stream_path, trace.num_car, trace.epoch_time)
+    for round_index in range(4):
+        writer.write_round(reader.get_round(round_index), round_index)
+    assert_same_trace(trace_file.TraceReader(stream_path).get_trace(), trace)
+
+
+def test_trace_file_command_line(tmp_path, monkeypatch, capsys):
+    trace = road_sim.ContactTrace.from_pair_list([[(0, 1)], [], [(1, 2), (0, 2)], [], [(2, 0)], []],
+                                                  np.arange(18).reshape(3, 6) % 4, 3)
+    path = str(tmp_path / 'trace.bin')
+    trace_file.write_trace_file(path, trace)
+    for argv, expected in [
+            ([], ['3 cars, 2 rounds of 3 s, 4 meetings']),
+            (['--round', '1'], ['Round:1: ', 'Seconds:0: ', '[]', 'Seconds:1: ', '[[2, 0]]', 'Seconds:2: ', '[]']),
+            (['--second', '2', '4', '--area'], ['Round:0: ', 'Seconds:2: ', '[[1, 2], [0, 2]]', 'Area: [2, 0, 2]',
+                                               'Round:1: ', 'Seconds:0: ', '[]', 'Area: [3, 1, 3]'])]:
+        monkeypatch.setattr(sys, 'argv', ['trace_file.py', path] + argv)
+        trace_file.main()
+        assert capsys.readouterr().out.splitlines() == expected
+
+
+def get_small_models(num_model):
+    # parameters and BatchNorm buffers, the int64 num_batches_tracked among them
+    torch.manual_seed(0)
+    models = [nn.Sequential(nn.Conv2d(1, 4, 3), nn.BatchNorm2d(4), nn.Flatten(), nn.Linear(4 * 6 * 6, 3))
+              for _ in range(num_model)]
+    for model in models:
+        model.train()
+        for _ in range(torch.randint(1, 4, (1,)).item()):
+            model(torch.randn(5, 1, 8, 8))
+    return models
+
+
+def test_snapshot_is_never_written(tmp_path):
+    # torch has no read-only tensors, so check that training and aggregation leave the vector alone
+    models = get_small_models(3)
+    store = model_store.ModelStore()
+    snapshots = store.snapshot_round(0, models)
+    vectors = [snapshot.vector.clone() for snapshot in snapshots]
+    for snapshot in snapshots:
+        # the tensors of the vector dtype are views, no copy of the snapshot
+        state = snapshot.state_dict()
+        assert state['0.weight'].data_ptr() == snapshot.vector.data_ptr()
+        assert state['3.bias'].untyped_storage().data_ptr() == snapshot.vector.untyped_storage().data_ptr()
+    for model, snapshot in zip(models, snapshots):
+        snapshot.load_into(model)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        model(torch.randn(5, 1, 8, 8)).sum().backward()
+        optimizer.step()
+        assert not torch.equal(snapshot.vector, snapshot.layout.flatten(model.state_dict()))
+    cache = {key: {'model': snapshots[key], 'time': 0} for key in [1, 2]}
+    cache_algorithm.cache_average_process(models[0], 0, 1, cache, np.ones(3))
+    for snapshot, vector in zip(snapshots, vectors):
+        assert torch.equal(snapshot.vector, vector)
+
+
+def test_cache_entries_share_the_snapshot_of_a_round():
+    num_car = 6
+    models = get_small_models(num_car)
+    store = model_store.ModelStore()
+    local_cache = [{} for _ in range(num_car)]
+    meetings = [(0, 1), (1, 2), (2, 3), (0, 3), (3, 4), (4, 5), (1, 5)]
+    for round_index in range(2):
+        model_before_training = store.snapshot_round(round_index, models)
+        pointers = [snapshot.vector.data_ptr() for snapshot in model_before_training]
+        for a, b in meetings:
+            cache_algorithm.update_model_cache(local_cache, model_before_training[a], model_before_training[b], a, b,
+                                               round_index, 10, False)
+        for i in range(num_car):
+            for car, entry in local_cache[i].items():
+                if entry['time'] == round_index:
+                    # the snapshot of the round itself, not a copy of it
+                    assert entry['model'] is model_before_training[car]
+                    assert entry['model'].vector.data_ptr() == pointers[car]
+                else:
+                    assert entry['model'] is store.get(car, entry['time'])
+        # one vector per car and round, however many caches hold it
+        entries = [(car, entry['time'], entry['model']) for cache in local_cache for car, entry in cache.items()]
+        assert len({id(model) for _, _, model in entries}) == len({(car, time) for car, time, _ in entries})
+        assert len(entries) > len({(car, time) for car, time, _ in entries})
+        for model in models:
+            model[3].bias.data += 1
+    # the store only keeps the versions a cache still refers to
+    del model_before_training, entries
+    cached = {(car, entry['time']) for cache in local_cache for car, entry in cache.items()}
+    assert set(store.versions.keys()) == cached
+
+
+def test_vector_average_matches_average_weights():
+    models = get_small_models(4)
+    full_weight_list = np.array([3.0, 1.0, 2.5, 0.5])
+    cache = {key: {'model': deepcopy(models[key]), 'time': 1} for key in [1, 2, 3]}
+    expected = cache_algorithm.cache_average_process(deepcopy(models[0]), 0, 2, cache, full_weight_list)
+    snapshots = model_store.snapshot_models(models)
+    cache = {key: {'model': snapshots[key], 'time': 1} for key in [1, 2, 3]}
+    assert model_store.get_cache_layout(cache) is not None
+    result = cache_algorithm.cache_average_process(deepcopy(models[0]), 0, 2, cache, full_weight_list)
+    # the same operations on every element, so the parameters and buffers are bitwise equal
+    for name, tensor in expected.state_dict().items():
+        assert tensor.dtype == result.state_dict()[name].dtype
+        assert torch.equal(tensor, result.state_dict()[name]), name